@@ -23,8 +23,8 @@ import time
 
 import imicrobe.models as im
 from imicrobe.util.irods import \
-    irods_copy, irods_create_collection, irods_data_object_checksums_match, \
-    irods_data_object_exists, irods_delete, irods_delete_collection, irods_session_manager
+    irods_create_collection, irods_delete, irods_delete_collection, irods_session_manager
+from imicrobe.util.irods_sync import sync_irods_to_irods
 import muscope_loader.models as mu
 from orminator import session_manager_from_db_uri
 
@@ -207,24 +207,20 @@ with session_manager_from_db_uri(db_uri=os.environ.get('MUSCOPE_DB_URI')) as mu_
                                 irods_session,
                                 target_collection_path=im_sample_collection_path)
 
-                            if irods_data_object_exists(irods_session, im_sample_file.file_) and \
-                                    irods_data_object_checksums_match(irods_session, mu_sample_file.file_, im_sample_file.file_):
-                                print('  imicrobe sample file "{}" matches muscope sample file "{}"'.format(
-                                    im_sample_file.file_, mu_sample_file.file_))
-                            else:
-                                print('copying')
-                                t0 = time.time()
-                                try:
-                                    irods_copy(
-                                        irods_session,
-                                        src_path=mu_sample_file.file_,
-                                        dest_path=im_sample_file.file_)
+                            # copy only if the imicrobe file is missing or differs by size or checksum
+                            t0 = time.time()
+                            try:
+                                if len(sync_irods_to_irods(
+                                        irods_session, {mu_sample_file.file_: im_sample_file.file_})) == 0:
+                                    print('  imicrobe sample file "{}" matches muscope sample file "{}"'.format(
+                                        im_sample_file.file_, mu_sample_file.file_))
+                                else:
                                     print('  copied file in {:5.2f}s'.format(time.time()-t0))
-                                except Exception as e:
-                                    print('  *** FAILED to copy file "{}" to "{}"'.format(
-                                        mu_sample_file.file_, im_sample_file.file_))
-                                    print('  *** after {:5.2f}s'.format(time.time()-t0))
-                                    print(e)
+                            except Exception as e:
+                                print('  *** FAILED to copy file "{}" to "{}"'.format(
+                                    mu_sample_file.file_, im_sample_file.file_))
+                                print('  *** after {:5.2f}s'.format(time.time()-t0))
+                                print(e)
                     else:
                         print('*** file copy is disabled ***')
 
@@ -11,18 +11,29 @@ from orminator import session_manager_from_db_uri
 def get_args():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--sample-limit', type=int, default=None, required=False)
+    arg_parser.add_argument('--workers', type=int, default=4, required=False,
+                            help='number of threads listing iRODS collections')
     args = arg_parser.parse_args()
     print(args)
     return args
 
 
-def find_missing_sample_files(sample_limit=100):
+def find_missing_sample_files(sample_limit=100, workers=4):
 
     for project, samples in irods.get_project_sample_collection_paths(sample_limit=sample_limit).items():
         print('project "{}"'.format(project))
         print('failed to find:')
-        for sample in samples:
-            for parent_collection, child_collections, data_objects in irods.walk(sample):
+        if len(samples) == 0:
+            continue
+        # walk the project's samples collection once rather than each sample
+        samples_collection_path = os.path.join(project, 'samples')
+        sample_set = set(samples)
+        for parent_collection, child_collections, data_objects in irods.walk(samples_collection_path, workers=workers):
+            sample = os.path.join(
+                samples_collection_path,
+                os.path.relpath(parent_collection.path, samples_collection_path).split('/')[0])
+            # skip data objects directly in the samples collection and samples beyond the sample limit
+            if sample in sample_set:
                 for data_object in data_objects:
                     #print('searching table sample_file for "{}"'.format(data_object.path))
                     with session_manager_from_db_uri(db_uri=os.environ['IMICROBE_DB_URI']) as imicrobe_db_session:
@@ -46,7 +57,7 @@ args = get_args()
 path_pattern = re.compile(r'projects/(?P<project_id>\d+)/samples/(?P<sample_id>\d+)')
 t0 = time.time()
 new_sample_file_count = 0
-for missing_sample_file in find_missing_sample_files(sample_limit=args.sample_limit):
+for missing_sample_file in find_missing_sample_files(sample_limit=args.sample_limit, workers=args.workers):
     print('  {}'.format(missing_sample_file))
     path_match = path_pattern.search(missing_sample_file)
     if path_match is None:
@@ -2,7 +2,9 @@
 First task:
 on Stampede2 copy UProC output files from TACC to IRODS.
 It took about 900s on Stampede2 to check that all ~8900 files were
-already present in /iplant/home/shared/imicrobe/projects
+already present in /iplant/home/shared/imicrobe/projects when each
+file was checked separately. Now the check is one catalog query per
+batch of sample collections.
 
 Second task:
 on myo read UProC files from IRODS and load imicrobe database
@@ -13,13 +15,16 @@ import sys
 import time
 
 import imicrobe.util.irods as irods
+from imicrobe.util.irods_sync import sync_local_to_irods
 
 
-def copy_uproc_output_to_irods(source_root, target_root, file_limit):
+def copy_uproc_output_to_irods(source_root, target_root, file_limit, jobs=4, dry_run=False, compare='mtime'):
     """
     This is intended to run on Stampede2 in the imicrobe account.
-    Walk the load directory and copy each UProC output file to IRODS target_root.
-    :return:
+    Walk the load directory and copy each UProC output file to IRODS target_root
+    if it is missing or differs (see imicrobe.util.irods_sync).
+    Files are copied `jobs` at a time and checksums are verified after each copy.
+    :return: imicrobe.util.irods_transfer.TransferSummary
     """
 
     print('source directory is "{}"'.format(source_root))
@@ -71,32 +76,9 @@ def copy_uproc_output_to_irods(source_root, target_root, file_limit):
 
     print('found {} UProC results files in {:5.2f}s'.format(len(uproc_results_files), time.time()-t0))
 
-    t0 = time.time()
-    print('which files are already in "{}"?'.format(target_root))
-    files_to_be_copied = {}
-    with irods.irods_session_manager() as irods_session:
-        for source_fp, target_fp in sorted(uproc_results_files.items()):
-            if irods.irods_data_object_exists(irods_session, target_fp):
-                pass
-            else:
-                files_to_be_copied[source_fp] = target_fp
-    print('found {} files to be copied in {:5.2f}s'.format(len(files_to_be_copied), time.time()-t0))
-
-    print('\ncopying {} files to "{}"'.format(len(files_to_be_copied), target_root))
+    print('\nwhich files are missing or different in "{}"?'.format(target_root))
 
-    for source_fp, target_fp in sorted(files_to_be_copied.items()):
-        print('copying\n\t"{}"\nto \n\t"{}"'.format(source_fp, target_fp))
-        t0 = time.time()
-        copy_file_to_irods(source_fp, target_fp)
-        print('finished copy in {:5.2f}s'.format(time.time()-t0))
-
-
-def copy_file_to_irods(source_fp, target_fp):
-    with irods.irods_session_manager() as irods_session:
-        if irods.irods_data_object_exists(irods_session, target_fp):
-            pass
-        else:
-            irods.irods_put(irods_session, source_fp, target_fp)
+    return sync_local_to_irods(uproc_results_files, jobs=jobs, compare=compare, dry_run=dry_run)
 
 
 def main(argv):
@@ -104,13 +86,25 @@ def main(argv):
     arg_parser.add_argument('--source-root')
     arg_parser.add_argument('--target-root')
     arg_parser.add_argument('--file-limit', type=int, default=None, required=False)
+    arg_parser.add_argument('--jobs', type=int, default=4, required=False,
+                            help='number of files copied at the same time')
+    arg_parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='list the files to be copied but copy nothing')
+    arg_parser.add_argument('--compare', choices=('exists', 'size', 'mtime', 'checksum'), default='mtime',
+                            help='copy files that are missing, or also differ by size, or also differ by checksum')
 
     args = arg_parser.parse_args(args=argv)
 
-    copy_uproc_output_to_irods(
+    transfer_summary = copy_uproc_output_to_irods(
         source_root=args.source_root,
         target_root=args.target_root,
-        file_limit=args.file_limit)
+        file_limit=args.file_limit,
+        jobs=args.jobs,
+        dry_run=args.dry_run,
+        compare=args.compare)
+
+    if len(transfer_summary.failed_paths) > 0:
+        sys.exit(1)
 
 
 def cli():
@@ -0,0 +1,128 @@
+"""
+A local checkpoint ledger for load.py.
+
+The ledger is a SQLite file with one row per sample collection. Each row records
+a fingerprint of the sample's UProC results data objects (name, size, checksum
+and modify time) and whether loading that sample has finished. A restarted load
+skips samples that finished with the same fingerprint and reloads samples that
+were interrupted or whose UProC results have changed.
+
+Rows are kept separately for each database, so one ledger file can be used to load
+more than one database. The rows for a database must be cleared when its results
+tables are dropped, otherwise every sample would be skipped.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+
+import sqlalchemy
+
+
+def ledger_database_key(db_uri):
+    """Return the database URI without its password, used to separate the ledger rows of different databases."""
+    return sqlalchemy.engine.make_url(db_uri).render_as_string(hide_password=True)
+
+
+def uproc_results_fingerprint(data_objects):
+    """Return a fingerprint for a list of UProC results data objects.
+
+    :param data_objects: iRODS data objects (anything with name, size, checksum, and modify_time)
+    :return: hex digest string
+    """
+    fingerprint = hashlib.sha256()
+    for data_object in sorted(data_objects, key=lambda d: d.name):
+        fingerprint.update('{}\t{}\t{}\t{}\n'.format(
+            data_object.name,
+            data_object.size,
+            data_object.checksum,
+            data_object.modify_time).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+class UProCLoadLedger:
+    """
+    Record which sample collections have been loaded into one database. Safe to share between threads.
+    """
+    STARTED = 'started'
+    FINISHED = 'finished'
+
+    def __init__(self, ledger_fp, db_uri):
+        """
+        :param ledger_fp: path to the ledger SQLite file
+        :param db_uri: SQLAlchemy URI of the database being loaded
+        """
+        self.ledger_fp = ledger_fp
+        self.database = ledger_database_key(db_uri)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(ledger_fp, check_same_thread=False)
+        sample_load_columns = [row[1] for row in self.connection.execute('pragma table_info(sample_load)')]
+        if len(sample_load_columns) > 0 and 'database' not in sample_load_columns:
+            # ledgers written before rows were kept per database can not be trusted for any database
+            print('discarding checkpoint ledger "{}" without database column'.format(ledger_fp))
+            self.connection.execute('drop table sample_load')
+        self.connection.execute("""
+            create table if not exists sample_load (
+                database text not null,
+                sample_collection_path text not null,
+                fingerprint text not null,
+                status text not null,
+                updated real not null,
+                primary key (database, sample_collection_path)
+            )""")
+        self.connection.commit()
+        print('checkpoint ledger "{}" has {} finished sample(s) for database "{}"'.format(
+            ledger_fp, self.count_finished(), self.database))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def count_finished(self):
+        with self.lock:
+            return self.connection.execute(
+                'select count(*) from sample_load where database = ? and status = ?',
+                (self.database, self.FINISHED)).fetchone()[0]
+
+    def clear(self):
+        """Forget every sample loaded into this database, for example after its results tables are dropped."""
+        with self.lock:
+            with self.connection:
+                cleared_count = self.connection.execute(
+                    'delete from sample_load where database = ?', (self.database, )).rowcount
+        print('cleared {} sample(s) from checkpoint ledger "{}"'.format(cleared_count, self.ledger_fp))
+
+    def is_finished(self, sample_collection_path, fingerprint):
+        """Return True if the sample finished loading with the same fingerprint."""
+        with self.lock:
+            row = self.connection.execute(
+                'select fingerprint, status from sample_load where database = ? and sample_collection_path = ?',
+                (self.database, sample_collection_path)).fetchone()
+        return row is not None and row == (fingerprint, self.FINISHED)
+
+    def mark_started(self, sample_collection_path, fingerprint):
+        self.mark([(sample_collection_path, fingerprint)], self.STARTED)
+
+    def mark_finished(self, sample_collection_path_fingerprints):
+        """Mark samples finished.
+
+        :param sample_collection_path_fingerprints: list of (sample collection path, fingerprint)
+        """
+        self.mark(sample_collection_path_fingerprints, self.FINISHED)
+
+    def mark(self, sample_collection_path_fingerprints, status):
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    'insert or replace into sample_load values (?, ?, ?, ?, ?)',
+                    [
+                        (self.database, sample_collection_path, fingerprint, status, now)
+                        for sample_collection_path, fingerprint
+                        in sample_collection_path_fingerprints])
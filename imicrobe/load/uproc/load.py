@@ -2,24 +2,29 @@
 Read UProC results files from an IRODS collections and load the imicrobe database.
 """
 import argparse
-import gzip
+import concurrent.futures
 import itertools
 import os
-import re
+import queue
 import subprocess
 import sys
+import threading
 import time
 
 import pandas as pd
-import pandas.errors
 import sqlalchemy
 
 from orminator import session_manager_from_db_uri
 
 import imicrobe.load.uproc.tables as uproc_tables
-from imicrobe.util import grouper
-from imicrobe.util.irods import get_project_sample_collection_paths, irods_session_manager
+from imicrobe.load.uproc.ledger import UProCLoadLedger, uproc_results_fingerprint
+from imicrobe.load.uproc.results import combine_uproc_results, uproc_results_file_name_re
+from imicrobe.util.accession_cache import AccessionIdCache
+from imicrobe.util.irods import get_project_sample_data_objects, irods_session_manager
 from imicrobe.util.kegg import get_kegg_annotations
+from imicrobe.util.kegg_store import KeggAnnotationStore
+from imicrobe.util.pfam import \
+    diff_pfam_catalogue, file_sha256, read_dead_family_table, read_pfam_version, read_pfamA_table
 
 
 def get_args(argv):
@@ -52,6 +57,60 @@ def get_args(argv):
         help='Stop after --sample-limit samples have been processed'
     )
 
+    arg_parser.add_argument(
+        '--insert-mode',
+        required=False,
+        choices=('bulk', 'orm'),
+        default='bulk',
+        help='Insert UProC results with chunked Core inserts (bulk) or one ORM object per row (orm)'
+    )
+
+    arg_parser.add_argument(
+        '--insert-chunk-size',
+        required=False,
+        type=int,
+        default=10000,
+        help='Number of sample_to_protein rows per INSERT in bulk mode'
+    )
+
+    arg_parser.add_argument(
+        '--workers',
+        required=False,
+        type=int,
+        default=1,
+        help='Number of iRODS download threads and number of parsing processes'
+    )
+
+    arg_parser.add_argument(
+        '--db-batch-size',
+        required=False,
+        type=int,
+        default=1,
+        help='Number of samples inserted per database transaction'
+    )
+
+    arg_parser.add_argument(
+        '--ledger-fp',
+        required=False,
+        default='uproc_load_ledger.sqlite3',
+        help='Checkpoint ledger file used to skip samples that have been loaded'
+    )
+
+    arg_parser.add_argument(
+        '--kegg-store-fp',
+        required=False,
+        default=None,
+        help='KEGG annotation store file (default is $IMICROBE_KEGG_STORE or ~/.cache/imicrobe/kegg_annotations.sqlite3)'
+    )
+
+    arg_parser.add_argument(
+        '--offline',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Take KEGG annotations only from the KEGG annotation store'
+    )
+
     args = arg_parser.parse_args(args=argv)
 
     return args
@@ -63,15 +122,27 @@ def main(argv):
 
     if args.drop_results_tables:
         drop_results_tables(args.db_uri)
+        # samples recorded in the ledger are no longer in the database
+        with UProCLoadLedger(args.ledger_fp, args.db_uri) as ledger:
+            ledger.clear()
     if args.drop_annotation_tables:
         drop_annotation_tables(args.db_uri)
     create_tables(args.db_uri)
     load_protein_type_table(args.db_uri)
     load_protein_evidence_type_table(args.db_uri)
 
-    download_pfam_file()
+    download_pfam_files()
 
-    load_annotations(args.db_uri, args.sample_limit)
+    load_annotations(
+        args.db_uri,
+        args.sample_limit,
+        insert_mode=args.insert_mode,
+        insert_chunk_size=args.insert_chunk_size,
+        workers=args.workers,
+        db_batch_size=args.db_batch_size,
+        ledger_fp=args.ledger_fp,
+        kegg_store_fp=args.kegg_store_fp,
+        offline=args.offline)
 
 
 def create_tables(db_uri):
@@ -79,6 +150,7 @@ def create_tables(db_uri):
 
     uproc_tables.Protein_type.__table__.create(bind=engine, checkfirst=True)
     uproc_tables.Protein.__table__.create(bind=engine, checkfirst=True)
+    uproc_tables.Protein_catalogue.__table__.create(bind=engine, checkfirst=True)
     uproc_tables.Protein_evidence_type.__table__.create(bind=engine, checkfirst=True)
     uproc_tables.Sample_to_protein.__table__.create(bind=engine, checkfirst=True)
 
@@ -89,6 +161,7 @@ def create_tables(db_uri):
 def drop_annotation_tables(db_uri):
     engine = sqlalchemy.create_engine(db_uri, echo=False)
 
+    uproc_tables.Protein_catalogue.__table__.drop(bind=engine, checkfirst=True)
     uproc_tables.Protein.__table__.drop(bind=engine, checkfirst=True)
     uproc_tables.Protein_type.__table__.drop(bind=engine, checkfirst=True)
 
@@ -129,109 +202,119 @@ def load_protein_evidence_type_table(db_uri):
                 imicrobe_db_session.add(uproc_tables.Protein_evidence_type(type_=p))
 
 
-def download_pfam_file():
-    pfam_fp = 'pfamA.txt.gz'
-    if os.path.exists(pfam_fp):
-        print('PFam file {} already exists'.format(pfam_fp))
-    else:
+pfam_current_release_url = 'ftp://ftp.ebi.ac.uk/pub/databases/Pfam/current_release'
+pfam_catalogue_files = {
+    'pfamA.txt.gz': pfam_current_release_url + '/database_files/pfamA.txt.gz',
+    'dead_family.txt.gz': pfam_current_release_url + '/database_files/dead_family.txt.gz',
+    'Pfam.version.gz': pfam_current_release_url + '/Pfam.version.gz'
+}
+
+
+def download_pfam_files():
+    """Download the Pfam catalogue files to the current directory. With timestamping (-N)
+    wget downloads a file only if it is missing or the upstream file is newer.
+
+    If a download fails an existing copy of the file is used. Raise an exception if
+    there is no copy.
+    """
+    for pfam_fp, pfam_url in pfam_catalogue_files.items():
         t0 = time.time()
-        subprocess.run(['wget', 'ftp://ftp.ebi.ac.uk/pub/databases/Pfam/current_release/database_files/pfamA.txt.gz', 'pfamA.txt.gz'])
-        print('downloaded PFam file in {:5.2f}s'.format(time.time() - t0))
+        try:
+            subprocess.run(['wget', '--quiet', '-N', pfam_url], check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            if os.path.exists(pfam_fp):
+                print('failed to download PFam file {}, using existing file {}: {}'.format(pfam_url, pfam_fp, e))
+            else:
+                raise Exception('failed to download PFam file {}: {}'.format(pfam_url, e))
+        else:
+            print('PFam file {} is up to date ({:5.2f}s)'.format(pfam_fp, time.time() - t0))
 
 
-def load_annotations(db_uri, sample_limit):
+def load_annotations(
+        db_uri, sample_limit, insert_mode='bulk', insert_chunk_size=10000, workers=1, db_batch_size=1,
+        ledger_fp='uproc_load_ledger.sqlite3', kegg_store_fp=None, offline=False):
     """Read UProC KEGG results files. Load KEGG annotations as needed.
 
+    Samples move through three stages connected by bounded queues:
+        1. `workers` I/O threads download the UProC results for each sample
+        2. a process pool of `workers` processes parses and combines the results for each sample
+        3. a single writer (this thread) inserts results, committing every `db_batch_size` samples
+    A full queue blocks the stage feeding it so downloaded and parsed results do not pile up in memory.
+
+    All sample collections and their UProC results data objects are listed up front with a few catalog
+    queries. Finished samples are recorded in a checkpoint ledger (see imicrobe.load.uproc.ledger). A sample
+    is skipped without contacting iRODS again if it finished with the same UProC results data objects. Otherwise any results already
+    in the database for the sample are replaced in the same transaction that inserts the new results.
+
+    :param db_uri: SQLAlchemy database URI
+    :param sample_limit: stop after this many samples (None for all samples)
+    :param insert_mode: 'bulk' or 'orm', see UProCResultsService
+    :param insert_chunk_size: rows per INSERT statement in 'bulk' mode
+    :param workers: number of I/O threads and number of parsing processes
+    :param db_batch_size: number of samples inserted per database transaction
+    :param ledger_fp: path to the checkpoint ledger SQLite file
+    :param kegg_store_fp: path to the KEGG annotation store, see imicrobe.util.kegg_store
+    :param offline: if True take KEGG annotations only from the KEGG annotation store
     :return:
     """
 
-    uproc_results_file_name_re = re.compile(r'\.uproc\.(kegg|pfam\d+)$')
-
-    uproc_results_service = UProCResultsService(db_uri)
+    uproc_results_service = UProCResultsService(
+        db_uri,
+        insert_mode=insert_mode,
+        insert_chunk_size=insert_chunk_size,
+        kegg_store=KeggAnnotationStore(store_fp=kegg_store_fp),
+        offline=offline)
 
-    uproc_results_service.insert_pfam_annotations_from_file(pfamA_fp='pfamA.txt.gz')
+    uproc_results_service.sync_pfam_catalogue(
+        pfamA_fp='pfamA.txt.gz',
+        dead_family_fp='dead_family.txt.gz',
+        pfam_version_fp='Pfam.version.gz')
 
     imicrobe_project_root = '/iplant/home/shared/load/projects'
-    project_to_sample_collection_paths = get_project_sample_collection_paths(
-        collection_root=imicrobe_project_root, sample_limit=sample_limit)
+    project_to_sample_data_objects = get_project_sample_data_objects(
+        collection_root=imicrobe_project_root,
+        name_re=uproc_results_file_name_re,
+        sample_limit=sample_limit)
+
+    downloaded_queue = queue.Queue(maxsize=2 * workers)
+    parsed_queue = queue.Queue(maxsize=2 * workers)
 
-    sample_count = sum([len(s) for p, s in project_to_sample_collection_paths.items()])
-    sample_index = 0
     t0 = time.time()
-    for project_collection_path, sample_collection_paths in project_to_sample_collection_paths.items():
-        print('project collection: "{}"'.format(project_collection_path))
-
-        # open a new irods session for each project
-        # seems to work better than using one session for all projects
-        with irods_session_manager() as irods_session:
-            for sample_collection_path in sample_collection_paths:
-                sample_index += 1
-                print('* inserting results for sample {} of {}'.format(sample_index, sample_count))
-                sample_collection = irods_session.collections.get(sample_collection_path)
-                sample_data_objects = sample_collection.data_objects
-
-                # put all parsed data frames for this sample into a list
-                # in most cases there will be only one data frame
-                sample_uproc_results_data_object_list = []
-                for data_object in sample_data_objects:
-                    #print('\t' + data_object.name)
-                    m = uproc_results_file_name_re.search(data_object.name)
-                    if m is None:
-                        pass
-                    elif data_object.size == 0:
-                        print('{} is empty'.format(data_object.path))
-                    else:
-                        # it can happen that a sample has more than one sample file
-                        # there will be one UProC result file for each sample file
-                        # all UProC results for a single sample must be combined
-                        #print(data_object.path)
-                        sample_uproc_results_data_object_list.append(data_object)
-
-                if len(sample_uproc_results_data_object_list) == 0:
-                    print('  found no UProC results in\n\t{}'.format(sample_collection_path))
-                elif uproc_results_service.count_uproc_results_for_sample(sample_id=sample_collection.name) > 0:
-                    # assume all data for this sample has been inserted
-                    print('* results for sample {} have been loaded'.format(sample_collection.name))
-                else:
-                    print('  reading UProC results for sample {}\n\t{}'.format(
-                        sample_collection.name,
-                        '\n\t'.join([s.name for s in sample_uproc_results_data_object_list])))
-                    sample_uproc_results_df_list = []
-                    for sample_uproc_results_data_object in sample_uproc_results_data_object_list:
-                        uproc_results_df = parse_uproc_results(sample_uproc_results_data_object)
-                        sample_uproc_results_df_list.append(uproc_results_df)
-                        #print(uproc_results_df.head())
-
-                    # combine the dataframes and insert the UProC results values
-                    if len(sample_uproc_results_df_list) == 0:
-                        pass
-                    else:
-                        combined_df = sample_uproc_results_df_list[0]
-                        for df in sample_uproc_results_df_list[1:]:
-                            combined_df = combined_df.add(df, fill_value=0.0)
-
-                        combined_df.sort_values(by='read_count', inplace=True, ascending=False)
-                        print('  combined data {}:\n{}'.format(combined_df.shape, combined_df.head()))
-                        t00 = time.time()
-
-                        uproc_results_service.insert_kegg_annotations_for_sample(
-                            annotation_results_df=combined_df[
-                                [accession.startswith('K') for accession in combined_df.index]])
-
-                        uproc_results_service.insert_uproc_results_for_sample(
-                            sample_id=sample_collection.name,
-                            uproc_results_df=combined_df)
-
-                        insertion_count = uproc_results_service.count_uproc_results_for_sample(
-                            sample_id=sample_collection.name)
-
-                        print('  inserted {} annotations for sample in {:5.2f}s'.format(
-                            insertion_count, time.time()-t00))
-
-                        print('* inserted {} of {} samples in {:5.2f}s'.format(
-                            sample_index, sample_count, time.time()-t0))
-
-    print('{} samples loaded'.format(sample_index))
+    with UProCLoadLedger(ledger_fp, db_uri) as ledger, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as parse_executor:
+        sample_collection_path_queue = queue.Queue()
+        for sample_to_load in get_samples_to_load(project_to_sample_data_objects, ledger):
+            sample_collection_path_queue.put(sample_to_load)
+        sample_count = sample_collection_path_queue.qsize()
+        # one stop signal for each I/O thread
+        for _ in range(workers):
+            sample_collection_path_queue.put(None)
+
+        pipeline_threads = [
+            threading.Thread(
+                target=download_uproc_results_worker,
+                args=(sample_collection_path_queue, downloaded_queue, ledger),
+                daemon=True)
+            for _ in range(workers)]
+        pipeline_threads.append(
+            threading.Thread(
+                target=parse_uproc_results_worker,
+                args=(downloaded_queue, parsed_queue, parse_executor, workers),
+                daemon=True))
+        for pipeline_thread in pipeline_threads:
+            pipeline_thread.start()
+
+        sample_index = write_uproc_results(
+            parsed_queue=parsed_queue,
+            uproc_results_service=uproc_results_service,
+            ledger=ledger,
+            sample_count=sample_count,
+            db_batch_size=db_batch_size)
+
+        for pipeline_thread in pipeline_threads:
+            pipeline_thread.join()
+
+    print('{} samples loaded in {:5.2f}s'.format(sample_index, time.time()-t0))
 
     with session_manager_from_db_uri(db_uri=db_uri) as imicrobe_db_session:
         sample_to_protein_count = imicrobe_db_session.query(uproc_tables.Sample_to_protein).count()
@@ -254,6 +337,165 @@ def load_annotations(db_uri, sample_limit):
         #'\t\n'.join(sorted(list(uproc_results_service.bad_accessions)))))
 
 
+def get_samples_to_load(project_to_sample_data_objects, ledger):
+    """Return a list of (sample_collection_path, fingerprint, [UProC results data objects]) for each
+    sample with non-empty UProC results that have not been loaded.
+
+    :param project_to_sample_data_objects: index of UProC results data objects as returned by
+        imicrobe.util.irods.get_project_sample_data_objects
+    :param ledger: UProCLoadLedger
+    """
+    samples_to_load = []
+    for project_collection_path, sample_to_data_objects in project_to_sample_data_objects.items():
+        for sample_collection_path, data_objects in sample_to_data_objects.items():
+            # it can happen that a sample has more than one sample file
+            # there will be one UProC result file for each sample file
+            # all UProC results for a single sample must be combined
+            sample_uproc_results_data_object_list = []
+            for data_object in data_objects:
+                if data_object.size == 0:
+                    print('{} is empty'.format(data_object.path))
+                else:
+                    sample_uproc_results_data_object_list.append(data_object)
+
+            fingerprint = uproc_results_fingerprint(sample_uproc_results_data_object_list)
+            if len(sample_uproc_results_data_object_list) == 0:
+                print('  found no UProC results in\n\t{}'.format(sample_collection_path))
+            elif ledger.is_finished(sample_collection_path, fingerprint):
+                print('* results for sample {} have been loaded'.format(os.path.basename(sample_collection_path)))
+            else:
+                samples_to_load.append((sample_collection_path, fingerprint, sample_uproc_results_data_object_list))
+
+    return samples_to_load
+
+
+def download_uproc_results_worker(sample_queue, downloaded_queue, ledger):
+    """I/O stage. Take (sample_collection_path, fingerprint, data objects) from sample_queue until None
+    arrives and put (sample_collection_path, sample_id, fingerprint, [(data object path, bytes), ...])
+    on downloaded_queue for each sample. Put None on downloaded_queue when finished.
+
+    Each sample is downloaded with a session checked out of the iRODS session pool.
+    """
+    try:
+        while True:
+            sample_to_load = sample_queue.get()
+            if sample_to_load is None:
+                break
+            sample_collection_path, fingerprint, data_objects = sample_to_load
+            try:
+                with irods_session_manager() as irods_session:
+                    downloaded_sample = download_sample_uproc_results(
+                        irods_session, sample_collection_path, fingerprint, data_objects, ledger)
+            except Exception as e:
+                print('failed to download UProC results from "{}"'.format(sample_collection_path))
+                print(e)
+                downloaded_sample = None
+
+            if downloaded_sample is not None:
+                downloaded_queue.put(downloaded_sample)
+    finally:
+        downloaded_queue.put(None)
+
+
+def download_sample_uproc_results(irods_session, sample_collection_path, fingerprint, data_objects, ledger):
+    sample_name = os.path.basename(sample_collection_path)
+    ledger.mark_started(sample_collection_path, fingerprint)
+    print('  reading UProC results for sample {}\n\t{}'.format(
+        sample_name,
+        '\n\t'.join([d.name for d in data_objects])))
+    sample_uproc_results = []
+    for data_object in data_objects:
+        with irods_session.data_objects.open(data_object.path, 'r') as d:
+            sample_uproc_results.append((data_object.path, d.read()))
+    return sample_collection_path, sample_name, fingerprint, sample_uproc_results
+
+
+def parse_uproc_results_worker(downloaded_queue, parsed_queue, parse_executor, download_worker_count):
+    """Parse stage. Submit each downloaded sample to parse_executor and put
+    (sample_collection_path, sample_id, fingerprint, future) on parsed_queue in the order samples were downloaded.
+    Put None on parsed_queue after all download workers have finished.
+
+    parsed_queue is bounded so at most a few samples are parsed ahead of the writer.
+    """
+    finished_download_worker_count = 0
+    try:
+        while finished_download_worker_count < download_worker_count:
+            downloaded_sample = downloaded_queue.get()
+            if downloaded_sample is None:
+                finished_download_worker_count += 1
+            else:
+                sample_collection_path, sample_id, fingerprint, sample_uproc_results = downloaded_sample
+                parsed_queue.put((
+                    sample_collection_path,
+                    sample_id,
+                    fingerprint,
+                    parse_executor.submit(combine_uproc_results, sample_uproc_results)))
+    finally:
+        parsed_queue.put(None)
+
+
+def write_uproc_results(parsed_queue, uproc_results_service, ledger, sample_count, db_batch_size):
+    """Writer stage. Insert parsed results for db_batch_size samples per transaction.
+    Samples are marked finished in the ledger after their transaction commits, except
+    samples with KEGG ids that could not be resolved in offline mode.
+
+    :return: number of samples inserted
+    """
+    sample_index = 0
+    t0 = time.time()
+    sample_batch = []
+    ledger_batch = []
+    while True:
+        parsed_sample = parsed_queue.get()
+        if parsed_sample is not None:
+            sample_collection_path, sample_id, fingerprint, combined_df_future = parsed_sample
+            try:
+                combined_df = combined_df_future.result()
+            except Exception as e:
+                print('failed to parse UProC results for sample {}'.format(sample_id))
+                print(e)
+            else:
+                if combined_df.empty:
+                    print('  no UProC results for sample {}'.format(sample_id))
+                    ledger.mark_finished([(sample_collection_path, fingerprint)])
+                else:
+                    print('  combined data for sample {} {}:\n{}'.format(
+                        sample_id, combined_df.shape, combined_df.head()))
+                    sample_batch.append((sample_id, combined_df))
+                    ledger_batch.append((sample_collection_path, fingerprint))
+
+        if len(sample_batch) > 0 and (len(sample_batch) >= db_batch_size or parsed_sample is None):
+            t00 = time.time()
+            unresolved_sample_collection_paths = set()
+            for (sample_id, combined_df), (sample_collection_path, _) in zip(sample_batch, ledger_batch):
+                unresolved_kegg_ids = uproc_results_service.insert_kegg_annotations_for_sample(
+                    annotation_results_df=combined_df[
+                        [accession.startswith('K') for accession in combined_df.index]])
+                if len(unresolved_kegg_ids) > 0:
+                    # load what is known now but load the sample again on the next run
+                    print('  sample {} has {} KEGG id(s) that are not in the KEGG annotation store'.format(
+                        sample_id, len(unresolved_kegg_ids)))
+                    unresolved_sample_collection_paths.add(sample_collection_path)
+
+            uproc_results_service.insert_uproc_results_for_samples(sample_batch)
+            ledger.mark_finished([
+                (sample_collection_path, fingerprint)
+                for sample_collection_path, fingerprint
+                in ledger_batch
+                if sample_collection_path not in unresolved_sample_collection_paths])
+
+            sample_index += len(sample_batch)
+            print('  inserted results for {} sample(s) in {:5.2f}s'.format(len(sample_batch), time.time()-t00))
+            print('* inserted {} of {} samples in {:5.2f}s'.format(sample_index, sample_count, time.time()-t0))
+            sample_batch = []
+            ledger_batch = []
+
+        if parsed_sample is None:
+            break
+
+    return sample_index
+
+
 def parse_uproc_results(data_object):
     """Parse a UProC result file to a pandas.DataFrame, which will look like this:
                     read_count
@@ -265,40 +507,51 @@ def parse_uproc_results(data_object):
         K02703         428
 
     :param data_object: IRODS data object
-    :return: pandas.DataFrame
+    :return: pandas.DataFrame, empty if the data object is empty
     """
-    with data_object.open('r+') as d:
-        try:
-            uproc_results_df = pd.read_csv(
-                filepath_or_buffer=d,
-                index_col=0,
-                header=None,
-                names=('accession', 'read_count'))
-            return uproc_results_df
-        except pd.errors.EmptyDataError:
-            print('data object "{}" is empty'.format(data_object.path))
-            return pd.DataFrame()
+    with data_object.open('r') as d:
+        return combine_uproc_results([(data_object.path, d.read())])
 
 
 class UProCResultsService:
     """
     Handle querying KEGG REST for annotations and inserting UProC results
     in iMicrobe database.
+
+    UProC results are inserted in one of two modes:
+        'bulk' - accessions are mapped to protein ids with a pandas join and
+                 rows are written with chunked Core INSERT statements
+        'orm'  - one Sample_to_protein object is added per accession
+    The 'orm' mode is kept to measure the difference.
     """
-    def __init__(self, db_uri):
+    insert_modes = ('bulk', 'orm')
+
+    def __init__(self, db_uri, insert_mode='bulk', insert_chunk_size=10000, kegg_store=None, offline=False):
         """Build a cache of KEGG annotations. Initialize it with annotations
         already in the iMicrobe database. As new annotations are downloaded and
         inserted into the iMicrobe database also add them to the cache.
+
+        New KEGG annotations are taken from kegg_store (a KeggAnnotationStore) when
+        possible. With offline=True they are taken only from kegg_store.
         """
+        if insert_mode not in self.insert_modes:
+            raise Exception('unknown insert mode "{}"'.format(insert_mode))
+
         self.db_uri = db_uri
+        self.insert_mode = insert_mode
+        self.insert_chunk_size = insert_chunk_size
+        self.kegg_store = kegg_store
+        self.offline = offline
 
         self.bad_accessions = set()
+        # KEGG ids missing from the KEGG annotation store in offline mode, KEGG may know them
+        self.unresolved_kegg_ids = set()
+        self.protein_evidence_type_ids = {}
 
-        self.annotation_db_ids = {}
+        # load only the accession and protein_id columns into a compact cache
         with session_manager_from_db_uri(db_uri=self.db_uri) as imicrobe_db_session:
-            protein_list = imicrobe_db_session.query(uproc_tables.Protein).all()
-            for protein in protein_list:
-                self.annotation_db_ids[protein.accession] = protein.protein_id
+            self.annotation_db_ids = AccessionIdCache.from_query(
+                imicrobe_db_session.query(uproc_tables.Protein.accession, uproc_tables.Protein.protein_id))
             print('found {} protein annotations in load database'.format(len(self.annotation_db_ids)))
 
 
@@ -307,32 +560,38 @@ class UProCResultsService:
         already in the database.
 
         :param annotation_results_df: pandas.DataFrame indexed by KEGG or PFAM accessions
-        :return:
+        :return: set of KEGG ids in annotation_results_df that could not be resolved in offline mode
         """
 
         with session_manager_from_db_uri(db_uri=self.db_uri) as imicrobe_db_session:
             t0 = time.time()
 
-            missing_accession_list = itertools.filterfalse(
+            missing_accession_list = list(itertools.filterfalse(
                 lambda kegg_id:
                     kegg_id in self.annotation_db_ids or kegg_id in self.bad_accessions,
-                annotation_results_df.index)
+                annotation_results_df.index))
 
-            kegg_annotations, bad_kegg_ids = get_kegg_annotations(missing_accession_list)
+            kegg_annotations, bad_kegg_ids = get_kegg_annotations(
+                missing_accession_list,
+                kegg_store=self.kegg_store,
+                offline=self.offline)
 
             if len(bad_kegg_ids) > 0:
                 print('** bad KEGG ids: {}'.format(bad_kegg_ids))
                 self.bad_accessions.update(bad_kegg_ids)
                 print('bad_accessions has {} element(s)'.format(len(self.bad_accessions)))
 
+            self.unresolved_kegg_ids.update(
+                set(missing_accession_list) - kegg_annotations.keys() - bad_kegg_ids)
+
             for accession, annotation in kegg_annotations.items():
 
                 if accession is None:
                     print('why is accession None?')
                 else:
                     description = '{}\n{}\n{}\n{}'.format(
-                        annotation['NAME'],
-                        annotation['DEFINITION'],
+                        annotation.get('NAME', ''),
+                        annotation.get('DEFINITION', ''),
                         annotation.get('PATHWAY', ''),
                         annotation.get('MODULE', ''))
                     new_protein_annotation = uproc_tables.Protein(
@@ -348,92 +607,211 @@ class UProCResultsService:
 
         print('downloaded {} annotation(s) in {:5.2f}s'.format(len(kegg_annotations), time.time()-t0))
 
+        return {kegg_id for kegg_id in annotation_results_df.index if kegg_id in self.unresolved_kegg_ids}
 
-    def insert_pfam_annotations_from_file(self, pfamA_fp):
-        with session_manager_from_db_uri(db_uri=self.db_uri) as imicrobe_db_session:
-            t0 = time.time()
 
-            debug = False
-            line_group_length = 2000
-            insert_count = 0
-            print('checking for PFam annotations missing from database')
-            with gzip.open(pfamA_fp, 'rt', encoding='latin-1', errors='replace') as pfamA_file:
-                for line_group in grouper(pfamA_file, line_group_length, fillvalue=None):
-                    line_counter = 0
-                    t00 = time.time()
-                    for line in (line_ for line_ in line_group if line_ is not None):
-                        line_counter += 1
-                        pfam_acc, pfam_identifier, pfam_aliases, pfam_name, _, _, _, _, description, *_ = line.strip().split('\t')
-
-                        if debug:
-                            print('pfam accession  : {}'.format(pfam_acc))
-                            print('pfam identifier : {}'.format(pfam_identifier))
-                            print('pfam aliases    : {}'.format(pfam_aliases))
-                            print('pfam name       : {}'.format(pfam_name))
-                            print('description     : {}'.format(description))
-
-
-                        protein_id_results = imicrobe_db_session.query(uproc_tables.Protein.protein_id).filter(
-                                uproc_tables.Protein.accession == pfam_acc).one_or_none()
-                        if protein_id_results is not None:
-                            protein_id = protein_id_results[0]
-                            # print('{} is already in the database'.format(pfam_acc))
-                        else:
-                            # insert
-                            new_protein = uproc_tables.Protein(
-                                accession=pfam_acc,
-                                description=description,
-                                protein_type_id=imicrobe_db_session.query(
-                                    uproc_tables.Protein_type.protein_type_id).filter(
-                                    uproc_tables.Protein_type.type_ == self.get_protein_type(pfam_acc)).one()[0]
-                            )
-                            imicrobe_db_session.add(new_protein)
-                            insert_count += 1
-                            imicrobe_db_session.flush()
-                            protein_id = new_protein.protein_id
-
-                        self.annotation_db_ids[pfam_acc] = protein_id
-
-                    imicrobe_db_session.commit()
-                    print('committed {} rows in {:5.1f}s ({:5.1f}s)'.format(
-                        insert_count,
-                        time.time() - t0,
-                        time.time() - t00))
-
-                print('table "{}" has {} PFAM rows'.format(
-                    uproc_tables.Protein.__tablename__,
-                    imicrobe_db_session.query(
-                        uproc_tables.Protein).join(
-                            uproc_tables.Protein_type).filter(
-                                uproc_tables.Protein_type.type_ == 'PFAM').count()))
+    def sync_pfam_catalogue(self, pfamA_fp, dead_family_fp, pfam_version_fp=None):
+        """Bring the PFAM rows of the protein table up to date with the Pfam catalogue files.
 
+        The Pfam version and the SHA-256 of each file are recorded in the protein_catalogue
+        table. If they match the last sync nothing is read. Otherwise new families are inserted,
+        families with a new description are updated, and retired families are described by their
+        cause of death, all with bulk statements in one transaction. The sync is skipped if
+        pfamA_fp or dead_family_fp does not exist.
 
-    def insert_uproc_results_for_sample(self, sample_id, uproc_results_df):
+        :param pfamA_fp: path to pfamA.txt.gz
+        :param dead_family_fp: path to dead_family.txt.gz
+        :param pfam_version_fp: path to Pfam.version.gz or None
+        :return:
         """
+        t0 = time.time()
+        missing_catalogue_fps = [fp for fp in (pfamA_fp, dead_family_fp) if not os.path.exists(fp)]
+        if len(missing_catalogue_fps) > 0:
+            print('skipping PFam catalogue sync, missing file(s): {}'.format(', '.join(missing_catalogue_fps)))
+            return
+
+        pfam_version = None
+        if pfam_version_fp is not None and os.path.exists(pfam_version_fp):
+            pfam_version = read_pfam_version(pfam_version_fp)
+        catalogue_files = {
+            os.path.basename(pfamA_fp): file_sha256(pfamA_fp),
+            os.path.basename(dead_family_fp): file_sha256(dead_family_fp)}
+
+        with session_manager_from_db_uri(db_uri=self.db_uri) as imicrobe_db_session:
+            loaded_catalogue_files = {
+                file_name: sha256
+                for file_name, sha256
+                in imicrobe_db_session.query(
+                    uproc_tables.Protein_catalogue.file_name,
+                    uproc_tables.Protein_catalogue.sha256).filter(
+                        uproc_tables.Protein_catalogue.file_name.in_(list(catalogue_files))).all()}
+            if loaded_catalogue_files == catalogue_files:
+                print('PFam catalogue (release {}) is unchanged since the last load'.format(pfam_version))
+                return
+
+            print('syncing PFam catalogue (release {})'.format(pfam_version))
+            pfam_protein_type_id = imicrobe_db_session.query(
+                uproc_tables.Protein_type.protein_type_id).filter(
+                    uproc_tables.Protein_type.type_ == 'PFAM').one()[0]
+
+            existing_df = pd.DataFrame(
+                imicrobe_db_session.query(
+                    uproc_tables.Protein.protein_id,
+                    uproc_tables.Protein.accession,
+                    uproc_tables.Protein.description).filter(
+                        uproc_tables.Protein.protein_type_id == pfam_protein_type_id).all(),
+                columns=['protein_id', 'accession', 'description'])
+
+            new_df, changed_df = diff_pfam_catalogue(
+                existing_df=existing_df,
+                pfamA_df=read_pfamA_table(pfamA_fp),
+                dead_family_df=read_dead_family_table(dead_family_fp))
+
+            new_protein_rows = [
+                {'accession': accession, 'description': description, 'protein_type_id': pfam_protein_type_id}
+                for accession, description
+                in zip(new_df.accession, new_df.description)]
+            protein_insert = uproc_tables.Protein.__table__.insert()
+            for i in range(0, len(new_protein_rows), self.insert_chunk_size):
+                imicrobe_db_session.execute(protein_insert, new_protein_rows[i:i+self.insert_chunk_size])
+
+            changed_protein_rows = [
+                {'b_accession': accession, 'b_description': description}
+                for accession, description
+                in zip(changed_df.accession, changed_df.description)]
+            protein_table = uproc_tables.Protein.__table__
+            protein_update = protein_table.update().where(
+                protein_table.c.accession == sqlalchemy.bindparam('b_accession')).values(
+                    description=sqlalchemy.bindparam('b_description'))
+            for i in range(0, len(changed_protein_rows), self.insert_chunk_size):
+                imicrobe_db_session.execute(protein_update, changed_protein_rows[i:i+self.insert_chunk_size])
+
+            catalogue_table = uproc_tables.Protein_catalogue.__table__
+            imicrobe_db_session.execute(
+                catalogue_table.delete().where(catalogue_table.c.file_name.in_(list(catalogue_files))))
+            imicrobe_db_session.execute(
+                catalogue_table.insert(),
+                [
+                    {'file_name': file_name, 'version': pfam_version, 'sha256': sha256}
+                    for file_name, sha256
+                    in catalogue_files.items()])
+
+            if len(new_protein_rows) > 0:
+                self.annotation_db_ids.update(
+                    self.get_protein_ids_for_protein_type(imicrobe_db_session, pfam_protein_type_id))
+
+        print('synced PFam catalogue: {} new, {} changed families in {:5.2f}s'.format(
+            len(new_protein_rows), len(changed_protein_rows), time.time()-t0))
+
+
+    def get_protein_ids_for_protein_type(self, imicrobe_db_session, protein_type_id):
+        """Return a dictionary of accession to protein_id for one protein type."""
+        return dict(
+            imicrobe_db_session.query(
+                uproc_tables.Protein.accession,
+                uproc_tables.Protein.protein_id).filter(
+                    uproc_tables.Protein.protein_type_id == protein_type_id).all())
+
+
+    def insert_uproc_results_for_sample(self, sample_id, uproc_results_df):
+        """Insert UProC results for one sample using the service's insert mode.
 
         :param sample_id:
-        :param uproc_results_df:
+        :param uproc_results_df: pandas.DataFrame indexed by accession with column read_count
+        :return:
+        """
+        self.insert_uproc_results_for_samples([(sample_id, uproc_results_df)])
+
+
+    def insert_uproc_results_for_samples(self, sample_results):
+        """Insert UProC results for several samples in one transaction. Results already
+        in the database for these samples, for example from an interrupted load, are replaced.
+
+        :param sample_results: list of (sample_id, pandas.DataFrame indexed by accession with column read_count)
         :return:
         """
-        print('inserting UProC results for sample_id {}'.format(sample_id))
         with session_manager_from_db_uri(db_uri=self.db_uri) as imicrobe_db_session:
-            for accession, uproc_result_row in uproc_results_df.iterrows():
-                # is the protein annotation already in table protein?
-                #print('r: "{}" uproc_result_row:\n{}'.format(accession, uproc_result_row))
-                if accession in self.annotation_db_ids:
-                    protein_id = self.annotation_db_ids[accession]
-                    #print('found accession "{}" in cache'.format(accession))
-                    sample_to_protein = uproc_tables.Sample_to_protein(
-                        protein_id=protein_id,
-                        sample_id=sample_id,
-                        protein_evidence_type_id=imicrobe_db_session.query(
-                            uproc_tables.Protein_evidence_type.protein_evidence_type_id).filter(
-                                uproc_tables.Protein_evidence_type.type_ == 'UProC').one()[0],
-                        read_count=str(uproc_result_row.read_count))
-                    imicrobe_db_session.add(sample_to_protein)
+            self.delete_uproc_results_for_samples(
+                imicrobe_db_session, [sample_id for sample_id, _ in sample_results])
+            for sample_id, uproc_results_df in sample_results:
+                print('inserting UProC results for sample_id {} ({} mode)'.format(sample_id, self.insert_mode))
+                if self.insert_mode == 'bulk':
+                    self.bulk_insert_uproc_results_for_sample(imicrobe_db_session, sample_id, uproc_results_df)
                 else:
-                    #print('annotation for "{}" is missing from cache'.format(accession))
-                    self.bad_accessions.add(accession)
+                    self.orm_insert_uproc_results_for_sample(imicrobe_db_session, sample_id, uproc_results_df)
+
+
+    def bulk_insert_uproc_results_for_sample(self, imicrobe_db_session, sample_id, uproc_results_df):
+        """Map accessions to protein ids with one vectorized lookup in the annotation cache
+        and insert all rows for the sample with chunked executemany INSERTs.
+
+        :param imicrobe_db_session:
+        :param sample_id:
+        :param uproc_results_df: pandas.DataFrame indexed by accession with column read_count
+        :return:
+        """
+        if uproc_results_df.empty:
+            return
+
+        protein_ids = self.annotation_db_ids.lookup(uproc_results_df.index)
+        missing_protein_id = protein_ids < 0
+        self.bad_accessions.update(uproc_results_df.index[missing_protein_id])
+
+        protein_evidence_type_id = self.get_protein_evidence_type_id(imicrobe_db_session, 'UProC')
+        sample_to_protein_rows = pd.DataFrame({
+            'sample_id': sample_id,
+            'protein_id': protein_ids[~missing_protein_id],
+            'protein_evidence_type_id': protein_evidence_type_id,
+            'read_count': uproc_results_df.read_count.values[~missing_protein_id].astype('int64')}).to_dict('records')
+
+        sample_to_protein_insert = uproc_tables.Sample_to_protein.__table__.insert()
+        for i in range(0, len(sample_to_protein_rows), self.insert_chunk_size):
+            imicrobe_db_session.execute(
+                sample_to_protein_insert,
+                sample_to_protein_rows[i:i+self.insert_chunk_size])
+
+
+    def orm_insert_uproc_results_for_sample(self, imicrobe_db_session, sample_id, uproc_results_df):
+        """Insert one Sample_to_protein ORM object per accession.
+
+        :param imicrobe_db_session:
+        :param sample_id:
+        :param uproc_results_df: pandas.DataFrame indexed by accession with column read_count
+        :return:
+        """
+        for accession, uproc_result_row in uproc_results_df.iterrows():
+            # is the protein annotation already in table protein?
+            #print('r: "{}" uproc_result_row:\n{}'.format(accession, uproc_result_row))
+            if accession in self.annotation_db_ids:
+                protein_id = self.annotation_db_ids[accession]
+                #print('found accession "{}" in cache'.format(accession))
+                sample_to_protein = uproc_tables.Sample_to_protein(
+                    protein_id=protein_id,
+                    sample_id=sample_id,
+                    protein_evidence_type_id=imicrobe_db_session.query(
+                        uproc_tables.Protein_evidence_type.protein_evidence_type_id).filter(
+                            uproc_tables.Protein_evidence_type.type_ == 'UProC').one()[0],
+                    read_count=str(uproc_result_row.read_count))
+                imicrobe_db_session.add(sample_to_protein)
+            else:
+                #print('annotation for "{}" is missing from cache'.format(accession))
+                self.bad_accessions.add(accession)
+
+
+    def get_protein_evidence_type_id(self, imicrobe_db_session, protein_evidence_type):
+        """Look up a protein_evidence_type_id once and remember it."""
+        if protein_evidence_type not in self.protein_evidence_type_ids:
+            self.protein_evidence_type_ids[protein_evidence_type] = imicrobe_db_session.query(
+                uproc_tables.Protein_evidence_type.protein_evidence_type_id).filter(
+                    uproc_tables.Protein_evidence_type.type_ == protein_evidence_type).one()[0]
+        return self.protein_evidence_type_ids[protein_evidence_type]
+
+
+    def delete_uproc_results_for_samples(self, imicrobe_db_session, sample_ids):
+        deleted_count = imicrobe_db_session.query(uproc_tables.Sample_to_protein).filter(
+            uproc_tables.Sample_to_protein.sample_id.in_(sample_ids)).delete(synchronize_session=False)
+        if deleted_count > 0:
+            print('deleted {} previously loaded sample_to_protein row(s)'.format(deleted_count))
 
 
     def count_uproc_results_for_sample(self, sample_id):
@@ -0,0 +1,103 @@
+"""
+Read UProC results files.
+
+UProC writes one 'accession,read_count' line per accession, for example
+
+    K00525,1793
+    K06237,701
+
+to files named like SRR000001.uproc.kegg or SRR000001.uproc.pfam28, optionally
+gzipped. These functions parse the bytes of such files directly into NumPy
+arrays and sum the read counts for all files of one sample without going
+through pandas.read_csv and DataFrame.add, so read counts stay int64.
+"""
+import gzip
+import re
+
+import numpy as np
+import pandas as pd
+
+
+uproc_results_file_name_re = re.compile(r'\.uproc\.(kegg|pfam\d+)(\.gz)?$')
+uproc_kegg_results_file_name_re = re.compile(r'\.uproc\.kegg(\.gz)?$')
+
+gzip_magic_bytes = b'\x1f\x8b'
+
+
+def parse_uproc_results_bytes(uproc_results, uproc_results_path):
+    """Parse the contents of a UProC results file.
+
+    :param uproc_results: file contents as bytes, gzipped or not
+    :param uproc_results_path: used in messages
+    :return: (numpy bytes array of accessions, numpy int64 array of read counts)
+    """
+    if uproc_results.startswith(gzip_magic_bytes):
+        uproc_results = gzip.decompress(uproc_results)
+
+    fields = uproc_results.replace(b',', b' ').split()
+    if len(fields) % 2 != 0 or uproc_results.count(b',') != len(fields) // 2:
+        raise Exception('failed to parse UProC results "{}": expected "accession,read_count" lines'.format(
+            uproc_results_path))
+
+    try:
+        accessions = np.array(fields[0::2], dtype=np.bytes_)
+        read_counts = np.array(fields[1::2], dtype=np.bytes_).astype(np.int64)
+    except ValueError as e:
+        raise Exception('failed to parse UProC results "{}": {}'.format(uproc_results_path, e))
+
+    return accessions, read_counts
+
+
+def sum_read_counts(accessions, read_counts):
+    """Sum read counts by accession.
+
+    :param accessions: numpy bytes array, accessions may repeat
+    :param read_counts: numpy int64 array
+    :return: (numpy bytes array of unique sorted accessions, numpy int64 array of summed read counts)
+    """
+    if len(accessions) == 0:
+        return accessions, read_counts
+
+    order = np.argsort(accessions, kind='stable')
+    sorted_accessions = accessions[order]
+    group_starts = np.concatenate((
+        [0],
+        np.flatnonzero(sorted_accessions[1:] != sorted_accessions[:-1]) + 1))
+
+    return sorted_accessions[group_starts], np.add.reduceat(read_counts[order], group_starts)
+
+
+def uproc_results_to_df(accessions, read_counts):
+    """Return a pandas.DataFrame indexed by accession (str) with int64 column read_count
+    sorted by descending read_count.
+    """
+    uproc_results_df = pd.DataFrame(
+        {'read_count': read_counts.astype(np.int64)},
+        index=pd.Index(accessions.astype(str), name='accession'))
+    uproc_results_df.sort_values(by='read_count', inplace=True, ascending=False, kind='stable')
+    return uproc_results_df
+
+
+def combine_uproc_results(sample_uproc_results):
+    """Parse and sum the UProC results for one sample. Runs in a worker process.
+
+    :param sample_uproc_results: list of (data object path, UProC results file contents as bytes)
+    :return: pandas.DataFrame indexed by accession sorted by descending read_count,
+        empty if all files are empty
+    """
+    accessions_list = []
+    read_counts_list = []
+    for uproc_results_path, uproc_results in sample_uproc_results:
+        accessions, read_counts = parse_uproc_results_bytes(uproc_results, uproc_results_path)
+        if len(accessions) == 0:
+            print('data object "{}" is empty'.format(uproc_results_path))
+        else:
+            accessions_list.append(accessions)
+            read_counts_list.append(read_counts)
+
+    if len(accessions_list) == 0:
+        return pd.DataFrame()
+    else:
+        return uproc_results_to_df(*sum_read_counts(
+            np.concatenate(accessions_list),
+            np.concatenate(read_counts_list)))
@@ -86,6 +86,33 @@ class Protein(models.Model):
     protein_type = orm.relationship('Protein_type')
 
 
+"""
+-- the version and SHA-256 of the catalogue files last loaded into table protein
+create table protein_catalogue (
+    protein_catalogue_id int unsigned not null auto_increment primary key,
+    file_name varchar(100) not null,
+    version varchar(100),
+    sha256 char(64) not null,
+    unique (file_name)
+) ENGINE=InnoDB DEFAULT CHARSET='utf8';
+"""
+class Protein_catalogue(models.Model):
+    __tablename__ = 'protein_catalogue'
+    __table_args__ = {
+        'mysql_engine': 'InnoDB',
+        'mysql_charset': 'utf8'}
+
+    protein_catalogue_id = sa.Column(
+        'protein_catalogue_id',
+        mysql.INTEGER(unsigned=True),
+        nullable=False,
+        primary_key=True)
+
+    file_name = sa.Column('file_name', sa.VARCHAR(100), nullable=False, unique=True)
+    version = sa.Column('version', sa.VARCHAR(100))
+    sha256 = sa.Column('sha256', sa.CHAR(64), nullable=False)
+
+
 """
 -- the relationship
 create table sample_to_protein (
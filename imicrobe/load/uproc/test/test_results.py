@@ -0,0 +1,33 @@
+import gzip
+
+import pytest
+
+from imicrobe.load.uproc.results import combine_uproc_results, uproc_results_file_name_re
+
+
+def test_uproc_results_file_name_re():
+    assert uproc_results_file_name_re.search('SRR000001.uproc.kegg')
+    assert uproc_results_file_name_re.search('SRR000001.uproc.pfam28')
+    assert uproc_results_file_name_re.search('SRR000001.uproc.pfam28.gz')
+    assert uproc_results_file_name_re.search('SRR000001.fasta') is None
+
+
+def test_combine_uproc_results():
+    combined_df = combine_uproc_results([
+        ('a.uproc.kegg', b'K00525,1793\nK06237,701\n'),
+        ('a.uproc.pfam28', gzip.compress(b'PF00001,5\n')),
+        ('b.uproc.kegg', b'K06237,300\n'),
+        ('c.uproc.kegg', b'')])
+
+    assert combined_df.read_count.dtype == 'int64'
+    assert combined_df.index.tolist() == ['K00525', 'K06237', 'PF00001']
+    assert combined_df.read_count.tolist() == [1793, 1001, 5]
+
+
+def test_combine_empty_uproc_results():
+    assert combine_uproc_results([('c.uproc.kegg', b'')]).empty
+
+
+def test_combine_bad_uproc_results():
+    with pytest.raises(Exception):
+        combine_uproc_results([('a.uproc.kegg', b'K00525 1793\n')])
@@ -5,28 +5,41 @@ Run with --create-kegg-table to create the KEGG table
 
 Run with --results-root-dp to write a job file for GNU Parallel.
 
+Run with --results-root-dp and --parallel N to load every file of UProC results
+in the directory tree with N worker processes instead of GNU Parallel. Each worker
+connects to the database and reads the KEGG annotation ids one time.
+
 Run with --uproc-kegg-results-fp to load one file of UProC results in to the iMicrobe database.
 
+Results can be loaded again without duplicating rows (see --on-duplicate) only if the
+uproc_kegg_result table has a unique key on (sample_file_id, kegg_annotation_id). The
+Uproc_kegg_result model does not define one, so loading stops if the key is missing.
+Run with --add-unique-key to add it, which is the same as
+    CREATE UNIQUE INDEX uq_uproc_kegg_result_sample_file_kegg_annotation
+        ON uproc_kegg_result (sample_file_id, kegg_annotation_id)
 
 """
 import argparse
-from collections import defaultdict
+import concurrent.futures
 from contextlib import contextmanager
-import io
 import itertools
 import os
-import re
 import sys
+import tempfile
 import time
 
 import requests
 
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.orm import sessionmaker
 
+from imicrobe.load.uproc.results import parse_uproc_results_bytes, uproc_kegg_results_file_name_re
+from imicrobe.load.uproc_results.kegg.sample_file_index import get_sample_file_index, get_sample_file_key, \
+    get_sample_file_keys
+from imicrobe.load.uproc_results.results_buffer import scan_uproc_results_tree, scandir_files
 from imicrobe.uproc_results.kegg.models import Kegg_annotation, Uproc_kegg_result
-
-from imicrobe_model import models
+from imicrobe.util.kegg import parse_kegg_orthology
 
 
 def get_args():
@@ -47,12 +60,23 @@ def get_args():
                            default=False,
                            help='create the KEGG tables')
 
+    argparser.add_argument('--add-unique-key',
+                           action='store_true',
+                           default=False,
+                           help='add a unique key on (sample_file_id, kegg_annotation_id) to the UProC KEGG result table')
+
     argparser.add_argument('--list', action='store_true', default=False,
                            help='list row of uproc_kegg_result table')
 
     argparser.add_argument('--results-root-dp',
                            help='path to root of results directory tree')
 
+    argparser.add_argument('--parallel',
+                           default=None,
+                           type=int,
+                           help='with --results-root-dp load files with this many processes '
+                                'instead of writing a job file')
+
     argparser.add_argument('--load-results-root-dp',
                            help='path to root of results directory tree')
 
@@ -61,6 +85,30 @@ def get_args():
                            type=int,
                            help='number of lines to print in job file')
 
+    argparser.add_argument('--scan-workers',
+                           default=4,
+                           type=int,
+                           help='number of processes parsing results files')
+
+    argparser.add_argument('--spill-dp',
+                           default=tempfile.gettempdir(),
+                           help='directory for parsed results that do not fit in memory')
+
+    argparser.add_argument('--spill-size-mb',
+                           default=1024,
+                           type=int,
+                           help='MB of parsed results held in memory before spilling to --spill-dp')
+
+    argparser.add_argument('--insert-batch-size',
+                           default=50000,
+                           type=int,
+                           help='number of UProC KEGG result rows inserted per transaction')
+
+    argparser.add_argument('--on-duplicate',
+                           choices=('update', 'ignore'),
+                           default='update',
+                           help='replace (update) or keep (ignore) the read count of rows that are already loaded')
+
     argparser.add_argument('--uproc-results-fp', help='path to one file of UProC results')
     argparser.parse_args()
 
@@ -91,8 +139,16 @@ def main():
     elif args.create_tables:
         create_table('kegg_annotation', meta, imicrobe_engine)
         create_table('uproc_kegg_result', meta, imicrobe_engine)
+    elif args.add_unique_key:
+        add_uproc_kegg_result_unique_key(imicrobe_engine)
     elif args.list:
         list_uproc_kegg_result_rows(Session_class, imicrobe_engine)
+    elif args.results_root_dp and args.parallel:
+        load_uproc_kegg_results_files_in_parallel(
+            dir_root=args.results_root_dp,
+            db_uri=db_uri,
+            parallel=args.parallel,
+            on_duplicate=args.on_duplicate)
     elif args.results_root_dp:
         ##drop_table(SampleToUpro, engine=imicrobe_engine)
         ##SampleToUproc.__table__.create(imicrobe_engine)
@@ -103,12 +159,19 @@ def main():
             dir_root=args.load_results_root_dp,
             session_class=Session_class,
             engine=imicrobe_engine,
-            line_limit=args.line_limit)
+            line_limit=args.line_limit,
+            scan_workers=args.scan_workers,
+            spill_dp=args.spill_dp,
+            spill_size=args.spill_size_mb * 1024 * 1024,
+            insert_batch_size=args.insert_batch_size,
+            on_duplicate=args.on_duplicate)
     elif args.uproc_results_fp:
-        load_sample_to_uproc_table_from_file(
-            uproc_results_fp=args.uproc_results_fp,
+        check_uproc_kegg_result_unique_key(imicrobe_engine)
+        load_uproc_kegg_results_from_file(
+            uproc_kegg_results_fp=args.uproc_results_fp,
             session_class=Session_class,
-            engine=imicrobe_engine)
+            engine=imicrobe_engine,
+            on_duplicate=args.on_duplicate)
     else:
         print('specify either --results-root-dp or --uproc-results-fp')
 
@@ -179,7 +242,7 @@ def write_command_file_from_directory_tree(dir_root):
     file_count = 0
     for root, dirs, files in os.walk(dir_root):
         for file in files:
-            if file.endswith('.uproc.kegg'):
+            if uproc_kegg_results_file_name_re.search(file):
                 file_count += 1
 
                 uproc_results_fp = os.path.join(root, file)
@@ -190,37 +253,169 @@ def write_command_file_from_directory_tree(dir_root):
     sys.stderr.write('wrote {} lines in {:5.1f}s\n'.format(file_count, time.time()-start_time))
 
 
-def load_all_samples_to_uproc_kegg_table_from_directory_tree(dir_root, session_class, engine, line_limit):
-    #from loaders.uproc_results.kegg.models import Kegg_annotation, Uproc_kegg_result
+uproc_kegg_result_unique_key_columns = ('sample_file_id', 'kegg_annotation_id')
+uproc_kegg_result_unique_key_name = 'uq_uproc_kegg_result_sample_file_kegg_annotation'
 
-    # load the kegg_annotations table first
-    start_time = time.time()
+
+def has_uproc_kegg_result_unique_key(engine):
+    """Return True if the uproc_kegg_result table has a primary key, unique constraint, or unique index
+    on exactly (sample_file_id, kegg_annotation_id).
+    """
+    inspector = sa.inspect(engine)
+    table_name = Uproc_kegg_result.__tablename__
+    unique_column_sets = [set(inspector.get_pk_constraint(table_name)['constrained_columns'])]
+    unique_column_sets.extend([set(u['column_names']) for u in inspector.get_unique_constraints(table_name)])
+    unique_column_sets.extend([set(i['column_names']) for i in inspector.get_indexes(table_name) if i['unique']])
+    return set(uproc_kegg_result_unique_key_columns) in unique_column_sets
+
+
+def check_uproc_kegg_result_unique_key(engine):
+    """Raise an exception if the uproc_kegg_result table has no unique key on (sample_file_id, kegg_annotation_id).
+    Without it the inserts from get_uproc_kegg_result_insert add a second row for results that are already loaded.
+    """
+    if not has_uproc_kegg_result_unique_key(engine):
+        raise Exception(
+            'table "{}" has no unique key on ({}) so loading results again would duplicate rows, '
+            'run with --add-unique-key to add it'.format(
+                Uproc_kegg_result.__tablename__, ', '.join(uproc_kegg_result_unique_key_columns)))
+
+
+def add_uproc_kegg_result_unique_key(engine):
+    """Add a unique index on (sample_file_id, kegg_annotation_id) to the uproc_kegg_result table.
+    This fails if the table already has duplicate rows.
+    """
+    if has_uproc_kegg_result_unique_key(engine):
+        print('table "{}" already has a unique key on ({})'.format(
+            Uproc_kegg_result.__tablename__, ', '.join(uproc_kegg_result_unique_key_columns)))
+    else:
+        # reflect the table so the index is not added to the Uproc_kegg_result model
+        uproc_kegg_result_table = sa.Table(Uproc_kegg_result.__tablename__, sa.MetaData(), autoload_with=engine)
+        sa.Index(
+            uproc_kegg_result_unique_key_name,
+            *[uproc_kegg_result_table.c[c] for c in uproc_kegg_result_unique_key_columns],
+            unique=True).create(engine)
+        print('added unique key "{}" to table "{}"'.format(
+            uproc_kegg_result_unique_key_name, Uproc_kegg_result.__tablename__))
+
+
+def get_uproc_kegg_result_insert(engine, on_duplicate):
+    """Return an INSERT statement for the uproc_kegg_result table that does not fail on rows
+    that are already loaded, so a directory tree can be loaded again. This depends on the
+    unique key checked by check_uproc_kegg_result_unique_key.
+
+    :param on_duplicate: 'update' to replace the read_count of an existing row, 'ignore' to keep it
+    """
+    uproc_kegg_result_table = Uproc_kegg_result.__table__
+    if engine.dialect.name == 'mysql':
+        if on_duplicate == 'update':
+            uproc_kegg_result_insert = mysql.insert(uproc_kegg_result_table)
+            return uproc_kegg_result_insert.on_duplicate_key_update(
+                read_count=uproc_kegg_result_insert.inserted.read_count)
+        else:
+            return uproc_kegg_result_table.insert().prefix_with('IGNORE')
+    elif engine.dialect.name == 'sqlite':
+        # INSERT OR REPLACE would delete and insert the row, changing its uproc_kegg_result_id
+        uproc_kegg_result_insert = sqlite.insert(uproc_kegg_result_table)
+        if on_duplicate == 'update':
+            return uproc_kegg_result_insert.on_conflict_do_update(
+                index_elements=list(uproc_kegg_result_unique_key_columns),
+                set_={'read_count': uproc_kegg_result_insert.excluded.read_count})
+        else:
+            return uproc_kegg_result_insert.on_conflict_do_nothing(
+                index_elements=list(uproc_kegg_result_unique_key_columns))
+    else:
+        raise Exception('on_duplicate is not supported for database "{}"'.format(engine.dialect.name))
+
+
+def insert_uproc_kegg_results(engine, file_rows, on_duplicate='update', batch_size=50000):
+    """Insert rows into the uproc_kegg_result table in transactions of about batch_size rows.
+    The rows of one file are never split between transactions. If a transaction fails
+    each file in it is inserted in its own transaction so only the bad files are skipped.
+
+    :param file_rows: iterable of (results file path, list of row dictionaries)
+    :return: (number of rows inserted, list of results file paths that failed)
+    """
     t0 = time.time()
-    file_count = 0
-    kegg_ids = set()
-    for root, dirs, files in os.walk(dir_root):
-        for file_name in files:
-            if file_name.endswith('.uproc.kegg'):
-                file_count += 1
-                uproc_kegg_results_fp = os.path.join(root, file_name)
-                with open(uproc_kegg_results_fp, 'rt') as uproc_kegg_results_file:
+    uproc_kegg_result_insert = get_uproc_kegg_result_insert(engine, on_duplicate)
+    inserted_row_count = 0
+    failed_results_fps = []
+
+    def insert_batch(batch):
+        t00 = time.time()
+        batch_row_count = sum([len(rows) for _, rows in batch])
+        try:
+            with engine.begin() as connection:
+                connection.execute(uproc_kegg_result_insert, [row for _, rows in batch for row in rows])
+            print('inserted {} rows from {} file(s) in {:5.1f}s ({:.0f} rows/s)'.format(
+                batch_row_count, len(batch), time.time()-t00, batch_row_count / max(time.time()-t00, 1e-9)))
+            return batch_row_count
+        except Exception as e:
+            print(e)
+            print('failed to insert {} rows from {} file(s), inserting one file at a time'.format(
+                batch_row_count, len(batch)))
+
+        file_row_count = 0
+        for results_fp, rows in batch:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(uproc_kegg_result_insert, rows)
+                file_row_count += len(rows)
+            except Exception as e:
+                # database integrity errors land here
+                print(e)
+                print('failed to insert data from file "{}"'.format(results_fp))
+                failed_results_fps.append(results_fp)
+        return file_row_count
+
+    batch = []
+    batch_row_count = 0
+    for results_fp, rows in file_rows:
+        if len(rows) == 0:
+            continue
+        elif len(batch) > 0 and batch_row_count + len(rows) > batch_size:
+            inserted_row_count += insert_batch(batch)
+            batch = []
+            batch_row_count = 0
+        batch.append((results_fp, rows))
+        batch_row_count += len(rows)
+
+    if len(batch) > 0:
+        inserted_row_count += insert_batch(batch)
+
+    print('inserted {} UProC KEGG results in {:5.1f}s ({:.0f} rows/s)\n'.format(
+        inserted_row_count, time.time()-t0, inserted_row_count / max(time.time()-t0, 1e-9)))
+
+    return inserted_row_count, failed_results_fps
+
+
+def load_all_samples_to_uproc_kegg_table_from_directory_tree(
+        dir_root, session_class, engine, line_limit, scan_workers=4, spill_dp=None, spill_size=1024 * 1024 * 1024,
+        insert_batch_size=50000, on_duplicate='update'):
+    #from loaders.uproc_results.kegg.models import Kegg_annotation, Uproc_kegg_result
 
-                    # UProC results files look like this:
-                    #   K01467,4208
-                    #   K01990,660
-                    #   K07481,434
-                    #   ... and so on ...
-                    t00 = time.time()
-                    file_line_count = 0
-                    for line in take(line_limit, uproc_kegg_results_file):
-                        kegg_id, read_count = line.strip().split(',')
-                        file_line_count += 1
+    check_uproc_kegg_result_unique_key(engine)
 
-                        kegg_ids.add(kegg_id)
+    # read every results file one time, both the KEGG ids and the results rows come from this buffer
+    start_time = time.time()
+    uproc_kegg_results_buffer = scan_uproc_results_tree(
+        dir_root=dir_root,
+        name_re=uproc_kegg_results_file_name_re,
+        line_limit=line_limit,
+        workers=scan_workers,
+        spill_dp=spill_dp,
+        spill_size=spill_size)
+    try:
+        load_uproc_kegg_results_buffer(
+            uproc_kegg_results_buffer, session_class, engine, start_time,
+            insert_batch_size=insert_batch_size, on_duplicate=on_duplicate)
+    finally:
+        uproc_kegg_results_buffer.close()
 
-                    print('{:<10.1f}s: parsed {} line(s) of file {}: "{}" in {:5.1f}s'.format(
-                        time.time()-t0, file_line_count, file_count, file_name, time.time()-t00))
 
+def load_uproc_kegg_results_buffer(
+        uproc_kegg_results_buffer, session_class, engine, start_time, insert_batch_size=50000, on_duplicate='update'):
+    # load the kegg_annotations table first
+    kegg_ids = set(uproc_kegg_results_buffer.accessions)
     print('found {} KEGG ids'.format(len(kegg_ids)))
     print(sorted(kegg_ids)[:10])
 
@@ -251,9 +446,10 @@ def load_all_samples_to_uproc_kegg_table_from_directory_tree(dir_root, session_c
 
             kegg_id_group = [k for k in kegg_id_group_ if k is not None]
             ko_id_list = '+'.join(['ko:{}'.format(k) for k in kegg_id_group])
-            kegg_annotation_response = requests.get('http://rest.kegg.jp/get/{}'.format(ko_id_list))
+            kegg_annotation_response = requests.get('http://rest.kegg.jp/get/{}'.format(ko_id_list), stream=True)
             if kegg_annotation_response.status_code == 200:
-                ko_annotations = parse_kegg_response(kegg_annotation_response.text)
+                kegg_annotation_response.encoding = kegg_annotation_response.encoding or 'utf-8'
+                ko_annotations = parse_kegg_orthology(kegg_annotation_response.iter_lines(decode_unicode=True))
                 # it can happen that some ko_ids are not found
                 # in these cases there is no entry for the ko_id
                 for kegg_id in sorted(kegg_id_group):
@@ -262,8 +458,8 @@ def load_all_samples_to_uproc_kegg_table_from_directory_tree(dir_root, session_c
                         session.add(
                             Kegg_annotation(
                                 kegg_annotation_id=kegg_id,
-                                name=ko_annotations[kegg_id]['NAME'],
-                                definition=ko_annotations[kegg_id]['DEFINITION'],
+                                name=ko_annotations[kegg_id].get('NAME', ''),
+                                definition=ko_annotations[kegg_id].get('DEFINITION', ''),
                                 pathway=ko_annotations[kegg_id].get('PATHWAY', ''),
                                 module=ko_annotations[kegg_id].get('MODULE', '')))
                         if len(downloaded_kegg_annotations) % 100 == 0:
@@ -287,150 +483,166 @@ def load_all_samples_to_uproc_kegg_table_from_directory_tree(dir_root, session_c
     print('downloaded and inserted {} KEGG annotations in {:5.1f}s\n'.format(
         len(downloaded_kegg_annotations), time.time()-start_time))
 
-    t0 = time.time()
-    uproc_kegg_results_files = []
+    # look up the sample_file_id of every results file before loading any results
+    results_fp_to_sample_file_key, unresolved_results_fps = get_sample_file_keys(uproc_kegg_results_buffer.file_paths)
+
+    sample_file_index = get_sample_file_index(
+        engine=engine,
+        sample_ids={sample_id for sample_id, _ in results_fp_to_sample_file_key.values()})
+
+    def iter_uproc_kegg_result_rows():
+        for uproc_kegg_results_fp, file_kegg_ids, file_read_counts in uproc_kegg_results_buffer.iter_files():
+            if uproc_kegg_results_fp not in results_fp_to_sample_file_key:
+                continue
+            sample_file_key = results_fp_to_sample_file_key[uproc_kegg_results_fp]
+            sample_id, _ = sample_file_key
+            sample_file_id = sample_file_index.get(sample_file_key)
+            if sample_file_id is None:
+                unresolved_results_fps.append(uproc_kegg_results_fp)
+                continue
+
+            rows = []
+            for kegg_id, read_count in zip(file_kegg_ids, file_read_counts.tolist()):
+                if kegg_id in download_failed_kegg_ids:
+                    pass
+                elif kegg_id in downloaded_kegg_annotations:
+                    rows.append({
+                        'sample_id': sample_id,
+                        'sample_file_id': sample_file_id,
+                        'kegg_annotation_id': kegg_id,
+                        'read_count': read_count})
+                else:
+                    print('what happened? "{}"'.format(kegg_id))
+
+            yield uproc_kegg_results_fp, rows
+
     # load the uproc_kegg_results table last
-    for root, dirs, files in os.walk(dir_root):
-        for file_name in files:
-            if file_name.endswith('.uproc.kegg'):
-                file_count += 1
-                uproc_kegg_results_fp = os.path.join(root, file_name)
-                # uproc_kegg_results_fp looks like
-                #   /home/u26/jklynch/usr/local/imicrobe/data/uproc/projects/148/samples/3486/ERR906934.fasta.uproc.kegg
-                # get the sample id from the last directory name
-
-                d, sample_id = os.path.split(root)
-                sample_id = int(sample_id)
-                _, project_id = os.path.split(os.path.dirname(d))
-                project_id = int(project_id)
-
-                # get the sample files associated with the sample
-                sample_file = session.query(
-                    models.Sample_file).filter(
-                        models.Sample_file.sample_id == sample_id,
-                        models.Sample_file.file == '/iplant/home/shared/load/projects/{}/samples/{}/{}'.format(
-                            project_id, sample_id, file_name)).one()
-
-                print(sample_file)
-
-                t00 = time.time()
-                file_results_count = 0
-                try:
-                    with open(uproc_kegg_results_fp, 'rt') as uproc_kegg_results_file, session_(session_class) as session:
-
-                        # UProC results files look like this:
-                        #   K01467,4208
-                        #   K01990,660
-                        #   K07481,434
-                        #   ... and so on ...
-                        for line in take(line_limit, uproc_kegg_results_file):
-                            kegg_id, read_count = line.strip().split(',')
-                            if kegg_id in download_failed_kegg_ids:
-                                pass
-                            elif kegg_id in downloaded_kegg_annotations:
-                                session.add(
-                                    Uproc_kegg_result(
-                                        sample_id=sample_id,
-                                        sample_file_id=sample_file.sample_file_id,
-                                        kegg_annotation_id=kegg_id,
-                                        read_count=int(read_count)))
-                                file_results_count += 1
-                            else:
-                                print('what happened? "{}"'.format(kegg_id))
-
-                        uproc_kegg_results_files.append(file_name)
-
-                    print('finished parsing file {}: "{}" with {} results in {:5.1f}s'.format(
-                        len(uproc_kegg_results_files), uproc_kegg_results_fp, file_results_count, time.time()-t00))
-
-                except Exception as e:
-                    # database integrity errors land here
-                    print(e)
-                    print('failed to insert data from file "{}"'.format(uproc_kegg_results_fp))
-
-    print('inserted {} UProC KEGG results in {:5.1f}s\n'.format(
-        len(downloaded_kegg_annotations), time.time()-t0))
+    _, failed_results_fps = insert_uproc_kegg_results(
+        engine,
+        iter_uproc_kegg_result_rows(),
+        on_duplicate=on_duplicate,
+        batch_size=insert_batch_size)
 
     print('failed to download {} annotation(s):\n\t{}'.format(
         len(download_failed_kegg_ids), '\n\t'.join(download_failed_kegg_ids)))
 
+    print('found no sample_file row for {} results file(s):\n\t{}'.format(
+        len(unresolved_results_fps), '\n\t'.join(sorted(unresolved_results_fps))))
+
+    print('failed to insert results from {} file(s):\n\t{}'.format(
+        len(failed_results_fps), '\n\t'.join(sorted(failed_results_fps))))
+
     print('total time: {:5.1f}s'.format(time.time()-start_time))
 
 
-kegg_orthology_field_re = re.compile(r'^(?P<field_name>[A-Z]+)?(\s+)(?P<field_value>.+)$')
-
-def parse_kegg_response(response):
-    """ response looks like this:
-            ENTRY       K01467                      KO
-            NAME        ampC
-            DEFINITION  beta-lactamase class C [EC:3.5.2.6]
-            PATHWAY     ko01501  beta-Lactam resistance
-                        ko02020  Two-component system
-            MODULE      M00628  beta-Lactam resistance, AmpC system
-            ...
-            ENTRY       K00154                      KO
-            NAME        E1.2.1.68
-            DEFINITION  coniferyl-aldehyde dehydrogenase [EC:1.2.1.68]
-            BRITE       Enzymes [BR:ko01000]
-                         1. Oxidoreductases
-                          1.2  Acting on the aldehyde or oxo group of donors
-                           1.2.1  With NAD+ or NADP+ as acceptor
-                            1.2.1.68  coniferyl-aldehyde dehydrogenase
-                             K00154  E1.2.1.68; coniferyl-aldehyde dehydrogenase
-            DBLINKS     COG: COG1012
-                        GO: 0050269
-            GENES       GQU: AWC35_21175
-                        CED: LH89_09310 LH89_19560
-                        SMW: SMWW4_v1c32370
-                        SMAR: SM39_2711
-                        SMAC: SMDB11_2482
-            ...
-
-    return: a dictionary of dictionaries that looks like this
-        {
-            'K01467': {
-                'ENTRY': 'K01467                      KO',
-                'NAME': 'ampC',
-                'DEFINITION': '',
-                'PATHWAY': '',
-                'MODULE': '',
-                ...
-            },
-            'K00154': {
-                'ENTRY': 'K00154                      KO',
-                'NAME': 'E1.2.1.68',
-                'DEFINITION': '',
-                'PATHWAY': '',
-                'MODULE': '',
-                ...
-            }
-
-        }
-    """
 
-    debug = False
+def load_uproc_kegg_results_from_file(
+        uproc_kegg_results_fp, session_class, engine, kegg_annotation_ids=None, on_duplicate='update'):
+    """Load one file of UProC KEGG results. Results for KEGG ids that are not in the
+    kegg_annotation table are skipped.
 
-    all_entries = defaultdict(lambda : defaultdict(list))
-    kegg_id = None
-    field_name = None
-    for line in io.StringIO(response).readlines():
-        field_match = kegg_orthology_field_re.search(line.rstrip())
-        if field_match is None:
-            # this line is /// to separate entries
-            pass
-        elif 'field_name' in field_match.groupdict():
-            field_name = field_match.group('field_name')
-            field_value = field_match.group('field_value')
-            if field_name == 'ENTRY':
-                kegg_id, *_ = field_value.split(' ')
-                #print('KEGG id: "{}"'.format(kegg_id))
+    :param kegg_annotation_ids: set of ids in the kegg_annotation table, if None the table is queried
+    :return: number of rows inserted
+    """
+    if kegg_annotation_ids is None:
+        with session_(session_class) as session:
+            kegg_annotation_ids = {s[0] for s in session.query(Kegg_annotation.kegg_annotation_id).all()}
+
+    sample_file_key = get_sample_file_key(uproc_kegg_results_fp)
+    sample_id, _ = sample_file_key
+    sample_file_id = get_sample_file_index(engine=engine, sample_ids={sample_id}).get(sample_file_key)
+    if sample_file_id is None:
+        raise Exception('found no sample_file row for results file "{}"'.format(uproc_kegg_results_fp))
+
+    with open(uproc_kegg_results_fp, 'rb') as uproc_kegg_results_file:
+        kegg_ids, read_counts = parse_uproc_results_bytes(uproc_kegg_results_file.read(), uproc_kegg_results_fp)
+
+    rows = []
+    missing_kegg_ids = []
+    for kegg_id, read_count in zip(kegg_ids.astype(str), read_counts.tolist()):
+        if kegg_id in kegg_annotation_ids:
+            rows.append({
+                'sample_id': sample_id,
+                'sample_file_id': sample_file_id,
+                'kegg_annotation_id': kegg_id,
+                'read_count': read_count})
         else:
-            # just a field value is present
-            pass
+            missing_kegg_ids.append(kegg_id)
+
+    if len(missing_kegg_ids) > 0:
+        print('skipped {} KEGG id(s) not in table "{}" from "{}"'.format(
+            len(missing_kegg_ids), Kegg_annotation.__tablename__, uproc_kegg_results_fp))
+
+    inserted_row_count, failed_results_fps = insert_uproc_kegg_results(
+        engine, [(uproc_kegg_results_fp, rows)], on_duplicate=on_duplicate)
+    if len(failed_results_fps) > 0:
+        raise Exception('failed to insert data from file "{}"'.format(uproc_kegg_results_fp))
+
+    return inserted_row_count
 
-        all_entries[kegg_id][field_name].append(field_value)
 
-    return all_entries
+# database connection and KEGG annotation ids for one worker process, see init_load_worker
+load_worker_state = {}
+
+
+def init_load_worker(db_uri):
+    """Connect to the database and read the KEGG annotation ids once per worker process."""
+    engine = sa.create_engine(db_uri, echo=False)
+    session_class = sessionmaker(bind=engine)
+    with session_(session_class) as session:
+        kegg_annotation_ids = {s[0] for s in session.query(Kegg_annotation.kegg_annotation_id).all()}
+
+    load_worker_state['engine'] = engine
+    load_worker_state['session_class'] = session_class
+    load_worker_state['kegg_annotation_ids'] = kegg_annotation_ids
+
+
+def load_uproc_kegg_results_file_in_worker(uproc_kegg_results_fp, on_duplicate):
+    return load_uproc_kegg_results_from_file(
+        uproc_kegg_results_fp,
+        session_class=load_worker_state['session_class'],
+        engine=load_worker_state['engine'],
+        kegg_annotation_ids=load_worker_state['kegg_annotation_ids'],
+        on_duplicate=on_duplicate)
+
+
+def load_uproc_kegg_results_files_in_parallel(dir_root, db_uri, parallel, on_duplicate='update'):
+    """Load every file of UProC KEGG results below dir_root with `parallel` worker processes.
+    This replaces the job file for GNU Parallel written by write_command_file_from_directory_tree.
+
+    :return: list of results file paths that failed to load
+    """
+    check_uproc_kegg_result_unique_key(sa.create_engine(db_uri, echo=False))
+
+    t0 = time.time()
+    uproc_kegg_results_fps = list(scandir_files(dir_root, uproc_kegg_results_file_name_re))
+    print('found {} UProC KEGG results file(s) in {:5.1f}s'.format(len(uproc_kegg_results_fps), time.time()-t0))
+
+    inserted_row_count = 0
+    failed_results_fps = []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=parallel, initializer=init_load_worker, initargs=(db_uri, )) as executor:
+        future_to_results_fp = {
+            executor.submit(load_uproc_kegg_results_file_in_worker, uproc_kegg_results_fp, on_duplicate):
+                uproc_kegg_results_fp
+            for uproc_kegg_results_fp
+            in uproc_kegg_results_fps}
+        for future in concurrent.futures.as_completed(future_to_results_fp):
+            try:
+                inserted_row_count += future.result()
+            except Exception as e:
+                print(e)
+                failed_results_fps.append(future_to_results_fp[future])
+
+    print('inserted {} UProC KEGG results from {} file(s) in {:5.1f}s ({:.0f} rows/s)'.format(
+        inserted_row_count,
+        len(uproc_kegg_results_fps) - len(failed_results_fps),
+        time.time()-t0,
+        inserted_row_count / max(time.time()-t0, 1e-9)))
+    print('failed to load {} file(s):\n\t{}'.format(
+        len(failed_results_fps), '\n\t'.join(sorted(failed_results_fps))))
+
+    return failed_results_fps
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+"""
+Find the sample_file row for each UProC KEGG results file.
+
+Results files are read from a local tree like
+    <root>/projects/<project id>/samples/<sample id>/<name>.uproc.kegg
+and the sample_file table names the same files in the iRODS load collection.
+
+The sample_file table is declared here with only the columns these functions use,
+rather than imported from the generated iMicrobe models, so the functions can be
+used and tested without the models.
+"""
+import os
+import time
+
+import sqlalchemy as sa
+
+from imicrobe.util import grouper
+
+
+sample_file_table = sa.table(
+    'sample_file',
+    sa.column('sample_file_id'),
+    sa.column('sample_id'),
+    sa.column('file'))
+
+
+def get_sample_file_key(uproc_kegg_results_fp):
+    """Return (sample id, sample_file.file) for a results file path like
+        /home/u26/jklynch/usr/local/imicrobe/data/uproc/projects/148/samples/3486/ERR906934.fasta.uproc.kegg
+    A gzipped results file has the same key as the uncompressed file.
+    Raise ValueError if the project or sample directory name is not an integer.
+    """
+    sample_dp, file_name = os.path.split(uproc_kegg_results_fp)
+    if file_name.endswith('.gz'):
+        file_name = file_name[:-len('.gz')]
+    samples_dp, sample_id = os.path.split(sample_dp)
+    sample_id = int(sample_id)
+    project_id = int(os.path.basename(os.path.dirname(samples_dp)))
+
+    return sample_id, '/iplant/home/shared/load/projects/{}/samples/{}/{}'.format(project_id, sample_id, file_name)
+
+
+def get_sample_file_keys(uproc_kegg_results_fps):
+    """Return (dictionary of results file path to sample file key, list of results file paths without a key).
+    A results file has no key if its path does not include project and sample ids.
+    """
+    results_fp_to_sample_file_key = {}
+    unresolved_results_fps = []
+    for uproc_kegg_results_fp in uproc_kegg_results_fps:
+        try:
+            results_fp_to_sample_file_key[uproc_kegg_results_fp] = get_sample_file_key(uproc_kegg_results_fp)
+        except ValueError:
+            unresolved_results_fps.append(uproc_kegg_results_fp)
+    return results_fp_to_sample_file_key, unresolved_results_fps
+
+
+def get_sample_file_index(engine, sample_ids, batch_size=1000):
+    """Return a dictionary of (sample id, sample_file.file) to sample_file_id for every
+    sample_file row of the given samples. Samples are queried batch_size at a time.
+    """
+    t0 = time.time()
+    sample_file_index = {}
+    with engine.connect() as connection:
+        for sample_id_group_ in grouper(sorted(sample_ids), n=batch_size, fillvalue=None):
+            sample_id_group = [s for s in sample_id_group_ if s is not None]
+            for sample_id, file_, sample_file_id in connection.execute(
+                    sa.select(
+                        sample_file_table.c.sample_id,
+                        sample_file_table.c.file,
+                        sample_file_table.c.sample_file_id).where(
+                            sample_file_table.c.sample_id.in_(sample_id_group))):
+                sample_file_index[(sample_id, file_)] = sample_file_id
+
+    print('found {} sample_file row(s) for {} sample(s) in {:5.1f}s'.format(
+        len(sample_file_index), len(sample_ids), time.time()-t0))
+    return sample_file_index
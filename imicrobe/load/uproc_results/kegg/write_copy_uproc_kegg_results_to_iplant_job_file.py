@@ -3,11 +3,16 @@ Parse original UProC output directory tree to write a launcher job file that wil
 to the shared iMicrobe storage system using iRODS.
 
 The shared iMicrobe storage system is at /iplant/home/shared/imicrobe
+
+With --sync only files that are missing from iRODS or differ from their iRODS copies
+are written to the job file (see imicrobe.util.irods_sync).
 """
 import argparse
 import os
 import sys
 
+from imicrobe.util.irods_sync import LocalChecksumCache, find_local_to_irods_differences
+
 
 def get_args(argv):
     arg_parser = argparse.ArgumentParser()
@@ -16,6 +21,11 @@ def get_args(argv):
     arg_parser.add_argument('--fs-source-dir', required=True)
     arg_parser.add_argument('--irods-target-dir', required=True)
     arg_parser.add_argument('--job-limit', default=None, type=int)
+    arg_parser.add_argument('--sync', action='store_true', default=False,
+                            help='write jobs only for files missing from or different in iRODS')
+    arg_parser.add_argument('--compare', choices=('exists', 'size', 'mtime', 'checksum'), default='mtime',
+                            help='with --sync, how files are compared to iRODS')
+    arg_parser.add_argument('--checksum-cache-fp', default=None, help='with --sync, local checksum cache file')
 
     args = arg_parser.parse_args(args=argv)
     print(args)
@@ -30,45 +40,52 @@ def main():
 def write_job_file(argv):
     args = get_args(argv)
 
-    job_count = 0
-    with open(args.job_file, 'wt') as job_file:
-        for root, dir_names, file_names in os.walk(top=args.fs_source_dir):
-            for file_name in file_names:
-                if file_name.endswith('.uproc.kegg'):
-                    # construct the irods target file path
-                    # by cutting the fs-source directory off of root
-                    # and joining what remains to irods-target, for example
-                    #        root = '/work/imicrobe/data/projects/1/sample/1'
-                    #   fs-source = '/work/imicrobe/data/projects'
-                    #   irods-target = '/iplant/home/shared/imicrobe/data/projects
-                    #
-                    #   irods_target_dir_path = '/iplant/home/shared/imicrobe/data/projects' + '/1/sample/1'
+    fs_source_to_irods_target_file_paths = {}
+    for root, dir_names, file_names in os.walk(top=args.fs_source_dir):
+        for file_name in file_names:
+            if file_name.endswith('.uproc.kegg'):
+                # construct the irods target file path
+                # by cutting the fs-source directory off of root
+                # and joining what remains to irods-target, for example
+                #        root = '/work/imicrobe/data/projects/1/sample/1'
+                #   fs-source = '/work/imicrobe/data/projects'
+                #   irods-target = '/iplant/home/shared/imicrobe/data/projects
+                #
+                #   irods_target_dir_path = '/iplant/home/shared/imicrobe/data/projects' + '/1/sample/1'
 
-                    fs_source_file_path = os.path.join(root, file_name)
+                fs_source_file_path = os.path.join(root, file_name)
 
-                    # do not allow irods_partial_dir_path to be absolute or os.path.join will ignore it (see docs)
-                    irods_partial_dir_path = root[len(args.fs_source_dir)+1:]
-                    irods_target_dir_path = os.path.join(
-                        args.irods_target_dir,
-                        irods_partial_dir_path)
+                # do not allow irods_partial_dir_path to be absolute or os.path.join will ignore it (see docs)
+                irods_partial_dir_path = root[len(args.fs_source_dir)+1:]
+                irods_target_dir_path = os.path.join(
+                    args.irods_target_dir,
+                    irods_partial_dir_path)
 
-                    irods_target_file_path = os.path.join(irods_target_dir_path, file_name)
+                irods_target_file_path = os.path.join(irods_target_dir_path, file_name)
 
-                    job_file.write('module load irods; imkdir {}; iput -K {} {}\n'.format(
-                        irods_target_dir_path,
-                        fs_source_file_path,
-                        irods_target_file_path))
+                fs_source_to_irods_target_file_paths[fs_source_file_path] = irods_target_file_path
 
-                    job_count += 1
+            else:
+                # ignore this file
+                pass
 
-                else:
-                    # ignore this file
-                    pass
+        if (args.job_limit is not None) and (args.job_limit <= len(fs_source_to_irods_target_file_paths)):
+            break
 
-            if (args.job_limit is not None) and (args.job_limit <= job_count):
-                break
+    if args.sync:
+        with LocalChecksumCache(cache_fp=args.checksum_cache_fp) as checksum_cache:
+            fs_source_to_irods_target_file_paths = find_local_to_irods_differences(
+                fs_source_to_irods_target_file_paths, checksum_cache=checksum_cache, compare=args.compare)
 
+    job_count = 0
+    with open(args.job_file, 'wt') as job_file:
+        for fs_source_file_path, irods_target_file_path in sorted(fs_source_to_irods_target_file_paths.items()):
+            job_file.write('module load irods; imkdir {}; iput -K {} {}\n'.format(
+                os.path.dirname(irods_target_file_path),
+                fs_source_file_path,
+                irods_target_file_path))
 
+            job_count += 1
 
     print('wrote {} jobs to "{}"'.format(job_count, args.job_file))
 
@@ -7,6 +7,7 @@ import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 
 from imicrobe.uproc_results.uproc_models import SampleToUproc, Uproc
+from imicrobe.util.pfam import read_pfamA_table
 
 
 def main():
@@ -56,47 +57,28 @@ def grouper(iterable, n, fillvalue=None):
 
 
 def load_pfam_table(session, engine):
-    debug = False
-    line_group_length = 2000
+    """Insert the Pfam families in data/pfamA.txt.gz that are not already in the uproc table.
+    The file is read once and existing accessions are fetched with one query.
+    """
+    insert_chunk_size = 5000
     pfamA_fp = 'data/pfamA.txt.gz'
-    # had problems on myo with U+009D in PF01298 description
-    # not a problem with imicrobe-vm on my laptop
-    # this is the error:
-    #   UnicodeEncodeError: 'latin-1' codec can't encode characters in position 1089-1090: ordinal not in range(256)
-    # why is 'latin-1' codec being used?
-    # specifying encoding='latin-1' and errors='replace' solves the problem on myo
-    with gzip.open(pfamA_fp, 'rt', encoding='latin-1', errors='replace') as pfamA_file:
-        for line_group in grouper(pfamA_file.readlines(), line_group_length, fillvalue=None):
-            line_counter = 0
-            t0 = time.time()
-            for line in (line_ for line_ in line_group if line_ is not None):
-                line_counter += 1
-                pfam_acc, pfam_identifier, pfam_aliases, pfam_name, _, _, _, _, description, *the_rest = line.strip().split('\t')
-
-                if debug:
-                    print('pfam accession  : {}'.format(pfam_acc))
-                    print('pfam identifier : {}'.format(pfam_identifier))
-                    print('pfam aliases    : {}'.format(pfam_aliases))
-                    print('pfam name       : {}'.format(pfam_name))
-                    print('description     : {}'.format(description))
-
-                if session.query(Uproc).filter(Uproc.accession==pfam_acc).one_or_none():
-                    pass
-                    #print('{} is already in the database'.format(pfam_acc))
-                else:
-                    # insert
-                    session.add(
-                        Uproc(
-                            accession=pfam_acc,
-                            identifier=pfam_identifier,
-                            name=pfam_name,
-                            description=description))
-
-            session.commit()
-            print(
-                'committed {} rows in {:5.1f}s'.format(
-                    line_counter,
-                    time.time()-t0))
+
+    t0 = time.time()
+    pfamA_df = read_pfamA_table(pfamA_fp)
+    print('read {} rows from "{}" in {:5.1f}s'.format(len(pfamA_df), pfamA_fp, time.time()-t0))
+
+    existing_accessions = {accession for (accession, ) in session.query(Uproc.accession).all()}
+    new_uproc_rows = pfamA_df[~pfamA_df.accession.isin(existing_accessions)].to_dict('records')
+
+    uproc_insert = Uproc.__table__.insert()
+    for i in range(0, len(new_uproc_rows), insert_chunk_size):
+        t00 = time.time()
+        session.execute(uproc_insert, new_uproc_rows[i:i+insert_chunk_size])
+        session.commit()
+        print(
+            'committed {} rows in {:5.1f}s'.format(
+                len(new_uproc_rows[i:i+insert_chunk_size]),
+                time.time()-t00))
 
     print('table "{}" has {} rows'.format(Uproc.__tablename__, session.query(Uproc).count()))
 
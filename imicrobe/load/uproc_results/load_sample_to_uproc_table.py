@@ -1,19 +1,52 @@
+"""
+Run with --results-root-dp to write a job file for GNU Parallel.
+
+Run with --results-root-dp and --parallel N to load every file of UProC results
+in the directory tree with N worker processes instead of GNU Parallel. Each worker
+connects to the database. The uproc accessions are read one time and shared with the
+workers through memory mapped files.
+
+Run with --uproc-results-fp to load one file of UProC results.
+
+Accessions are resolved to uproc_ids a whole file at a time, either with a map of
+every uproc accession read once (--uproc-id-cache preload) or with one query per
+new accession remembered in an LRU cache (--uproc-id-cache lru), which is faster
+for a few files. Accessions that are not in the uproc table are counted and
+reported at the end of the run.
+"""
 import argparse
+import collections
+import concurrent.futures
+import functools
 import itertools
 import os
+import re
 import sys
+import tempfile
 import time
 
+import numpy as np
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 
+from imicrobe.load.uproc.results import parse_uproc_results_bytes
+from imicrobe.load.uproc_results.results_buffer import scandir_files
 from imicrobe.uproc_results.uproc_models import SampleToUproc, Uproc
+from imicrobe.util.accession_cache import AccessionIdCache
 
 
 def get_args():
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--results-root-dp', help='path to root of results directory tree')
+    argparser.add_argument('--parallel', default=None, type=int,
+                           help='with --results-root-dp load files with this many processes instead of writing a job file')
     argparser.add_argument('--uproc-results-fp', help='path to one file of UProC results')
+    argparser.add_argument('--uproc-id-cache', choices=('preload', 'lru'), default='preload',
+                           help='read all uproc accessions once (preload) or query each new accession (lru)')
+    argparser.add_argument('--lru-cache-size', default=100000, type=int,
+                           help='number of accessions remembered with --uproc-id-cache lru')
+    argparser.add_argument('--missing-accessions-fp', default=None,
+                           help='write accessions that are not in the uproc table to this file')
     argparser.add_argument('--line-limit', default=None, type=int, help='number of lines to print')
     argparser.parse_args()
 
@@ -41,15 +74,26 @@ def main():
         drop_table(SampleToUproc, engine=imicrobe_engine)
         SampleToUproc.__table__.create(imicrobe_engine)
         #load_sample_to_uproc_table(session=session, engine=imicrobe_engine)
-        write_command_file_from_directory_tree(
-            dir_root=args.results_root_dp,
-            session=session,
-            engine=imicrobe_engine)
+        if args.parallel:
+            load_sample_to_uproc_table_in_parallel(
+                dir_root=args.results_root_dp,
+                db_uri=db_uri,
+                parallel=args.parallel,
+                uproc_id_cache=args.uproc_id_cache,
+                lru_cache_size=args.lru_cache_size,
+                missing_accessions_fp=args.missing_accessions_fp)
+        else:
+            write_command_file_from_directory_tree(
+                dir_root=args.results_root_dp,
+                session=session,
+                engine=imicrobe_engine)
     elif args.uproc_results_fp:
-        load_sample_to_uproc_table_from_file(
+        _, missing_accessions = load_sample_to_uproc_table_from_file(
             uproc_results_fp=args.uproc_results_fp,
             session=session,
-            engine=imicrobe_engine)
+            engine=imicrobe_engine,
+            uproc_id_cache=get_uproc_id_cache(session, args.uproc_id_cache, args.lru_cache_size))
+        report_missing_accessions(collections.Counter(missing_accessions), args.missing_accessions_fp)
     else:
         print('specify either --results-root-dp or --uproc-results-fp')
 
@@ -81,7 +125,7 @@ def write_command_file_from_directory_tree(dir_root, session, engine):
     file_count = 0
     for root, dirs, files in os.walk(dir_root):
         for file in files:
-            if file.endswith('.uproc'):
+            if file.endswith('.uproc') or file.endswith('.uproc.gz'):
                 file_count += 1
 
                 uproc_results_fp = os.path.join(root, file)
@@ -91,43 +135,196 @@ def write_command_file_from_directory_tree(dir_root, session, engine):
     sys.stderr.write('wrote {} lines in {:5.1f}s\n'.format(file_count, time.time()-start_time))
 
 
-def load_sample_to_uproc_table_from_file(uproc_results_fp, session, engine):
+class LruUprocIdCache:
+    """
+    Look up uproc_ids one accession at a time, remembering the last maxsize accessions.
+    Has the lookup method of imicrobe.util.accession_cache.AccessionIdCache.
+    """
+    def __init__(self, session, maxsize=100000):
+        self.session = session
+        self.get = functools.lru_cache(maxsize=maxsize)(self._query_uproc_id)
+
+    def _query_uproc_id(self, accession):
+        uproc_row = self.session.query(Uproc.uproc_id).filter(Uproc.accession == accession).one_or_none()
+        return -1 if uproc_row is None else uproc_row[0]
+
+    def lookup(self, accessions):
+        """
+        :return: numpy int64 array of uproc_ids, -1 where an accession is not in the uproc table
+        """
+        return np.array([self.get(accession) for accession in accessions], dtype=np.int64)
+
+
+def get_uproc_id_cache(session, uproc_id_cache='preload', lru_cache_size=100000):
+    """Return an object with a lookup(accessions) method that returns uproc_ids.
+
+    :param uproc_id_cache: 'preload' to read every uproc accession now, 'lru' to query accessions as they are needed
+    """
+    if uproc_id_cache == 'lru':
+        return LruUprocIdCache(session, maxsize=lru_cache_size)
+    else:
+        t0 = time.time()
+        accession_id_cache = AccessionIdCache.from_query(session.query(Uproc.accession, Uproc.uproc_id))
+        print('read {} uproc accessions in {:5.1f}s'.format(len(accession_id_cache), time.time()-t0))
+        return accession_id_cache
+
+
+def load_sample_to_uproc_table_from_file(uproc_results_fp, session, engine, uproc_id_cache=None):
+    """Load one file of UProC results with one bulk insert.
+
+    :param uproc_id_cache: see get_uproc_id_cache, if None an LRU cache is used
+    :return: (number of lines read, list of accessions that are not in the uproc table)
+    """
     debug = True
     if debug:
         print('reading UProC results from "{}"'.format(uproc_results_fp))
     t0 = time.time()
-    with open(uproc_results_fp, 'rt') as uproc_results_file:
-        line_count = 0
-        # uproc_results_fp looks like
-        #   /home/u26/jklynch/usr/local/imicrobe/data/uproc/projects/148/samples/3486/ERR906934.fasta.uproc
-        p, sample_id = os.path.split(os.path.dirname(uproc_results_fp))
-        sample_id = int(sample_id)
-
-        for line in uproc_results_file:
-            line_count += 1
-            pfam_accession, read_count = line.strip().split(',')
-
-            uproc_result = session.query(
-                Uproc).filter(
-                Uproc.accession == pfam_accession).one_or_none()
-
-            if uproc_result is None:
-                print('failed to find Pfam accession "{}"'.format(pfam_accession))
-            else:
-                x = SampleToUproc(
-                    sample_id=int(sample_id),
-                    uproc_id=uproc_result.uproc_id,
-                    read_count=int(read_count))
-                session.add(x)
+    if uproc_id_cache is None:
+        uproc_id_cache = LruUprocIdCache(session)
+
+    # uproc_results_fp looks like
+    #   /home/u26/jklynch/usr/local/imicrobe/data/uproc/projects/148/samples/3486/ERR906934.fasta.uproc
+    p, sample_id = os.path.split(os.path.dirname(uproc_results_fp))
+    sample_id = int(sample_id)
 
+    with open(uproc_results_fp, 'rb') as uproc_results_file:
+        accessions, read_counts = parse_uproc_results_bytes(uproc_results_file.read(), uproc_results_fp)
+    accessions = accessions.astype(str)
+    uproc_ids = uproc_id_cache.lookup(accessions)
+
+    found = uproc_ids >= 0
+    missing_accessions = accessions[~found].tolist()
+    if len(missing_accessions) > 0:
+        print('failed to find {} Pfam accession(s) in "{}": {}'.format(
+            len(missing_accessions), uproc_results_fp, ', '.join(missing_accessions[:10])))
+
+    sample_to_uproc_rows = [
+        {'sample_id': sample_id, 'uproc_id': uproc_id, 'read_count': read_count}
+        for uproc_id, read_count
+        in zip(uproc_ids[found].tolist(), read_counts[found].tolist())]
+    if len(sample_to_uproc_rows) > 0:
+        session.execute(SampleToUproc.__table__.insert(), sample_to_uproc_rows)
     session.commit()
     if debug:
         print(
             '  committed {} rows to "{}" table in {:5.1f}s'.format(
-                line_count,
+                len(sample_to_uproc_rows),
                 SampleToUproc.__tablename__,
                 time.time() - t0))
 
+    return len(accessions), missing_accessions
+
+
+def report_missing_accessions(missing_accession_file_counts, missing_accessions_fp=None):
+    """Print the accessions that were not found in the uproc table and optionally write them to a file.
+
+    :param missing_accession_file_counts: collections.Counter of accession to number of files
+    :param missing_accessions_fp: if not None write one 'accession<tab>file count' line per accession
+    """
+    print('{} accession(s) are not in table "{}"'.format(len(missing_accession_file_counts), Uproc.__tablename__))
+    for accession, file_count in missing_accession_file_counts.most_common(10):
+        print('\t{}\tin {} file(s)'.format(accession, file_count))
+
+    if missing_accessions_fp is not None:
+        with open(missing_accessions_fp, 'wt') as missing_accessions_file:
+            for accession, file_count in missing_accession_file_counts.most_common():
+                missing_accessions_file.write('{}\t{}\n'.format(accession, file_count))
+        print('wrote missing accessions to "{}"'.format(missing_accessions_fp))
+
+
+# database session and uproc accessions for one worker process, see init_load_worker
+load_worker_state = {}
+
+
+def save_uproc_id_cache(db_uri, uproc_id_cache_dp):
+    """Read every uproc accession and save them in uproc_id_cache_dp for the worker processes."""
+    engine = sa.create_engine(db_uri, echo=False)
+    session = sessionmaker(bind=engine)()
+    try:
+        get_uproc_id_cache(session, 'preload').save(uproc_id_cache_dp)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def init_load_worker(db_uri, uproc_id_cache_dp, lru_cache_size):
+    """Connect to the database and set up the uproc_id cache once per worker process.
+
+    :param uproc_id_cache_dp: directory written by save_uproc_id_cache, memory mapped so the
+        workers share one copy, or None to look up accessions with an LRU cache
+    """
+    engine = sa.create_engine(db_uri, echo=False)
+    session = sessionmaker(bind=engine)()
+
+    load_worker_state['engine'] = engine
+    load_worker_state['session'] = session
+    if uproc_id_cache_dp is None:
+        load_worker_state['uproc_id_cache'] = LruUprocIdCache(session, maxsize=lru_cache_size)
+    else:
+        load_worker_state['uproc_id_cache'] = AccessionIdCache.load(uproc_id_cache_dp, mmap=True)
+
+
+def load_file_in_worker(uproc_results_fp):
+    session = load_worker_state['session']
+    try:
+        return load_sample_to_uproc_table_from_file(
+            uproc_results_fp,
+            session=session,
+            engine=load_worker_state['engine'],
+            uproc_id_cache=load_worker_state['uproc_id_cache'])
+    except:
+        session.rollback()
+        raise
+
+
+def load_sample_to_uproc_table_in_parallel(
+        dir_root, db_uri, parallel, uproc_id_cache='preload', lru_cache_size=100000, missing_accessions_fp=None):
+    """Load every file of UProC results below dir_root with `parallel` worker processes.
+    This replaces the job file for GNU Parallel written by write_command_file_from_directory_tree.
+
+    :return: list of results file paths that failed to load
+    """
+    t0 = time.time()
+    uproc_results_fps = list(scandir_files(dir_root, re.compile(r'\.uproc(\.gz)?$')))
+    print('found {} UProC results file(s) in {:5.1f}s'.format(len(uproc_results_fps), time.time()-t0))
+
+    line_count = 0
+    failed_results_fps = []
+    missing_accession_file_counts = collections.Counter()
+    with tempfile.TemporaryDirectory(prefix='uproc_id_cache_') as uproc_id_cache_dp:
+        if uproc_id_cache == 'preload':
+            save_uproc_id_cache(db_uri, uproc_id_cache_dp)
+        else:
+            uproc_id_cache_dp = None
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=parallel,
+                initializer=init_load_worker,
+                initargs=(db_uri, uproc_id_cache_dp, lru_cache_size)) as executor:
+            future_to_results_fp = {
+                executor.submit(load_file_in_worker, uproc_results_fp): uproc_results_fp
+                for uproc_results_fp
+                in uproc_results_fps}
+            for future in concurrent.futures.as_completed(future_to_results_fp):
+                try:
+                    file_line_count, missing_accessions = future.result()
+                    line_count += file_line_count
+                    missing_accession_file_counts.update(set(missing_accessions))
+                except Exception as e:
+                    print(e)
+                    failed_results_fps.append(future_to_results_fp[future])
+
+    print('loaded {} line(s) from {} file(s) in {:5.1f}s ({:.0f} lines/s)'.format(
+        line_count,
+        len(uproc_results_fps) - len(failed_results_fps),
+        time.time()-t0,
+        line_count / max(time.time()-t0, 1e-9)))
+    print('failed to load {} file(s):\n\t{}'.format(
+        len(failed_results_fps), '\n\t'.join(sorted(failed_results_fps))))
+    report_missing_accessions(missing_accession_file_counts, missing_accessions_fp)
+
+    return failed_results_fps
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,229 @@
+"""
+Scan a directory tree of UProC results files once and keep the parsed results in a
+columnar buffer so that every file is read and parsed only one time.
+
+The buffer has three columns, one row per results line:
+    file_id       int32, index into UprocResultsBuffer.file_paths
+    accession_id  int32, index into UprocResultsBuffer.accessions
+    read_count    int64
+
+Rows are held in memory until they take more than spill_size bytes, then they are
+written to a NumPy .npz file in spill_dp and read back one spill file at a time.
+
+The tree is listed with os.scandir and the files are parsed by a pool of processes,
+since parsing is CPU-bound. Only the parent process adds parsed files to the buffer,
+in the order the files were listed.
+"""
+import collections
+import concurrent.futures
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from imicrobe.load.uproc.results import parse_uproc_results_bytes
+
+
+class UprocResultsBuffer:
+    """
+    Parsed UProC results for many files. Safe to fill from several threads.
+    """
+    def __init__(self, spill_dp=None, spill_size=1024 * 1024 * 1024):
+        """
+        :param spill_dp: directory for spill files, None to keep all rows in memory
+        :param spill_size: bytes of rows held in memory before they are spilled
+        """
+        self.spill_dp = None if spill_dp is None else tempfile.mkdtemp(prefix='uproc_results_', dir=spill_dp)
+        self.spill_size = spill_size
+        self.lock = threading.Lock()
+
+        self.file_paths = []
+        self.accessions = []
+        self.accession_to_id = {}
+        self.row_count = 0
+
+        # columns not yet spilled as lists of arrays, one per file
+        self.file_ids = []
+        self.accession_ids = []
+        self.read_counts = []
+        self.buffered_size = 0
+        self.spill_fps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.spill_dp is not None:
+            shutil.rmtree(self.spill_dp, ignore_errors=True)
+
+    def __len__(self):
+        return self.row_count
+
+    def add(self, file_path, accessions, read_counts):
+        """Add the parsed results of one file.
+
+        :param accessions: numpy bytes array
+        :param read_counts: numpy int64 array
+        """
+        unique_accessions, accession_index = np.unique(accessions, return_inverse=True)
+        self.add_factorized(file_path, unique_accessions, accession_index, read_counts)
+
+    def add_factorized(self, file_path, unique_accessions, accession_index, read_counts):
+        """Add the parsed results of one file as returned by np.unique(accessions, return_inverse=True).
+
+        :param unique_accessions: numpy bytes array
+        :param accession_index: numpy int array, accessions is unique_accessions[accession_index]
+        :param read_counts: numpy int64 array
+        """
+        with self.lock:
+            file_id = len(self.file_paths)
+            self.file_paths.append(file_path)
+
+            unique_accession_ids = np.empty(len(unique_accessions), dtype=np.int32)
+            for i, accession in enumerate(unique_accessions.astype(str)):
+                accession_id = self.accession_to_id.get(accession)
+                if accession_id is None:
+                    accession_id = len(self.accessions)
+                    self.accessions.append(accession)
+                    self.accession_to_id[accession] = accession_id
+                unique_accession_ids[i] = accession_id
+
+            self.file_ids.append(np.full(len(accession_index), file_id, dtype=np.int32))
+            self.accession_ids.append(unique_accession_ids[accession_index])
+            self.read_counts.append(np.asarray(read_counts, dtype=np.int64))
+            self.row_count += len(accession_index)
+            self.buffered_size += 16 * len(accession_index)
+
+            if self.spill_dp is not None and self.buffered_size >= self.spill_size:
+                self._spill()
+
+    def _spill(self):
+        spill_fp = os.path.join(self.spill_dp, 'rows_{}.npz'.format(len(self.spill_fps)))
+        np.savez(spill_fp, *self._concatenate_buffered_columns())
+        self.spill_fps.append(spill_fp)
+        self.file_ids = []
+        self.accession_ids = []
+        self.read_counts = []
+        self.buffered_size = 0
+
+    def _concatenate_buffered_columns(self):
+        if len(self.file_ids) == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+        else:
+            return np.concatenate(self.file_ids), np.concatenate(self.accession_ids), np.concatenate(self.read_counts)
+
+    def iter_column_chunks(self):
+        """Yield (file_ids, accession_ids, read_counts) for each spill file and then for the rows in memory.
+        All rows of one file are in the same chunk.
+        """
+        for spill_fp in self.spill_fps:
+            with np.load(spill_fp) as spill:
+                yield spill['arr_0'], spill['arr_1'], spill['arr_2']
+        yield self._concatenate_buffered_columns()
+
+    def iter_files(self):
+        """Yield (file path, list of accessions, numpy int64 array of read counts) for each file."""
+        accessions = np.array(self.accessions, dtype=object)
+        for file_ids, accession_ids, read_counts in self.iter_column_chunks():
+            file_starts = np.concatenate(([0], np.flatnonzero(file_ids[1:] != file_ids[:-1]) + 1))
+            file_ends = np.concatenate((file_starts[1:], [len(file_ids)]))
+            for file_start, file_end in zip(file_starts, file_ends):
+                if file_start < file_end:
+                    yield (
+                        self.file_paths[file_ids[file_start]],
+                        accessions[accession_ids[file_start:file_end]].tolist(),
+                        read_counts[file_start:file_end])
+
+
+def scandir_files(dp, name_re):
+    """Yield the paths of files below dp with names matching name_re, using os.scandir."""
+    subdir_paths = []
+    with os.scandir(dp) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdir_paths.append(entry.path)
+            elif entry.is_file() and name_re.search(entry.name):
+                yield entry.path
+
+    for subdir_path in sorted(subdir_paths):
+        yield from scandir_files(subdir_path, name_re)
+
+
+def read_uproc_results_file(uproc_results_fp, line_limit=None):
+    """Parse one file and factorize its accessions. Runs in a worker process.
+
+    :return: arguments for UprocResultsBuffer.add_factorized
+    """
+    with open(uproc_results_fp, 'rb') as uproc_results_file:
+        accessions, read_counts = parse_uproc_results_bytes(uproc_results_file.read(), uproc_results_fp)
+    unique_accessions, accession_index = np.unique(accessions[:line_limit], return_inverse=True)
+    return uproc_results_fp, unique_accessions, accession_index.astype(np.int32), read_counts[:line_limit]
+
+
+def scan_uproc_results_tree(dir_root, name_re, line_limit=None, workers=4, spill_dp=None, spill_size=1024 * 1024 * 1024):
+    """Read every UProC results file below dir_root one time.
+
+    :param dir_root: root of the results directory tree
+    :param name_re: compiled regular expression for results file names
+    :param line_limit: if not None read only this many lines of each file
+    :param workers: number of processes parsing files
+    :param spill_dp: see UprocResultsBuffer
+    :param spill_size: see UprocResultsBuffer
+    :return: UprocResultsBuffer
+    """
+    t0 = time.time()
+    if spill_dp is None:
+        print('WARNING: no spill directory was given, all parsed results will be held in memory')
+    results_buffer = UprocResultsBuffer(spill_dp=spill_dp, spill_size=spill_size)
+
+    subdir_paths = []
+    root_fps = []
+    with os.scandir(dir_root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdir_paths.append(entry.path)
+            elif entry.is_file() and name_re.search(entry.name):
+                root_fps.append(entry.path)
+
+    # (subdirectory of dir_root, file path) in the order files are added to the buffer
+    dp_fps = itertools.chain(
+        ((dir_root, fp) for fp in sorted(root_fps)),
+        ((subdir_path, fp) for subdir_path in sorted(subdir_paths) for fp in scandir_files(subdir_path, name_re)))
+
+    file_count = 0
+    dp_file_counts = collections.Counter()
+    # (subdirectory, future) for files being parsed, at most 4 * workers so parsed
+    # files do not pile up in memory waiting to be added
+    parse_futures = collections.deque()
+
+    def add_parsed_file():
+        dp, parse_future = parse_futures.popleft()
+        results_buffer.add_factorized(*parse_future.result())
+        dp_file_counts[dp] += 1
+        if len(parse_futures) == 0 or parse_futures[0][0] != dp:
+            print('{:<10.1f}s: parsed {} file(s) in "{}"'.format(time.time()-t0, dp_file_counts.pop(dp), dp))
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for dp, fp in dp_fps:
+                parse_futures.append((dp, executor.submit(read_uproc_results_file, fp, line_limit)))
+                file_count += 1
+                while len(parse_futures) > 4 * workers:
+                    add_parsed_file()
+            while len(parse_futures) > 0:
+                add_parsed_file()
+    except BaseException:
+        results_buffer.close()
+        raise
+
+    print('parsed {} line(s) with {} accession(s) from {} file(s) in {:5.1f}s'.format(
+        len(results_buffer), len(results_buffer.accessions), file_count, time.time()-t0))
+
+    return results_buffer
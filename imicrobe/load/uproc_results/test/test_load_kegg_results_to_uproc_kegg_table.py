@@ -0,0 +1,85 @@
+import os
+
+import pytest
+import sqlalchemy as sa
+
+# the UProC KEGG ORM models may not be installed
+pytest.importorskip('imicrobe.uproc_results.kegg.models')
+
+from imicrobe.load.uproc_results.kegg import load_kegg_results_to_uproc_kegg_table as loader
+
+
+def copy_table(table, metadata, *constraints):
+    """Copy the columns of a model table, without foreign keys, to a SQLite test database."""
+    return sa.Table(
+        table.name,
+        metadata,
+        *[sa.Column(c.name, c.type, primary_key=c.primary_key) for c in table.columns],
+        *constraints)
+
+
+def create_test_db(tmpdir, unique_key=True):
+    engine = sa.create_engine('sqlite:///' + str(tmpdir.join('test.db')), echo=False)
+    metadata = sa.MetaData()
+    sample_file_table = sa.Table(
+        'sample_file',
+        metadata,
+        sa.Column('sample_file_id', sa.Integer, primary_key=True),
+        sa.Column('sample_id', sa.Integer),
+        sa.Column('file', sa.String(200)))
+    constraints = [sa.UniqueConstraint(*loader.uproc_kegg_result_unique_key_columns)] if unique_key else []
+    copy_table(loader.Uproc_kegg_result.__table__, metadata, *constraints)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            sample_file_table.insert(),
+            [{'sample_file_id': 7, 'sample_id': 3, 'file': '/iplant/home/shared/load/projects/1/samples/3/a.fasta.uproc.kegg'}])
+    return engine
+
+
+def test_load_same_file_twice(tmpdir):
+    engine = create_test_db(tmpdir)
+    loader.check_uproc_kegg_result_unique_key(engine)
+
+    results_fp = str(tmpdir.join('projects', '1', 'samples', '3', 'a.fasta.uproc.kegg'))
+    os.makedirs(os.path.dirname(results_fp))
+    with open(results_fp, 'wt') as results_file:
+        results_file.write('K00001,5\nK00002,7\nK99999,1\n')
+
+    def load():
+        return loader.load_uproc_kegg_results_from_file(
+            results_fp,
+            session_class=sa.orm.sessionmaker(bind=engine),
+            engine=engine,
+            kegg_annotation_ids={'K00001', 'K00002'})
+
+    def select_rows():
+        with engine.connect() as connection:
+            return [
+                tuple(row)
+                for row
+                in connection.execute(sa.text(
+                    'select uproc_kegg_result_id, kegg_annotation_id, read_count '
+                    'from uproc_kegg_result order by kegg_annotation_id'))]
+
+    assert load() == 2
+    rows = select_rows()
+    assert [row[1:] for row in rows] == [('K00001', 5), ('K00002', 7)]
+    load()
+    assert select_rows() == rows
+
+    # a changed read count updates the existing row, as ON DUPLICATE KEY UPDATE does on MySQL
+    with open(results_fp, 'wt') as results_file:
+        results_file.write('K00001,6\nK00002,7\n')
+    load()
+    assert select_rows() == [(rows[0][0], 'K00001', 6), rows[1]]
+
+
+def test_unique_key_is_required(tmpdir):
+    engine = create_test_db(tmpdir, unique_key=False)
+    with pytest.raises(Exception):
+        loader.check_uproc_kegg_result_unique_key(engine)
+
+    loader.add_uproc_kegg_result_unique_key(engine)
+    loader.check_uproc_kegg_result_unique_key(engine)
+
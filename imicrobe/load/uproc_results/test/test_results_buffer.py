@@ -0,0 +1,62 @@
+import gzip
+import os
+import re
+
+from imicrobe.load.uproc.results import uproc_kegg_results_file_name_re
+from imicrobe.load.uproc_results.results_buffer import scan_uproc_results_tree, scandir_files
+
+
+def write_results(fp, content):
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with open(fp, 'wb') as f:
+        f.write(content)
+
+
+def test_scan_uproc_results_tree(tmpdir):
+    dir_root = str(tmpdir.join('projects'))
+    write_results(os.path.join(dir_root, '1', 'samples', '1', 'a.uproc.kegg'), b'K00001,5\nK00002,7\n')
+    write_results(os.path.join(dir_root, '1', 'samples', '2', 'b.uproc.kegg'), gzip.compress(b'K00002,1\n'))
+    write_results(os.path.join(dir_root, '1', 'samples', '2', 'b.uproc.pfam28'), b'PF00001,1\n')
+    write_results(os.path.join(dir_root, '2', 'samples', '3', 'c.uproc.kegg'), b'K00003,2\nK00001,3\n')
+
+    spill_dp = str(tmpdir.join('spill'))
+    os.makedirs(spill_dp)
+    with scan_uproc_results_tree(
+            dir_root, re.compile(r'\.uproc\.kegg$'), workers=2, spill_dp=spill_dp, spill_size=20) as results_buffer:
+        assert len(results_buffer) == 5
+        assert sorted(results_buffer.accessions) == ['K00001', 'K00002', 'K00003']
+        assert len(results_buffer.spill_fps) > 0
+        # files parsed in worker processes are added in the order they were listed
+        assert [os.path.relpath(fp, dir_root) for fp in results_buffer.file_paths] == \
+            ['1/samples/1/a.uproc.kegg', '1/samples/2/b.uproc.kegg', '2/samples/3/c.uproc.kegg']
+
+        files = {
+            os.path.relpath(fp, dir_root): (accessions, read_counts.tolist())
+            for fp, accessions, read_counts
+            in results_buffer.iter_files()}
+
+    assert files == {
+        '1/samples/1/a.uproc.kegg': (['K00001', 'K00002'], [5, 7]),
+        '1/samples/2/b.uproc.kegg': (['K00002'], [1]),
+        '2/samples/3/c.uproc.kegg': (['K00003', 'K00001'], [2, 3])}
+    assert os.listdir(spill_dp) == []
+
+
+def test_scan_gzipped_uproc_kegg_results(tmpdir):
+    dir_root = str(tmpdir.join('projects'))
+    write_results(os.path.join(dir_root, '1', 'samples', '1', 'a.uproc.kegg'), b'K00001,5\n')
+    write_results(os.path.join(dir_root, '1', 'samples', '2', 'b.uproc.kegg.gz'), gzip.compress(b'K00002,1\n'))
+    write_results(os.path.join(dir_root, '1', 'samples', '2', 'b.uproc.kegg.gz.tmp'), b'K00003,1\n')
+
+    assert sorted([os.path.relpath(fp, dir_root) for fp in scandir_files(dir_root, uproc_kegg_results_file_name_re)]) == \
+        ['1/samples/1/a.uproc.kegg', '1/samples/2/b.uproc.kegg.gz']
+
+    with scan_uproc_results_tree(dir_root, uproc_kegg_results_file_name_re, workers=2) as results_buffer:
+        files = {
+            os.path.relpath(fp, dir_root): (accessions, read_counts.tolist())
+            for fp, accessions, read_counts
+            in results_buffer.iter_files()}
+
+    assert files == {
+        '1/samples/1/a.uproc.kegg': (['K00001'], [5]),
+        '1/samples/2/b.uproc.kegg.gz': (['K00002'], [1])}
@@ -0,0 +1,42 @@
+import sqlalchemy as sa
+
+from imicrobe.load.uproc_results.kegg.sample_file_index import \
+    get_sample_file_index, get_sample_file_key, get_sample_file_keys
+
+
+def test_get_sample_file_key():
+    sample_file_key = (3, '/iplant/home/shared/load/projects/1/samples/3/a.fasta.uproc.kegg')
+    assert get_sample_file_key('/data/projects/1/samples/3/a.fasta.uproc.kegg') == sample_file_key
+    assert get_sample_file_key('/data/projects/1/samples/3/a.fasta.uproc.kegg.gz') == sample_file_key
+
+    results_fp_to_sample_file_key, unresolved_results_fps = get_sample_file_keys(
+        ['/data/projects/1/samples/3/a.fasta.uproc.kegg', '/data/projects/1/samples/misc/b.fasta.uproc.kegg'])
+    assert results_fp_to_sample_file_key == {'/data/projects/1/samples/3/a.fasta.uproc.kegg': sample_file_key}
+    assert unresolved_results_fps == ['/data/projects/1/samples/misc/b.fasta.uproc.kegg']
+
+
+def test_get_sample_file_index():
+    engine = sa.create_engine('sqlite://')
+    metadata = sa.MetaData()
+    sample_file_table = sa.Table(
+        'sample_file',
+        metadata,
+        sa.Column('sample_file_id', sa.Integer, primary_key=True),
+        sa.Column('sample_id', sa.Integer),
+        sa.Column('file', sa.String(200)))
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            sample_file_table.insert(),
+            [
+                {'sample_file_id': 10 + sample_id, 'sample_id': sample_id, 'file': 'sample_{}.fa'.format(sample_id)}
+                for sample_id
+                in range(5)])
+
+    # samples are queried two at a time
+    sample_file_index = get_sample_file_index(engine, sample_ids={0, 2, 3, 4, 99}, batch_size=2)
+    assert sample_file_index == {
+        (0, 'sample_0.fa'): 10,
+        (2, 'sample_2.fa'): 12,
+        (3, 'sample_3.fa'): 13,
+        (4, 'sample_4.fa'): 14}
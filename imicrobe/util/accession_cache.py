@@ -0,0 +1,161 @@
+"""
+A compact map of accession (such as 'K00001' or 'PF00001') to database id.
+
+Accessions are kept in a sorted NumPy bytes array with a parallel uint32 id array,
+about 20 bytes per accession instead of a few hundred for a dictionary of str to int.
+Lookups are binary searches and can be vectorized over many accessions at once.
+
+A cache can be saved to a directory and loaded with memory mapping, so worker
+processes share one copy of the arrays through the page cache instead of each
+querying the database and building its own.
+"""
+import os
+
+import numpy as np
+
+from imicrobe.util import take
+
+
+class AccessionIdCache:
+    """
+    Map accessions to ids. Supports the dictionary operations `in`, `[]`, `[]=`,
+    get, update, and len. Accessions added after the cache is built are kept in a
+    small dictionary and merged into the arrays when it grows.
+    """
+    merge_threshold = 4096
+
+    def __init__(self, accessions=(), ids=()):
+        """
+        :param accessions: sorted numpy bytes array or any sequence of str
+        :param ids: ids corresponding to accessions
+        """
+        if isinstance(accessions, np.ndarray) and accessions.dtype.kind == 'S':
+            self.accessions = accessions
+            self.ids = ids
+        else:
+            self.accessions = np.empty(0, dtype='S1')
+            self.ids = np.empty(0, dtype=np.uint32)
+            self.pending = dict(zip(accessions, ids))
+            self.merge()
+        self.pending = {}
+
+    @classmethod
+    def from_query(cls, query, batch_size=10000):
+        """Build a cache from a query returning (accession, id) rows, for example
+            session.query(Protein.accession, Protein.protein_id)
+        Rows are fetched and converted to arrays batch_size at a time so the whole
+        result is never held as Python objects.
+        """
+        accession_batches = [np.empty(0, dtype='S1')]
+        id_batches = [np.empty(0, dtype=np.uint32)]
+        rows = iter(query.yield_per(batch_size))
+        while True:
+            row_batch = take(batch_size, rows)
+            if len(row_batch) == 0:
+                break
+            accession_batches.append(np.array([accession.encode('ascii') for accession, _ in row_batch]))
+            id_batches.append(np.fromiter((id_ for _, id_ in row_batch), dtype=np.uint32, count=len(row_batch)))
+
+        accessions = np.concatenate(accession_batches)
+        ids = np.concatenate(id_batches)
+        order = np.argsort(accessions, kind='stable')
+        accessions = accessions[order]
+        ids = ids[order]
+        if len(accessions) > 0:
+            # keep the last row for a repeated accession, as a dictionary would
+            last = np.append(accessions[1:] != accessions[:-1], True)
+            accessions = accessions[last]
+            ids = ids[last]
+        return cls(accessions=accessions, ids=ids)
+
+    @classmethod
+    def load(cls, cache_dp, mmap=True):
+        """Load a cache written by save(). With mmap=True the arrays are memory mapped read-only."""
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            accessions=np.load(os.path.join(cache_dp, 'accessions.npy'), mmap_mode=mmap_mode),
+            ids=np.load(os.path.join(cache_dp, 'ids.npy'), mmap_mode=mmap_mode))
+
+    def save(self, cache_dp):
+        self.merge()
+        os.makedirs(cache_dp, exist_ok=True)
+        np.save(os.path.join(cache_dp, 'accessions.npy'), self.accessions)
+        np.save(os.path.join(cache_dp, 'ids.npy'), self.ids)
+
+    def merge(self):
+        """Merge pending accessions into the sorted arrays."""
+        if len(self.pending) == 0:
+            return
+
+        pending_accessions = np.array([a.encode('ascii') for a in self.pending])
+        pending_ids = np.fromiter(self.pending.values(), dtype=np.uint32, count=len(self.pending))
+
+        # pending accessions replace accessions already in the arrays
+        self.accessions, self.ids = self._without(pending_accessions)
+        accessions = np.concatenate((self.accessions, pending_accessions))
+        ids = np.concatenate((self.ids, pending_ids))
+        order = np.argsort(accessions, kind='stable')
+        self.accessions = accessions[order]
+        self.ids = ids[order]
+        self.pending = {}
+
+    def _without(self, accessions):
+        keep = np.ones(len(self.accessions), dtype=bool)
+        if len(self.accessions) > 0:
+            i = np.searchsorted(self.accessions, accessions)
+            i_ = np.minimum(i, len(self.accessions) - 1)
+            found = self.accessions[i_] == accessions
+            keep[i_[found]] = False
+        return self.accessions[keep], self.ids[keep]
+
+    def lookup(self, accessions):
+        """Look up many accessions at once.
+
+        :param accessions: sequence of str, for example a pandas.Index
+        :return: numpy int64 array of ids, -1 where an accession is not in the cache
+        """
+        self.merge()
+        keys = np.asarray(accessions, dtype=object).astype('S')
+        found_ids = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.accessions) > 0 and len(keys) > 0:
+            i = np.searchsorted(self.accessions, keys)
+            i_ = np.minimum(i, len(self.accessions) - 1)
+            found = self.accessions[i_] == keys
+            found_ids[found] = self.ids[i_[found]]
+
+        return found_ids
+
+    def get(self, accession, default=None):
+        if accession in self.pending:
+            return self.pending[accession]
+        elif len(self.accessions) == 0:
+            return default
+        key = accession.encode('ascii')
+        i = np.searchsorted(self.accessions, key)
+        if i < len(self.accessions) and self.accessions[i] == key:
+            return int(self.ids[i])
+        else:
+            return default
+
+    def __contains__(self, accession):
+        return self.get(accession) is not None
+
+    def __getitem__(self, accession):
+        id_ = self.get(accession)
+        if id_ is None:
+            raise KeyError(accession)
+        return id_
+
+    def __setitem__(self, accession, id_):
+        self.pending[accession] = id_
+        if len(self.pending) >= self.merge_threshold:
+            self.merge()
+
+    def update(self, accession_ids):
+        self.pending.update(accession_ids)
+        if len(self.pending) >= self.merge_threshold:
+            self.merge()
+
+    def __len__(self):
+        self.merge()
+        return len(self.accessions)
@@ -0,0 +1,221 @@
+"""
+Benchmark the iRODS call patterns of the loaders against a fake data store
+(see imicrobe.util.fake_irods) with injected per-call latency.
+
+Each benchmark times the original call pattern (the baseline) and the current one:
+    listing  - one request per project and per sample vs. get_project_sample_data_objects
+    exists   - irods_data_object_exists per file vs. irods_paths_exist
+    read     - read every file serially on one session vs. concurrently with pooled sessions
+    put      - a new session, an existence check, and a put per file vs. put_files
+    write    - exists, unlink, create, and write per file vs. irods_write_data_objects
+
+    python -m imicrobe.util.benchmark_irods --projects 5 --samples 20 --latency 0.005
+
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+from imicrobe.util import irods
+from imicrobe.util.fake_irods import use_fake_irods
+from imicrobe.util.irods_transfer import put_files
+
+
+projects_collection_path = '/iplant/home/shared/imicrobe/projects'
+
+
+def build_fake_projects(root_dp, project_count, sample_count, file_count, file_size):
+    """Write project_count projects with sample_count samples each and file_count
+    UProC results files of file_size bytes in each sample.
+
+    :return: list of data object paths
+    """
+    data_object_paths = []
+    for p in range(project_count):
+        for s in range(sample_count):
+            sample_collection_path = os.path.join(projects_collection_path, str(p), 'samples', str(p*sample_count + s))
+            sample_dp = os.path.join(root_dp, sample_collection_path.lstrip('/'))
+            os.makedirs(sample_dp, exist_ok=True)
+            for f in range(file_count):
+                data_object_path = os.path.join(sample_collection_path, 'reads_{}.uproc.kegg'.format(f))
+                with open(os.path.join(root_dp, data_object_path.lstrip('/')), 'wb') as data_object_file:
+                    data_object_file.write(b'K00001,1\n' * (file_size // 9))
+                data_object_paths.append(data_object_path)
+    return data_object_paths
+
+
+def list_per_sample():
+    data_object_count = 0
+    project_to_sample_paths = irods.get_project_sample_collection_paths(collection_root=projects_collection_path)
+    with irods.irods_session_manager() as irods_session:
+        for project_path, sample_paths in project_to_sample_paths.items():
+            for sample_path in sample_paths:
+                data_object_count += len(irods_session.collections.get(sample_path).data_objects)
+    return data_object_count
+
+
+def list_in_bulk():
+    project_to_sample_data_objects = irods.get_project_sample_data_objects(collection_root=projects_collection_path)
+    return sum([len(d) for s in project_to_sample_data_objects.values() for d in s.values()])
+
+
+def exists_per_file(paths):
+    with irods.irods_session_manager() as irods_session:
+        return len([p for p in paths if irods.irods_data_object_exists(irods_session, p)])
+
+
+def exists_in_bulk(paths):
+    with irods.irods_session_manager() as irods_session:
+        return len(irods.irods_paths_exist(irods_session, paths))
+
+
+def read_serially(paths):
+    byte_count = 0
+    with irods.irods_session_manager() as irods_session:
+        for path in paths:
+            with irods_session.data_objects.open(path, 'r') as data_object_file:
+                byte_count += len(data_object_file.read())
+    return byte_count
+
+
+def read_concurrently(paths, jobs):
+    def read(path):
+        with irods.irods_session_manager() as irods_session:
+            with irods_session.data_objects.open(path, 'r') as data_object_file:
+                return len(data_object_file.read())
+
+    irods.irods_session_pool().ensure_max_size(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return sum(executor.map(read, paths))
+
+
+def put_per_file_session(fake_irods, src_to_dest_paths):
+    for src_path, dest_path in sorted(src_to_dest_paths.items()):
+        with fake_irods.session() as irods_session:
+            if not irods.irods_data_object_exists(irods_session, dest_path):
+                irods.irods_put(irods_session, src_path, dest_path)
+    return len(src_to_dest_paths)
+
+
+def write_with_delete(dest_path_to_content):
+    with irods.irods_session_manager() as irods_session:
+        for dest_path, content in sorted(dest_path_to_content.items()):
+            if irods.irods_data_object_exists(irods_session, dest_path):
+                irods.irods_delete(irods_session, dest_path)
+            target_obj = irods_session.data_objects.create(dest_path)
+            with target_obj.open('r+') as target:
+                target.write(content.encode('utf-8'))
+    return len(dest_path_to_content)
+
+
+def time_call(fake_irods, f, *args):
+    fake_irods.reset_call_counts()
+    t0 = time.time()
+    result = f(*args)
+    return time.time() - t0, sum(fake_irods.call_counts.values()), result
+
+
+def run_benchmarks(root_dp, project_count, sample_count, file_count, file_size, latency, connect_latency, jobs):
+    """Build a fake data store in root_dp and run each benchmark.
+
+    :return: list of (benchmark name, baseline seconds, baseline round trips, seconds, round trips)
+    """
+    data_object_paths = build_fake_projects(root_dp, project_count, sample_count, file_count, file_size)
+
+    # local files to put and the collection they are put in
+    local_dp = os.path.join(root_dp, 'local')
+    os.makedirs(local_dp)
+    put_collection_path = '/iplant/home/shared/imicrobe/put'
+    os.makedirs(os.path.join(root_dp, put_collection_path.lstrip('/')))
+    src_to_dest_paths = {}
+    for data_object_path in data_object_paths:
+        local_fp = os.path.join(local_dp, data_object_path.replace('/', '_'))
+        with open(local_fp, 'wb') as local_file:
+            local_file.write(b'K00002,2\n' * (file_size // 9))
+        src_to_dest_paths[local_fp] = os.path.join(put_collection_path, os.path.basename(local_fp))
+
+    dest_path_to_content = {
+        dest_path + '.json': '{"sample": "' + dest_path + '"}'
+        for dest_path
+        in src_to_dest_paths.values()}
+
+    results = []
+    with use_fake_irods(root_dp, latency=latency, connect_latency=connect_latency) as fake_irods:
+        def compare(benchmark_name, baseline, optimized, reset=None):
+            baseline_time, baseline_calls, baseline_result = time_call(fake_irods, *baseline)
+            if reset is not None:
+                reset()
+            optimized_time, optimized_calls, optimized_result = time_call(fake_irods, *optimized)
+            if baseline_result != optimized_result:
+                raise Exception('benchmark "{}" results differ: {} and {}'.format(
+                    benchmark_name, baseline_result, optimized_result))
+            results.append((benchmark_name, baseline_time, baseline_calls, optimized_time, optimized_calls))
+
+        def remove_put_data_objects():
+            for dest_path in src_to_dest_paths.values():
+                os.remove(os.path.join(root_dp, dest_path.lstrip('/')))
+
+        compare('listing', (list_per_sample, ), (list_in_bulk, ))
+        compare('exists', (exists_per_file, data_object_paths), (exists_in_bulk, data_object_paths))
+        compare('read', (read_serially, data_object_paths), (read_concurrently, data_object_paths, jobs))
+        compare(
+            'put',
+            (put_per_file_session, fake_irods, src_to_dest_paths),
+            (lambda: put_files(src_to_dest_paths, jobs=jobs).file_count, ),
+            reset=remove_put_data_objects)
+        compare(
+            'write',
+            (write_with_delete, dest_path_to_content),
+            (lambda: len(dest_path_to_content) - len(irods.irods_write_data_objects(dest_path_to_content, jobs=jobs)), ))
+
+    return results
+
+
+def print_results(results):
+    print('{:<10}{:>14}{:>10}{:>14}{:>10}{:>10}'.format(
+        'benchmark', 'baseline (s)', 'calls', 'current (s)', 'calls', 'speedup'))
+    for benchmark_name, baseline_time, baseline_calls, optimized_time, optimized_calls in results:
+        print('{:<10}{:>14.3f}{:>10}{:>14.3f}{:>10}{:>9.1f}x'.format(
+            benchmark_name,
+            baseline_time,
+            baseline_calls,
+            optimized_time,
+            optimized_calls,
+            baseline_time / max(optimized_time, 1e-9)))
+
+
+def get_args(argv):
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--projects', type=int, default=5, help='number of projects')
+    arg_parser.add_argument('--samples', type=int, default=20, help='number of samples per project')
+    arg_parser.add_argument('--files', type=int, default=2, help='number of files per sample')
+    arg_parser.add_argument('--file-size', type=int, default=10000, help='bytes per file')
+    arg_parser.add_argument('--latency', type=float, default=0.005, help='seconds per fake iRODS call')
+    arg_parser.add_argument('--connect-latency', type=float, default=0.05, help='seconds per fake iRODS session')
+    arg_parser.add_argument('--jobs', type=int, default=8, help='number of concurrent reads, puts, and writes')
+
+    args = arg_parser.parse_args(args=argv)
+
+    return args
+
+
+def main(argv):
+    args = get_args(argv)
+
+    with tempfile.TemporaryDirectory() as root_dp:
+        print_results(run_benchmarks(
+            root_dp,
+            project_count=args.projects,
+            sample_count=args.samples,
+            file_count=args.files,
+            file_size=args.file_size,
+            latency=args.latency,
+            connect_latency=args.connect_latency,
+            jobs=args.jobs))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,331 @@
+"""
+An in-process stand-in for an iRODS data store backed by a local directory tree.
+
+FakeIrodsSession has the parts of the python-irodsclient iRODSSession surface used by
+this package (collections, data_objects, and query over collection and data object
+names, sizes, checksums, and modify times) so the iRODS code paths can be tested and
+benchmarked without a live data store. The iRODS path /a/b/c is the local path
+<root_dp>/a/b/c.
+
+Every call that would be a round trip to a real data store sleeps for `latency`
+seconds and is counted in call_counts. Creating a session sleeps for
+`connect_latency` seconds, standing in for connection and authentication.
+
+Use the fake for everything that goes through imicrobe.util.irods.irods_session_manager:
+
+    with use_fake_irods(root_dp, latency=0.01) as fake_irods:
+        ...
+        print(fake_irods.call_counts)
+
+"""
+import base64
+import collections
+import contextlib
+import datetime
+import fnmatch
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from irods.exception import CAT_NO_ROWS_FOUND, CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.models import Collection, DataObject
+
+import imicrobe.util.irods as irods
+
+
+class FakeIrods:
+    """
+    State shared by all sessions of one fake data store: the local root directory,
+    the injected latency, and call counts.
+    """
+    def __init__(self, root_dp, latency=0.0, connect_latency=0.0, zone='fakeZone'):
+        self.root_dp = os.path.abspath(root_dp)
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.zone = zone
+        self.lock = threading.Lock()
+        self.call_counts = collections.Counter()
+
+    def session(self):
+        return FakeIrodsSession(self)
+
+    def call(self, call_name):
+        with self.lock:
+            self.call_counts[call_name] += 1
+        if self.latency > 0.0:
+            time.sleep(self.latency)
+
+    def local_path(self, irods_path):
+        return os.path.join(self.root_dp, irods_path.lstrip('/'))
+
+    def irods_path(self, local_path):
+        return '/' + os.path.relpath(local_path, self.root_dp).replace(os.sep, '/')
+
+    def reset_call_counts(self):
+        with self.lock:
+            self.call_counts.clear()
+
+
+class FakeIrodsSession:
+    def __init__(self, fake_irods):
+        self.fake_irods = fake_irods
+        self.zone = fake_irods.zone
+        self.collections = FakeCollectionManager(fake_irods)
+        self.data_objects = FakeDataObjectManager(fake_irods)
+        fake_irods.call('connect')
+        if fake_irods.connect_latency > 0.0:
+            time.sleep(fake_irods.connect_latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
+
+    def cleanup(self):
+        pass
+
+    def query(self, *columns):
+        return FakeQuery(self.fake_irods, columns)
+
+
+class FakeCollection:
+    def __init__(self, fake_irods, path):
+        self.fake_irods = fake_irods
+        self.path = path
+        self.name = os.path.basename(path)
+
+    @property
+    def subcollections(self):
+        self.fake_irods.call('collection.subcollections')
+        local_dp = self.fake_irods.local_path(self.path)
+        return [
+            FakeCollection(self.fake_irods, os.path.join(self.path, entry.name))
+            for entry
+            in sorted(os.scandir(local_dp), key=lambda e: e.name)
+            if entry.is_dir()]
+
+    @property
+    def data_objects(self):
+        self.fake_irods.call('collection.data_objects')
+        local_dp = self.fake_irods.local_path(self.path)
+        return [
+            FakeDataObject(self.fake_irods, os.path.join(self.path, entry.name))
+            for entry
+            in sorted(os.scandir(local_dp), key=lambda e: e.name)
+            if entry.is_file()]
+
+
+class FakeDataObject:
+    def __init__(self, fake_irods, path):
+        self.fake_irods = fake_irods
+        self.path = path
+        self.name = os.path.basename(path)
+        local_stat = os.stat(fake_irods.local_path(path))
+        self.size = local_stat.st_size
+        # python-irodsclient returns naive UTC datetimes
+        self.modify_time = datetime.datetime.fromtimestamp(
+            int(local_stat.st_mtime), datetime.timezone.utc).replace(tzinfo=None)
+
+    @property
+    def checksum(self):
+        return fake_checksum(self.fake_irods.local_path(self.path))
+
+    def open(self, mode='r', **options):
+        self.fake_irods.call('data_object.open')
+        return open_local_file(self.fake_irods.local_path(self.path), mode)
+
+
+class FakeCollectionManager:
+    def __init__(self, fake_irods):
+        self.fake_irods = fake_irods
+
+    def get(self, path):
+        self.fake_irods.call('collections.get')
+        if os.path.isdir(self.fake_irods.local_path(path)):
+            return FakeCollection(self.fake_irods, path)
+        else:
+            raise CollectionDoesNotExist(path)
+
+    def exists(self, path):
+        self.fake_irods.call('collections.exists')
+        return os.path.isdir(self.fake_irods.local_path(path))
+
+    def create(self, path):
+        self.fake_irods.call('collections.create')
+        os.makedirs(self.fake_irods.local_path(path), exist_ok=True)
+        return FakeCollection(self.fake_irods, path)
+
+    def remove(self, path, recurse=True, force=False, **options):
+        self.fake_irods.call('collections.remove')
+        local_dp = self.fake_irods.local_path(path)
+        if not os.path.isdir(local_dp):
+            raise CAT_NO_ROWS_FOUND(path)
+        shutil.rmtree(local_dp)
+
+
+class FakeDataObjectManager:
+    def __init__(self, fake_irods):
+        self.fake_irods = fake_irods
+
+    def _check_collection(self, path):
+        if not os.path.isdir(os.path.dirname(self.fake_irods.local_path(path))):
+            raise CollectionDoesNotExist(os.path.dirname(path))
+
+    def get(self, path):
+        self.fake_irods.call('data_objects.get')
+        self._check_collection(path)
+        if os.path.isfile(self.fake_irods.local_path(path)):
+            return FakeDataObject(self.fake_irods, path)
+        else:
+            raise DataObjectDoesNotExist(path)
+
+    def exists(self, path):
+        self.fake_irods.call('data_objects.exists')
+        return os.path.isfile(self.fake_irods.local_path(path))
+
+    def create(self, path, **options):
+        self.fake_irods.call('data_objects.create')
+        self._check_collection(path)
+        open(self.fake_irods.local_path(path), 'wb').close()
+        return FakeDataObject(self.fake_irods, path)
+
+    def open(self, path, mode, create=True, **options):
+        self.fake_irods.call('data_objects.open')
+        self._check_collection(path)
+        local_fp = self.fake_irods.local_path(path)
+        if not os.path.isfile(local_fp) and (mode.startswith('r') or not create):
+            raise DataObjectDoesNotExist(path)
+        return open_local_file(local_fp, mode)
+
+    def put(self, local_path, irods_path, return_data_object=False, num_threads=0, **options):
+        self.fake_irods.call('data_objects.put')
+        self._check_collection(irods_path)
+        shutil.copyfile(local_path, self.fake_irods.local_path(irods_path))
+        if return_data_object:
+            return FakeDataObject(self.fake_irods, irods_path)
+
+    def copy(self, src_path, dest_path, **options):
+        self.fake_irods.call('data_objects.copy')
+        self._check_collection(dest_path)
+        if not os.path.isfile(self.fake_irods.local_path(src_path)):
+            raise DataObjectDoesNotExist(src_path)
+        shutil.copyfile(self.fake_irods.local_path(src_path), self.fake_irods.local_path(dest_path))
+
+    def unlink(self, path, force=False, **options):
+        self.fake_irods.call('data_objects.unlink')
+        local_fp = self.fake_irods.local_path(path)
+        if not os.path.isfile(local_fp):
+            raise CAT_NO_ROWS_FOUND(path)
+        os.remove(local_fp)
+
+    def chksum(self, path, **options):
+        self.fake_irods.call('data_objects.chksum')
+        local_fp = self.fake_irods.local_path(path)
+        if not os.path.isfile(local_fp):
+            raise DataObjectDoesNotExist(path)
+        return fake_checksum(local_fp)
+
+
+class FakeQuery:
+    """
+    Supports queries over Collection.name and DataObject name, size, checksum, and
+    modify_time with '=', 'like', and 'in' criteria. Results come in pages of page_size rows.
+    """
+    page_size = 500
+
+    def __init__(self, fake_irods, columns, criteria=()):
+        self.fake_irods = fake_irods
+        self.columns = columns
+        self.criteria = list(criteria)
+
+    def filter(self, *criteria):
+        return FakeQuery(self.fake_irods, self.columns, self.criteria + list(criteria))
+
+    def get_batches(self):
+        rows = list(self._rows())
+        for page_start in range(0, max(len(rows), 1), self.page_size):
+            # each page is one round trip
+            self.fake_irods.call('query')
+            yield rows[page_start:page_start+self.page_size]
+
+    def get_results(self):
+        for result_set in self.get_batches():
+            yield from result_set
+
+    def all(self):
+        return list(self.get_results())
+
+    def _matches(self, row):
+        for criterion in self.criteria:
+            value = row[criterion.query_key]
+            if criterion.op == '=' and value != criterion.value:
+                return False
+            elif criterion.op == 'like' and not fnmatch.fnmatchcase(value, criterion.value.replace('%', '*')):
+                return False
+            elif criterion.op == 'in' and value not in criterion.value:
+                return False
+        return True
+
+    def _rows(self):
+        include_data_objects = any([c in (DataObject.name, DataObject.size, DataObject.checksum, DataObject.modify_time)
+                                    for c in self.columns])
+        for local_dp, dir_names, file_names in os.walk(self.fake_irods.root_dp):
+            dir_names.sort()
+            collection_path = self.fake_irods.irods_path(local_dp)
+            if not include_data_objects:
+                row = {Collection.name: collection_path}
+                if self._matches(row):
+                    yield {column: row[column] for column in self.columns}
+            else:
+                for file_name in sorted(file_names):
+                    row = {Collection.name: collection_path, DataObject.name: file_name}
+                    if self._matches(row):
+                        data_object = FakeDataObject(self.fake_irods, os.path.join(collection_path, file_name))
+                        row.update({
+                            DataObject.size: data_object.size,
+                            DataObject.checksum: data_object.checksum,
+                            DataObject.modify_time: data_object.modify_time})
+                        yield {column: row[column] for column in self.columns}
+
+
+def fake_checksum(local_fp):
+    """Return a checksum of a local file in the iRODS 'sha2:<base64>' format."""
+    file_hash = hashlib.sha256()
+    with open(local_fp, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return 'sha2:' + base64.b64encode(file_hash.digest()).decode('ascii')
+
+
+def open_local_file(local_fp, mode):
+    # iRODS data objects are always opened in binary mode
+    if mode.startswith('r+'):
+        return open(local_fp, 'r+b')
+    elif mode.startswith('r'):
+        return open(local_fp, 'rb')
+    elif mode.startswith('w'):
+        return open(local_fp, 'wb')
+    elif mode.startswith('a'):
+        return open(local_fp, 'ab')
+    else:
+        raise Exception('unsupported mode "{}"'.format(mode))
+
+
+@contextlib.contextmanager
+def use_fake_irods(root_dp, latency=0.0, connect_latency=0.0, max_pool_size=8):
+    """Replace the process-wide iRODS session pool with a pool of FakeIrodsSessions
+    for the duration of the with block.
+
+    :return: FakeIrods
+    """
+    fake_irods = FakeIrods(root_dp, latency=latency, connect_latency=connect_latency)
+    fake_pool = irods.IrodsSessionPool(max_size=max_pool_size, session_factory=fake_irods.session)
+    previous_pool = irods.set_irods_session_pool(fake_pool)
+    try:
+        yield fake_irods
+    finally:
+        fake_pool.close()
+        irods.set_irods_session_pool(previous_pool)
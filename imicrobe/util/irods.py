@@ -1,16 +1,208 @@
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import heapq
 import os
+import threading
+import time
 
-from imicrobe.util import take
+from imicrobe.util import grouper, take
 
+from irods.column import In, Like
 from irods.keywords import FORCE_FLAG_KW
+from irods.models import Collection, DataObject
 from irods.session import iRODSSession
-from irods.exception import CAT_NO_ROWS_FOUND, CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.exception import CAT_NO_ROWS_FOUND, CollectionDoesNotExist, DataObjectDoesNotExist, NetworkException
 
 
-def irods_session_manager():
+# a data object as listed by a catalog query
+IrodsDataObjectInfo = collections.namedtuple(
+    'IrodsDataObjectInfo',
+    ['path', 'name', 'size', 'checksum', 'modify_time'])
+
+# a collection as yielded by walk
+IrodsCollectionInfo = collections.namedtuple('IrodsCollectionInfo', ['path', 'name'])
+
+
+def new_irods_session():
     return iRODSSession(irods_env_file=os.path.expanduser('~/.irods/irods_environment.json'))
 
 
+class IrodsSessionPool:
+    """
+    A thread-safe pool of iRODS sessions so bulk jobs authenticate once per session rather
+    than once per operation. Use it like this:
+
+        with irods_session_pool.session() as irods_session:
+            ...
+
+    At most max_size sessions are open at one time; checkout blocks until a session is returned.
+    A session that has been idle longer than health_check_interval seconds is checked with a
+    small catalog query before it is handed out, and a session idle longer than max_idle_time
+    seconds is closed. A session is discarded if the block using it raises a NetworkException.
+    """
+
+    def __init__(self, max_size=8, max_idle_time=300, health_check_interval=60, session_factory=new_irods_session):
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.health_check_interval = health_check_interval
+        self.session_factory = session_factory
+
+        self.condition = threading.Condition()
+        # (time returned, session) most recently returned last
+        self.idle_sessions = []
+        self.open_session_count = 0
+        self.created_session_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        irods_session = self.checkout()
+        try:
+            yield irods_session
+        except NetworkException:
+            self.checkin(irods_session, healthy=False)
+            raise
+        except BaseException:
+            self.checkin(irods_session)
+            raise
+        else:
+            self.checkin(irods_session)
+
+    def checkout(self, timeout=None):
+        """Return an idle session or a new session, waiting up to timeout seconds
+        (None to wait indefinitely) if max_size sessions are checked out.
+        """
+        with self.condition:
+            evicted_sessions = self._evict_idle_sessions()
+            while len(self.idle_sessions) == 0 and self.open_session_count >= self.max_size:
+                if not self.condition.wait(timeout=timeout):
+                    raise Exception('no iRODS session was returned to the pool within {}s'.format(timeout))
+            if len(self.idle_sessions) > 0:
+                returned_time, irods_session = self.idle_sessions.pop()
+            else:
+                returned_time, irods_session = None, None
+                self.open_session_count += 1
+
+        for evicted_session in evicted_sessions:
+            self._cleanup(evicted_session)
+
+        if irods_session is not None and time.time() - returned_time > self.health_check_interval:
+            if not self._is_healthy(irods_session):
+                # keep the pool slot for the replacement session
+                self._cleanup(irods_session)
+                irods_session = None
+
+        if irods_session is None:
+            try:
+                irods_session = self.session_factory()
+            except BaseException:
+                with self.condition:
+                    self.open_session_count -= 1
+                    self.condition.notify()
+                raise
+            with self.condition:
+                self.created_session_count += 1
+
+        return irods_session
+
+    def ensure_max_size(self, max_size):
+        """Allow at least max_size sessions, for example one per worker thread."""
+        with self.condition:
+            if self.max_size < max_size:
+                self.max_size = max_size
+                self.condition.notify_all()
+
+    def checkin(self, irods_session, healthy=True):
+        if healthy:
+            with self.condition:
+                self.idle_sessions.append((time.time(), irods_session))
+                self.condition.notify()
+        else:
+            self._discard(irods_session)
+
+    def close(self):
+        with self.condition:
+            idle_sessions = self.idle_sessions
+            self.idle_sessions = []
+        for _, irods_session in idle_sessions:
+            self._discard(irods_session)
+
+    def _evict_idle_sessions(self):
+        # call with self.condition held, return the evicted sessions to be cleaned up
+        now = time.time()
+        evicted_sessions = [s for t, s in self.idle_sessions if now - t > self.max_idle_time]
+        if len(evicted_sessions) > 0:
+            self.idle_sessions = [(t, s) for t, s in self.idle_sessions if now - t <= self.max_idle_time]
+            self.open_session_count -= len(evicted_sessions)
+        return evicted_sessions
+
+    def _discard(self, irods_session):
+        self._cleanup(irods_session)
+        with self.condition:
+            self.open_session_count -= 1
+            self.condition.notify()
+
+    @staticmethod
+    def _cleanup(irods_session):
+        try:
+            irods_session.cleanup()
+        except Exception as e:
+            print('failed to clean up iRODS session: {}'.format(e))
+
+    @staticmethod
+    def _is_healthy(irods_session):
+        try:
+            irods_session.collections.get('/{}'.format(irods_session.zone))
+            return True
+        except Exception:
+            return False
+
+
+_irods_session_pool = None
+_irods_session_pool_lock = threading.Lock()
+
+
+def irods_session_pool():
+    """Return the process-wide IrodsSessionPool, creating it on first use."""
+    global _irods_session_pool
+    with _irods_session_pool_lock:
+        if _irods_session_pool is None:
+            _irods_session_pool = IrodsSessionPool()
+            atexit.register(_irods_session_pool.close)
+        return _irods_session_pool
+
+
+def set_irods_session_pool(pool):
+    """Replace the process-wide IrodsSessionPool, for example with a pool of fake sessions
+    (see imicrobe.util.fake_irods).
+
+    :return: the previous pool, which may be None
+    """
+    global _irods_session_pool
+    with _irods_session_pool_lock:
+        previous_pool = _irods_session_pool
+        _irods_session_pool = pool
+        return previous_pool
+
+
+def irods_session_manager():
+    """Check out a session from the process-wide pool. Use it like this:
+
+        with irods_session_manager() as irods_session:
+            ...
+
+    The session is returned to the pool rather than closed at the end of the block.
+    """
+    return irods_session_pool().session()
+
+
 def irods_collection_exists(irods_session, collection_path):
     try:
         irods_session.collections.get(collection_path)
@@ -54,15 +246,84 @@ def irods_data_object_checksums_match(irods_session, path_1, path_2):
     return data_object_1.checksum == data_object_2.checksum
 
 
-def irods_write_data_object(irods_session, dest_path, content):
-    if irods_data_object_exists(irods_session, dest_path):
-        irods_delete(irods_session, dest_path)
+def iter_content_chunks(content, chunk_size=1024 * 1024):
+    """Yield bytes from content in chunks of about chunk_size bytes.
+
+    :param content: str, bytes, a file-like object with a read method, or an iterable of str or bytes
+    """
+    if isinstance(content, (str, bytes)):
+        pieces = [content]
+    elif hasattr(content, 'read'):
+        pieces = iter(lambda: content.read(chunk_size), content.read(0))
     else:
-        pass
+        pieces = content
+
+    chunk = bytearray()
+    for piece in pieces:
+        chunk.extend(piece.encode('utf-8') if isinstance(piece, str) else piece)
+        while len(chunk) >= chunk_size:
+            yield bytes(chunk[:chunk_size])
+            del chunk[:chunk_size]
+    if len(chunk) > 0:
+        yield bytes(chunk)
+
+
+def irods_write_data_object(irods_session, dest_path, content, chunk_size=1024 * 1024):
+    """Write content to dest_path, replacing dest_path if it exists. Content is written
+    in chunks of chunk_size bytes so it is never encoded or held in memory all at once.
+
+    :param irods_session:
+    :param dest_path: data object path
+    :param content: str, bytes, a file-like object with a read method, or an iterable of str or bytes
+    :param chunk_size: bytes per write
+    :return: number of bytes written
+    """
+    byte_count = 0
+    # 'w' creates or truncates the data object so no separate exists check and delete are needed
+    with irods_session.data_objects.open(dest_path, 'w', **{FORCE_FLAG_KW: True}) as target:
+        for chunk in iter_content_chunks(content, chunk_size=chunk_size):
+            target.write(chunk)
+            byte_count += len(chunk)
+    return byte_count
+
+
+def irods_write_data_objects(dest_path_to_content, jobs=4, chunk_size=1024 * 1024):
+    """Write many data objects concurrently with sessions from the session pool.
+
+    :param dest_path_to_content: dictionary (or iterable of pairs) of data object paths to content
+        as accepted by irods_write_data_object, for example generators that produce content on demand
+    :param jobs: number of data objects written at the same time
+    :param chunk_size: bytes per write
+    :return: dictionary of data object paths that could not be written to exceptions
+    """
+    def write_data_object(dest_path, content):
+        with irods_session_manager() as irods_session:
+            return irods_write_data_object(irods_session, dest_path, content, chunk_size=chunk_size)
+
+    if hasattr(dest_path_to_content, 'items'):
+        dest_path_to_content = dest_path_to_content.items()
+
+    t0 = time.time()
+    byte_count = 0
+    failed_dest_paths = dict()
+    irods_session_pool().ensure_max_size(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        write_futures = {
+            executor.submit(write_data_object, dest_path, content): dest_path
+            for dest_path, content
+            in dest_path_to_content}
+        for write_future in concurrent.futures.as_completed(write_futures):
+            dest_path = write_futures[write_future]
+            try:
+                byte_count += write_future.result()
+            except Exception as e:
+                print('*** FAILED to write "{}"'.format(dest_path))
+                print(e)
+                failed_dest_paths[dest_path] = e
 
-    target_obj = irods_session.data_objects.create(dest_path)
-    with target_obj.open('r+') as target:
-        target.write(content.encode('utf-8'))
+    print('wrote {} data object(s) ({:.1f}MB) in {:5.2f}s, {} failed'.format(
+        len(write_futures) - len(failed_dest_paths), byte_count / 1e6, time.time()-t0, len(failed_dest_paths)))
+    return failed_dest_paths
 
 
 def irods_copy(irods_session, src_path, dest_path):
@@ -83,6 +344,58 @@ def irods_data_object_exists(irods_session, target_path):
         return False
 
 
+def irods_paths_exist(irods_session, paths, collection_batch_size=50):
+    """Check which of many data object paths exist with one catalog query per batch of
+    parent collections rather than one request per path.
+
+    :param irods_session:
+    :param paths: iterable of data object paths
+    :param collection_batch_size: number of parent collections per query
+    :return: dictionary of existing paths to IrodsDataObjectInfo, paths that do not exist are absent
+    """
+    collection_to_data_object_names = collections.defaultdict(set)
+    for path in paths:
+        collection_path, data_object_name = os.path.split(path)
+        collection_to_data_object_names[collection_path].add(data_object_name)
+
+    existing_paths = dict()
+    for collection_path_group in grouper(sorted(collection_to_data_object_names.keys()), n=collection_batch_size):
+        collection_path_list = [c for c in collection_path_group if c is not None]
+        data_object_query = irods_session.query(
+            Collection.name, DataObject.name, DataObject.size, DataObject.checksum, DataObject.modify_time).filter(
+                In(Collection.name, collection_path_list))
+        for result_set in data_object_query.get_batches():
+            for row in result_set:
+                if row[DataObject.name] in collection_to_data_object_names[row[Collection.name]]:
+                    data_object_path = os.path.join(row[Collection.name], row[DataObject.name])
+                    existing_paths[data_object_path] = IrodsDataObjectInfo(
+                        path=data_object_path,
+                        name=row[DataObject.name],
+                        size=row[DataObject.size],
+                        checksum=row[DataObject.checksum],
+                        modify_time=row[DataObject.modify_time])
+
+    return existing_paths
+
+
+def irods_collections_exist(irods_session, collection_paths, collection_batch_size=50):
+    """Check which of many collection paths exist with one catalog query per batch.
+
+    :param irods_session:
+    :param collection_paths: iterable of collection paths
+    :param collection_batch_size: number of collections per query
+    :return: set of existing collection paths
+    """
+    existing_collection_paths = set()
+    for collection_path_group in grouper(sorted(set(collection_paths)), n=collection_batch_size):
+        collection_query = irods_session.query(Collection.name).filter(
+            In(Collection.name, [c for c in collection_path_group if c is not None]))
+        for result_set in collection_query.get_batches():
+            existing_collection_paths.update([row[Collection.name] for row in result_set])
+
+    return existing_collection_paths
+
+
 def irods_delete(irods_session, target_path):
     try:
         irods_session.data_objects.unlink(path=target_path, force=True)
@@ -97,21 +410,131 @@ def irods_delete_collection(irods_session, target_collection_path):
         print('unable to delete collection "{}" because it does not exist'.format(target_collection_path))
 
 
-def walk(walk_root, verbose=False):
+def walk(walk_root, verbose=False, workers=1, ordered=True, max_in_flight=None):
+    """Walk the collection tree below walk_root yielding
+        (collection, subcollections, data_objects)
+    for each collection, including walk_root. The collection and subcollections are
+    IrodsCollectionInfo records and the data objects are IrodsDataObjectInfo records.
+    Records are yielded rather than iRODSCollection and iRODSDataObject objects because
+    the session that listed a collection is returned to the pool before it is yielded.
+
+    Collections are expanded (listed) by `workers` threads using sessions from the
+    process-wide session pool while results are yielded. At most max_in_flight expansions are
+    submitted at one time, so memory use does not grow with the size of the tree. An ordered walk
+    keeps the expansions of the next max_in_flight collections in path order in flight.
+
+    :param walk_root: path of the top collection
+    :param verbose: print the walk root
+    :param workers: number of threads expanding collections
+    :param ordered: if True collections are yielded in sorted path order for reproducible
+        behavior, otherwise in the order their expansions finish
+    :param max_in_flight: maximum number of pending expansions, default 4 * workers
+    """
     if verbose:
         print('walk root is "{}"'.format(walk_root))
 
-    with irods_session_manager() as irods_session:
-        collection_stack = list()
-        p = irods_session.collections.get(walk_root)
-        collection_stack.append(p)
-        while len(collection_stack) > 0:
-            parent_collection = collection_stack.pop(0)
-            yield parent_collection, parent_collection.subcollections, parent_collection.data_objects
-            for s in parent_collection.subcollections:
-                collection_stack.insert(0, s)
-            # keep the stack in sorted order for reproducible behavior
-            collection_stack.sort(key=lambda c: c.path)
+    if max_in_flight is None:
+        max_in_flight = 4 * workers
+
+    def expand_collection(collection_path):
+        with irods_session_manager() as irods_session:
+            collection = irods_session.collections.get(collection_path)
+            return (
+                IrodsCollectionInfo(path=collection.path, name=collection.name),
+                [
+                    IrodsCollectionInfo(path=s.path, name=s.name)
+                    for s
+                    in collection.subcollections],
+                [
+                    IrodsDataObjectInfo(
+                        path=d.path, name=d.name, size=d.size, checksum=d.checksum, modify_time=d.modify_time)
+                    for d
+                    in collection.data_objects])
+
+    # expansions that have not finished, cancelled if the walk is abandoned
+    pending_futures = set()
+
+    def submit_expansion(collection_path):
+        expansion_future = executor.submit(expand_collection, collection_path)
+        pending_futures.add(expansion_future)
+        expansion_future.add_done_callback(pending_futures.discard)
+        return expansion_future
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        if ordered:
+            walk_expansions = _walk_ordered(walk_root, submit_expansion, max_in_flight)
+        else:
+            walk_expansions = _walk_unordered(walk_root, submit_expansion, max_in_flight)
+        yield from walk_expansions
+    finally:
+        # ThreadPoolExecutor.shutdown has no cancel_futures before Python 3.9
+        for expansion_future in list(pending_futures):
+            expansion_future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _walk_ordered(walk_root, submit_expansion, max_in_flight):
+    # always yield the smallest collection path not yet yielded, as the original
+    # sorted stack did, and keep the expansions of the next max_in_flight collections
+    # to be yielded in flight
+    collection_path_heap = [walk_root]
+    # collection path to submitted expansion
+    prefetched = {}
+    # collection path to finished expansion, its subcollections are already on the heap
+    expanded = {}
+    while len(collection_path_heap) > 0:
+        # take finished expansions in any order so their subcollections can be prefetched
+        for collection_path in [p for p, f in prefetched.items() if f.done()]:
+            expansion = prefetched.pop(collection_path).result()
+            expanded[collection_path] = expansion
+            for subcollection in expansion[1]:
+                heapq.heappush(collection_path_heap, subcollection.path)
+
+        if collection_path_heap[0] in expanded:
+            yield expanded.pop(heapq.heappop(collection_path_heap))
+        else:
+            window = _heap_smallest(collection_path_heap, max_in_flight)
+            for collection_path in window:
+                if collection_path not in prefetched and collection_path not in expanded:
+                    prefetched[collection_path] = submit_expansion(collection_path)
+            # a new subcollection can push a prefetched collection out of the window,
+            # its expansion is submitted again when the collection is back in the window
+            window = set(window)
+            for collection_path in [p for p in prefetched if p not in window]:
+                prefetched.pop(collection_path).cancel()
+
+            concurrent.futures.wait(prefetched.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+
+
+def _heap_smallest(heap, count):
+    """Return the count smallest items of a heap in sorted order without modifying it.
+    This takes O(count log count) time where heapq.nsmallest takes O(len(heap)) time.
+    """
+    smallest = []
+    # (item, heap index) for the children of the items already taken
+    candidates = [(heap[0], 0)] if len(heap) > 0 else []
+    while len(candidates) > 0 and len(smallest) < count:
+        item, i = heapq.heappop(candidates)
+        smallest.append(item)
+        for child_i in (2 * i + 1, 2 * i + 2):
+            if child_i < len(heap):
+                heapq.heappush(candidates, (heap[child_i], child_i))
+    return smallest
+
+
+def _walk_unordered(walk_root, submit_expansion, max_in_flight):
+    # yield expansions as they finish
+    waiting_collection_paths = collections.deque([walk_root])
+    in_flight = set()
+    while len(waiting_collection_paths) > 0 or len(in_flight) > 0:
+        while len(waiting_collection_paths) > 0 and len(in_flight) < max_in_flight:
+            in_flight.add(submit_expansion(waiting_collection_paths.popleft()))
+        done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for expansion_future in done:
+            collection, subcollections, data_objects = expansion_future.result()
+            waiting_collection_paths.extend([s.path for s in subcollections])
+            yield collection, subcollections, data_objects
 
 
 def get_project_sample_collection_paths(
@@ -171,3 +594,87 @@ def get_project_sample_collection_paths(
                 pass
 
     return project_to_sample_collections
+
+
+def get_project_sample_data_objects(
+        collection_root='/iplant/home/shared/imicrobe/projects',
+        name_re=None,
+        sample_limit=None):
+    """Return an index of every project, sample, and sample data object under collection_root.
+
+    The index is built from two paginated catalog queries over collections named like
+    '<collection_root>/%/samples/%' rather than one request per project and per sample.
+    Only data objects directly in a sample collection are listed.
+
+    :param collection_root: the top of the collection tree to be searched
+    :param name_re: compiled regular expression, if not None list only data objects with
+        matching names (re.search is used)
+    :param sample_limit: maximum number of samples to return
+    :return: dictionary of project paths to dictionaries of sample paths to lists of
+        IrodsDataObjectInfo, all sorted by path, such as
+        {
+            '/project/alice': {
+                '/project/alice/samples/abe': [IrodsDataObjectInfo(path='/project/alice/samples/abe/abe.uproc.kegg', ...), ...],
+                '/project/alice/samples/aoife': [],
+                ...
+            },
+            ...
+        }
+    """
+    t0 = time.time()
+    collection_root = collection_root.rstrip('/')
+    sample_collection_name_like = collection_root + '/%/samples/%'
+
+    sample_collection_path_to_data_objects = collections.defaultdict(dict)
+    with irods_session_manager() as irods_session:
+        sample_collection_query = irods_session.query(Collection.name).filter(
+            Like(Collection.name, sample_collection_name_like))
+        for result_set in sample_collection_query.get_batches():
+            for row in result_set:
+                # the LIKE pattern also matches collections below the sample collections
+                if is_sample_collection_path(collection_root, row[Collection.name]):
+                    sample_collection_path_to_data_objects[row[Collection.name]]
+
+        data_object_query = irods_session.query(
+            Collection.name, DataObject.name, DataObject.size, DataObject.checksum, DataObject.modify_time).filter(
+                Like(Collection.name, sample_collection_name_like))
+        for result_set in data_object_query.get_batches():
+            for row in result_set:
+                if not is_sample_collection_path(collection_root, row[Collection.name]):
+                    pass
+                elif name_re is not None and name_re.search(row[DataObject.name]) is None:
+                    pass
+                else:
+                    # a data object with more than one replica is listed once per replica
+                    data_object_path = os.path.join(row[Collection.name], row[DataObject.name])
+                    sample_collection_path_to_data_objects[row[Collection.name]][data_object_path] = \
+                        IrodsDataObjectInfo(
+                            path=data_object_path,
+                            name=row[DataObject.name],
+                            size=row[DataObject.size],
+                            checksum=row[DataObject.checksum],
+                            modify_time=row[DataObject.modify_time])
+
+    project_to_sample_data_objects = dict()
+    for sample_collection_path in take(sample_limit, sorted(sample_collection_path_to_data_objects.keys())):
+        project_collection_path = os.path.dirname(os.path.dirname(sample_collection_path))
+        project_to_sample_data_objects.setdefault(project_collection_path, dict())[sample_collection_path] = [
+            data_object
+            for _, data_object
+            in sorted(sample_collection_path_to_data_objects[sample_collection_path].items())]
+
+    print('listed {} data object(s) in {} sample collection(s) of {} project(s) in {:5.2f}s'.format(
+        sum([len(d) for s in project_to_sample_data_objects.values() for d in s.values()]),
+        sum([len(s) for s in project_to_sample_data_objects.values()]),
+        len(project_to_sample_data_objects),
+        time.time()-t0))
+
+    return project_to_sample_data_objects
+
+
+def is_sample_collection_path(collection_root, collection_path):
+    """Return True if collection_path looks like <collection_root>/<project>/samples/<sample>."""
+    if not collection_path.startswith(collection_root + '/'):
+        return False
+    path_parts = collection_path[len(collection_root)+1:].split('/')
+    return len(path_parts) == 3 and path_parts[1] == 'samples' and all(path_parts)
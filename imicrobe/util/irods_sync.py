@@ -0,0 +1,311 @@
+"""
+Copy only the files that differ between a source and iRODS, like rsync.
+
+The target data objects are listed with a few batched catalog queries (see
+imicrobe.util.irods.irods_paths_exist), then each source is compared with its
+target by size, then by modification time, and checksums are compared only for files
+modified after their data object was written (or for every file with --compare checksum).
+iRODS checksums are 'sha2:<base64>' or hex MD5, and local checksums are computed in the
+same format.
+
+Hashing 100k local files on every run would take longer than most copies so local
+checksums are kept in a SQLite cache keyed by path, size, and modification time.
+A file is hashed again only if its size or modification time has changed.
+
+    python -m imicrobe.util.irods_sync --source-dir /work/.../projects --target-collection /iplant/.../projects
+
+"""
+import argparse
+import concurrent.futures
+import datetime
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from imicrobe.util.irods import irods_copy, irods_paths_exist, irods_session_manager, irods_session_pool
+from imicrobe.util.irods_transfer import local_file_irods_checksum, put_files
+
+
+def default_checksum_cache_fp():
+    return os.environ.get(
+        'IMICROBE_CHECKSUM_CACHE',
+        os.path.expanduser('~/.cache/imicrobe/local_checksums.sqlite3'))
+
+
+class LocalChecksumCache:
+    """
+    Checksums of local files keyed by path, size, and modification time. Safe to share between threads.
+    """
+    def __init__(self, cache_fp=None, flush_size=1000):
+        """
+        :param cache_fp: path to the SQLite file, default_checksum_cache_fp() if None
+        :param flush_size: number of new checksums held in memory before they are written
+        """
+        self.cache_fp = default_checksum_cache_fp() if cache_fp is None else cache_fp
+        self.flush_size = flush_size
+        self.lock = threading.Lock()
+        # (path, algorithm) -> row not yet written
+        self.new_rows = {}
+        self.hashed_count = 0
+        self.cached_count = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_fp)), exist_ok=True)
+        self.connection = sqlite3.connect(self.cache_fp, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("""
+                create table if not exists local_checksum (
+                    path text not null,
+                    algorithm text not null,
+                    size integer not null,
+                    mtime_ns integer not null,
+                    checksum text not null,
+                    primary key (path, algorithm)
+                )""")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+        print('local checksum cache: {} file(s) hashed, {} checksum(s) reused'.format(
+            self.hashed_count, self.cached_count))
+
+    def flush(self):
+        with self.lock:
+            new_rows = self.new_rows
+            self.new_rows = {}
+            with self.connection:
+                self.connection.executemany(
+                    'insert or replace into local_checksum values (?, ?, ?, ?, ?)', list(new_rows.values()))
+
+    def get_checksum(self, fp, irods_checksum_like):
+        """Return the checksum of a local file in the format of irods_checksum_like,
+        hashing the file only if it is not in the cache or has changed.
+        Has the same signature as imicrobe.util.irods_transfer.local_file_irods_checksum.
+        """
+        algorithm = 'sha2' if irods_checksum_like.startswith('sha2:') else 'md5'
+        path = os.path.abspath(fp)
+        fp_stat = os.stat(path)
+        with self.lock:
+            new_row = self.new_rows.get((path, algorithm))
+            if new_row is not None and new_row[2:4] == (fp_stat.st_size, fp_stat.st_mtime_ns):
+                row = new_row[4:]
+            else:
+                row = self.connection.execute(
+                    'select checksum from local_checksum '
+                    'where path = ? and algorithm = ? and size = ? and mtime_ns = ?',
+                    (path, algorithm, fp_stat.st_size, fp_stat.st_mtime_ns)).fetchone()
+            if row is not None:
+                self.cached_count += 1
+                return row[0]
+
+        checksum = local_file_irods_checksum(path, irods_checksum_like)
+        with self.lock:
+            self.hashed_count += 1
+            self.new_rows[(path, algorithm)] = (path, algorithm, fp_stat.st_size, fp_stat.st_mtime_ns, checksum)
+            flush = len(self.new_rows) >= self.flush_size
+        if flush:
+            self.flush()
+        return checksum
+
+
+def find_local_to_irods_differences(src_to_dest_paths, checksum_cache, compare='mtime', jobs=4):
+    """Return the part of src_to_dest_paths that must be copied.
+
+    Data objects written without a checksum cost one round trip each to checksum them,
+    so with compare='checksum' the first sync of a large tree can be slow. These checksums
+    are requested by `jobs` threads with sessions from the session pool.
+
+    :param src_to_dest_paths: dictionary of local file paths to iRODS data object paths
+    :param checksum_cache: LocalChecksumCache
+    :param compare: 'exists' to copy only missing data objects, 'size' to also copy data objects
+        with a different size, 'mtime' to also compare checksums of files modified after their
+        data object, 'checksum' to compare checksums of all files
+    :param jobs: number of data object checksums requested at the same time
+    :return: dictionary of local file paths to iRODS data object paths
+    """
+    t0 = time.time()
+    with irods_session_manager() as irods_session:
+        dest_manifest = irods_paths_exist(irods_session, src_to_dest_paths.values())
+
+    different_src_to_dest_paths = dict()
+    # (local file path, data object path, data object info) with the same size that must be compared by checksum
+    checksum_comparisons = []
+    for src_path, dest_path in sorted(src_to_dest_paths.items()):
+        dest = dest_manifest.get(dest_path)
+        if dest is None:
+            different_src_to_dest_paths[src_path] = dest_path
+        elif compare == 'exists':
+            pass
+        elif int(dest.size) != os.path.getsize(src_path):
+            different_src_to_dest_paths[src_path] = dest_path
+        elif compare == 'size':
+            pass
+        elif compare == 'mtime' and not is_modified_after(src_path, dest.modify_time):
+            pass
+        else:
+            checksum_comparisons.append((src_path, dest_path, dest))
+
+    dest_checksums = get_data_object_checksums([dest for _, _, dest in checksum_comparisons], jobs=jobs)
+    for src_path, dest_path, dest in checksum_comparisons:
+        dest_checksum = dest_checksums[dest.path]
+        if checksum_cache.get_checksum(src_path, dest_checksum) != dest_checksum:
+            different_src_to_dest_paths[src_path] = dest_path
+
+    print('{} of {} file(s) differ from iRODS by {} ({} compared by checksum) ({:5.2f}s)'.format(
+        len(different_src_to_dest_paths), len(src_to_dest_paths), compare, len(checksum_comparisons), time.time()-t0))
+    return different_src_to_dest_paths
+
+
+def is_modified_after(fp, modify_time):
+    """Return True if a local file was modified after modify_time, a naive UTC datetime as
+    listed for iRODS data objects, or if modify_time is None.
+    """
+    if modify_time is None:
+        return True
+    modify_timestamp = modify_time.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return int(os.path.getmtime(fp)) > modify_timestamp
+
+
+def get_data_object_checksums(data_objects, jobs=4):
+    """Return a dictionary of data object path to checksum. Data objects listed without a
+    checksum are checksummed now by `jobs` threads, one round trip each.
+
+    :param data_objects: IrodsDataObjectInfo list as returned by imicrobe.util.irods.irods_paths_exist
+    """
+    checksums = {d.path: d.checksum for d in data_objects if d.checksum}
+    unchecksummed_paths = [d.path for d in data_objects if not d.checksum]
+    if len(unchecksummed_paths) > 0:
+        t0 = time.time()
+
+        def chksum(path):
+            with irods_session_manager() as irods_session:
+                return irods_session.data_objects.chksum(path)
+
+        irods_session_pool().ensure_max_size(jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            checksums.update(zip(unchecksummed_paths, executor.map(chksum, unchecksummed_paths)))
+        print('checksummed {} data object(s) in {:5.2f}s'.format(len(unchecksummed_paths), time.time()-t0))
+    return checksums
+
+
+def sync_local_to_irods(
+        src_to_dest_paths, jobs=4, compare='mtime', dry_run=False, checksum_cache_fp=None):
+    """Copy local files to iRODS if they are missing or differ.
+
+    :param src_to_dest_paths: dictionary of local file paths to iRODS data object paths
+    :param jobs: number of files copied at the same time
+    :param compare: see find_local_to_irods_differences
+    :param dry_run: print what would be copied but copy nothing
+    :param checksum_cache_fp: path to the local checksum cache, default_checksum_cache_fp() if None
+    :return: imicrobe.util.irods_transfer.TransferSummary
+    """
+    with LocalChecksumCache(cache_fp=checksum_cache_fp) as checksum_cache:
+        different_src_to_dest_paths = find_local_to_irods_differences(
+            src_to_dest_paths, checksum_cache=checksum_cache, compare=compare, jobs=jobs)
+        return put_files(
+            different_src_to_dest_paths,
+            jobs=jobs,
+            dry_run=dry_run,
+            local_checksum=checksum_cache.get_checksum)
+
+
+def find_irods_to_irods_differences(irods_session, src_to_dest_paths):
+    """Return the part of src_to_dest_paths whose targets are missing or differ from their
+    sources by size or checksum. Both sides are listed with batched catalog queries.
+
+    :param irods_session:
+    :param src_to_dest_paths: dictionary of iRODS data object paths to iRODS data object paths
+    :return: dictionary of iRODS data object paths to iRODS data object paths
+    """
+    manifest = irods_paths_exist(
+        irods_session,
+        list(src_to_dest_paths.keys()) + list(src_to_dest_paths.values()))
+
+    different_src_to_dest_paths = dict()
+    for src_path, dest_path in src_to_dest_paths.items():
+        src = manifest.get(src_path)
+        dest = manifest.get(dest_path)
+        if src is None:
+            raise Exception('data object "{}" does not exist'.format(src_path))
+        elif dest is None or int(src.size) != int(dest.size):
+            different_src_to_dest_paths[src_path] = dest_path
+        else:
+            # data objects written without a checksum get one now
+            src_checksum = src.checksum or irods_session.data_objects.chksum(src_path)
+            dest_checksum = dest.checksum or irods_session.data_objects.chksum(dest_path)
+            if src_checksum != dest_checksum:
+                different_src_to_dest_paths[src_path] = dest_path
+
+    return different_src_to_dest_paths
+
+
+def sync_irods_to_irods(irods_session, src_to_dest_paths):
+    """Copy iRODS data objects whose targets are missing or differ.
+
+    :return: dictionary of copied iRODS data object paths to iRODS data object paths
+    """
+    different_src_to_dest_paths = find_irods_to_irods_differences(irods_session, src_to_dest_paths)
+    for src_path, dest_path in sorted(different_src_to_dest_paths.items()):
+        irods_copy(irods_session, src_path=src_path, dest_path=dest_path)
+    return different_src_to_dest_paths
+
+
+def get_local_to_irods_paths(source_dir, target_collection, name_re=None):
+    """Return a dictionary of files below source_dir to data object paths below target_collection,
+    for example '<source_dir>/1/samples/1/a.uproc.kegg' to '<target_collection>/1/samples/1/a.uproc.kegg'.
+
+    :param name_re: compiled regular expression, if not None include only files with matching names
+    """
+    src_to_dest_paths = dict()
+    for root, dir_names, file_names in os.walk(top=source_dir):
+        for file_name in file_names:
+            if name_re is None or name_re.search(file_name):
+                src_path = os.path.join(root, file_name)
+                src_to_dest_paths[src_path] = os.path.join(
+                    target_collection, os.path.relpath(src_path, source_dir))
+    return src_to_dest_paths
+
+
+def get_args(argv):
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--source-dir', required=True, help='local directory')
+    arg_parser.add_argument('--target-collection', required=True, help='iRODS collection')
+    arg_parser.add_argument('--name-re', default=None, help='copy only files with names matching this regex')
+    arg_parser.add_argument('--compare', choices=('exists', 'size', 'mtime', 'checksum'), default='mtime')
+    arg_parser.add_argument('--jobs', type=int, default=4, help='number of files copied at the same time')
+    arg_parser.add_argument('--dry-run', action='store_true', default=False)
+    arg_parser.add_argument('--checksum-cache-fp', default=None, help='local checksum cache file')
+
+    args = arg_parser.parse_args(args=argv)
+
+    return args
+
+
+def main(argv):
+    args = get_args(argv)
+
+    transfer_summary = sync_local_to_irods(
+        get_local_to_irods_paths(
+            source_dir=args.source_dir,
+            target_collection=args.target_collection,
+            name_re=None if args.name_re is None else re.compile(args.name_re)),
+        jobs=args.jobs,
+        compare=args.compare,
+        dry_run=args.dry_run,
+        checksum_cache_fp=args.checksum_cache_fp)
+
+    if len(transfer_summary.failed_paths) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
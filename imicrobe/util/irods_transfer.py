@@ -0,0 +1,171 @@
+"""
+Upload many local files to iRODS concurrently.
+
+Small files are the common case (UProC results are a few kB to a few MB) so
+the time to copy thousands of them is dominated by per-file round trips. Files
+are uploaded by a pool of `jobs` threads, each checking a session out of the
+iRODS session pool. Files larger than large_file_size are uploaded with several
+parallel transfer threads. After each upload the iRODS checksum is compared with
+the checksum of the local file and a failed upload is retried.
+"""
+import base64
+import concurrent.futures
+import hashlib
+import os
+import random
+import time
+
+from irods.keywords import FORCE_FLAG_KW
+
+from imicrobe.util.irods import irods_session_manager, irods_session_pool
+
+
+class TransferSummary:
+    """
+    Counts of transferred files and bytes for printing a throughput summary.
+    """
+    def __init__(self):
+        self.t0 = time.time()
+        self.file_count = 0
+        self.byte_count = 0
+        self.skipped_count = 0
+        self.retry_count = 0
+        self.failed_paths = []
+
+    def elapsed(self):
+        return time.time() - self.t0
+
+    def __str__(self):
+        elapsed = max(self.elapsed(), 1e-9)
+        return 'transferred {} file(s) ({:.1f}MB) in {:5.2f}s: {:.1f} files/s, {:.2f} MB/s, ' \
+               '{} skipped, {} retried, {} failed'.format(
+                   self.file_count,
+                   self.byte_count / 1e6,
+                   elapsed,
+                   self.file_count / elapsed,
+                   self.byte_count / 1e6 / elapsed,
+                   self.skipped_count,
+                   self.retry_count,
+                   len(self.failed_paths))
+
+
+def local_file_irods_checksum(fp, irods_checksum_like):
+    """Return the checksum of a local file in the same format as an iRODS checksum:
+    'sha2:<base64 SHA-256 digest>' or a hex MD5 digest.
+
+    :param fp: local file path
+    :param irods_checksum_like: an iRODS checksum, used only to choose the format
+    """
+    if irods_checksum_like.startswith('sha2:'):
+        file_hash = hashlib.sha256()
+    else:
+        file_hash = hashlib.md5()
+
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(block)
+
+    if irods_checksum_like.startswith('sha2:'):
+        return 'sha2:' + base64.b64encode(file_hash.digest()).decode('ascii')
+    else:
+        return file_hash.hexdigest()
+
+
+def put_file(src_path, dest_path, num_threads=0, verify_checksum=True, local_checksum=local_file_irods_checksum):
+    """Upload one file, overwriting dest_path, and compare checksums.
+
+    :param num_threads: number of parallel transfer threads, 0 to let the iRODS client decide
+    :param local_checksum: function like local_file_irods_checksum, for example the get_checksum
+        method of a LocalChecksumCache (see imicrobe.util.irods_sync)
+    :return: the iRODS checksum of dest_path, or None if verify_checksum is False
+    """
+    with irods_session_manager() as irods_session:
+        irods_session.data_objects.put(src_path, dest_path, num_threads=num_threads, **{FORCE_FLAG_KW: True})
+        if verify_checksum:
+            irods_checksum = irods_session.data_objects.chksum(dest_path)
+        else:
+            return None
+
+    src_checksum = local_checksum(src_path, irods_checksum)
+    if irods_checksum != src_checksum:
+        raise Exception('checksum of "{}" is {} but checksum of "{}" is {}'.format(
+            dest_path, irods_checksum, src_path, src_checksum))
+    return irods_checksum
+
+
+def put_file_with_retry(
+        src_path, dest_path, num_threads=0, verify_checksum=True, max_retries=3, backoff=1.0,
+        local_checksum=local_file_irods_checksum):
+    """Call put_file. Retry failures after sleeping a random time between 0 and
+    backoff * 2**attempt seconds.
+
+    :return: number of retries
+    """
+    attempt = 0
+    while True:
+        try:
+            put_file(
+                src_path, dest_path,
+                num_threads=num_threads, verify_checksum=verify_checksum, local_checksum=local_checksum)
+            return attempt
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            else:
+                print('failed to copy "{}" to "{}": {}'.format(src_path, dest_path, e))
+
+        time.sleep(random.uniform(0.0, backoff * 2**attempt))
+        attempt += 1
+
+
+def put_files(
+        src_to_dest_paths, jobs=4, large_file_size=64 * 1024 * 1024, large_file_threads=4,
+        verify_checksum=True, max_retries=3, dry_run=False, local_checksum=local_file_irods_checksum):
+    """Upload local files to iRODS with `jobs` concurrent uploads.
+
+    :param src_to_dest_paths: dictionary of local file paths to iRODS data object paths
+    :param jobs: number of files uploaded at the same time
+    :param large_file_size: files of at least this many bytes are uploaded with large_file_threads threads
+    :param large_file_threads: number of parallel transfer threads for large files
+    :param verify_checksum: compare iRODS and local checksums after each upload
+    :param max_retries: number of times a failed upload is retried
+    :param dry_run: print what would be copied but copy nothing
+    :param local_checksum: function returning the checksum of a local file, see put_file
+    :return: TransferSummary
+    """
+    summary = TransferSummary()
+
+    if dry_run:
+        for src_path, dest_path in sorted(src_to_dest_paths.items()):
+            print('would copy\n\t"{}"\nto\n\t"{}"'.format(src_path, dest_path))
+            summary.skipped_count += 1
+        return summary
+
+    irods_session_pool().ensure_max_size(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        put_futures = {}
+        for src_path, dest_path in sorted(src_to_dest_paths.items()):
+            src_size = os.path.getsize(src_path)
+            put_futures[executor.submit(
+                put_file_with_retry,
+                src_path,
+                dest_path,
+                num_threads=large_file_threads if src_size >= large_file_size else 1,
+                verify_checksum=verify_checksum,
+                max_retries=max_retries,
+                local_checksum=local_checksum)] = (src_path, dest_path, src_size)
+
+        for put_future in concurrent.futures.as_completed(put_futures):
+            src_path, dest_path, src_size = put_futures[put_future]
+            try:
+                summary.retry_count += put_future.result()
+                summary.file_count += 1
+                summary.byte_count += src_size
+                print('copied "{}" to "{}"'.format(src_path, dest_path))
+            except Exception as e:
+                print('*** FAILED to copy "{}" to "{}"'.format(src_path, dest_path))
+                print(e)
+                summary.failed_paths.append(src_path)
+
+    print(summary)
+    return summary
@@ -1,40 +1,162 @@
-import io
-import re
+import concurrent.futures
+import random
+import threading
 import time
-from collections import defaultdict
 
 import requests
-import requests_cache
+import requests.adapters
 
 from imicrobe.util import grouper
 
 
-requests_cache.install_cache('kegg_api_cache')
+kegg_rest_url = 'http://rest.kegg.jp'
 
+# the KEGG orthology fields used by the loaders
+kegg_annotation_fields = ('NAME', 'DEFINITION', 'PATHWAY', 'MODULE')
 
-def get_kegg_annotations(kegg_ids):
-    all_kegg_annotations = {}
-    all_bad_kegg_ids = set()
-    # the missing_accessions_groups_of_10 generator returns groups of 10 KEGG ids
-    # that are not already in the database and that are not 'bad' KEGG ids
-    # the last group will be padded with 'None' if there are fewer than 10 KEGG ids
-    for group_of_10 in grouper(sorted(kegg_ids), n=10):
-        t0 = time.time()
-        kegg_id_list = [k for k in group_of_10 if k is not None]
-        #print(kegg_id_list)
-        print('requesting {} KEGG annotation(s)'.format(len(kegg_id_list)))
-        kegg_annotations, bad_kegg_ids = get_10_kegg_annotations(kegg_id_list)
-        print('    received {} in {:5.2f}s'.format(len(kegg_annotations), time.time()-t0))
-        all_kegg_annotations.update(kegg_annotations)
-        all_bad_kegg_ids.update(bad_kegg_ids)
+
+class TokenBucket:
+    """
+    A thread-safe token bucket rate limiter. Tokens are added at `rate` per second
+    up to `capacity`. Each call to acquire() takes one token, waiting if necessary.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_kegg_annotations(
+        kegg_ids,
+        max_workers=3,
+        requests_per_second=3.0,
+        max_retries=5,
+        timeout=30,
+        kegg_url=kegg_rest_url,
+        kegg_store=None,
+        offline=False):
+    """Request annotations for any number of KEGG ids, 10 ids per request.
+
+    If kegg_store is given, annotations (and known bad ids) are taken from the store
+    first and only the remaining KEGG ids are requested. Downloaded annotations are
+    added to the store. With offline=True nothing is requested and KEGG ids missing
+    from the store are in neither the annotations nor the bad ids, since KEGG may know them.
+
+    Requests are made concurrently by up to max_workers threads sharing one pooled
+    HTTP session. No more than requests_per_second requests are started per second
+    (KEGG asks for no more than 3). Timeouts, connection errors, and 5xx responses
+    are retried up to max_retries times with jittered exponential backoff.
+
+    :param kegg_ids: iterable of KEGG ids such as 'K00001'
+    :param max_workers: maximum number of concurrent requests
+    :param requests_per_second: maximum request rate
+    :param max_retries: maximum number of retries for each request
+    :param timeout: seconds to wait for each response
+    :param kegg_url: KEGG REST API root URL
+    :param kegg_store: imicrobe.util.kegg_store.KeggAnnotationStore or None
+    :param offline: if True make no requests
+    :return: (dictionary of annotations as in get_10_kegg_annotations, set of KEGG ids with no annotation)
+    """
+    kegg_ids = set(kegg_ids)
+    if kegg_store is None:
+        all_kegg_annotations = {}
+        all_bad_kegg_ids = set()
+    else:
+        all_kegg_annotations, all_bad_kegg_ids = kegg_store.get_kegg_annotations(kegg_ids)
+        kegg_ids = kegg_ids - all_kegg_annotations.keys() - all_bad_kegg_ids
+        print('found {} KEGG annotation(s) in the KEGG annotation store'.format(
+            len(all_kegg_annotations) + len(all_bad_kegg_ids)))
+
+    if offline:
+        if len(kegg_ids) > 0:
+            print('offline: {} KEGG id(s) are not in the KEGG annotation store'.format(len(kegg_ids)))
+        return all_kegg_annotations, all_bad_kegg_ids
+
+    kegg_id_groups = [
+        [k for k in group_of_10 if k is not None]
+        for group_of_10
+        in grouper(sorted(kegg_ids), n=10)]
+    if len(kegg_id_groups) == 0:
+        return all_kegg_annotations, all_bad_kegg_ids
+
+    rate_limiter = TokenBucket(rate=requests_per_second)
+    t0 = time.time()
+    with requests.Session() as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        print('requesting {} KEGG annotation(s) in {} request(s)'.format(
+            sum([len(g) for g in kegg_id_groups]), len(kegg_id_groups)))
+        futures = [
+            executor.submit(
+                get_10_kegg_annotations,
+                kegg_id_list,
+                session=session,
+                rate_limiter=rate_limiter,
+                max_retries=max_retries,
+                timeout=timeout,
+                kegg_url=kegg_url)
+            for kegg_id_list
+            in kegg_id_groups]
+        for future in concurrent.futures.as_completed(futures):
+            kegg_annotations, bad_kegg_ids = future.result()
+            all_kegg_annotations.update(kegg_annotations)
+            all_bad_kegg_ids.update(bad_kegg_ids)
+            if kegg_store is not None:
+                kegg_store.put_kegg_annotations(kegg_annotations, bad_kegg_ids)
+
+    print('    received {} in {:5.2f}s'.format(len(all_kegg_annotations), time.time()-t0))
 
     return all_kegg_annotations, all_bad_kegg_ids
 
 
-kegg_orthology_field_re = re.compile(r'^(?P<field_name>[A-Z]+)?(\s+)(?P<field_value>.+)$')
+def request_with_retry(
+        session, url, rate_limiter=None, max_retries=5, timeout=30, backoff=1.0, max_backoff=60.0, stream=False):
+    """GET url. Retry timeouts, connection errors, and 5xx responses after sleeping
+    a random time between 0 and backoff * 2**attempt seconds (at most max_backoff).
+    With stream=True the response body is not read.
+
+    :return: requests.Response (which may have a 5xx status if all retries failed)
+    """
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            response = session.get(url, timeout=timeout, stream=stream)
+            if response.status_code < 500 or attempt >= max_retries:
+                return response
+            else:
+                print('response to "{}" is {}'.format(url, response.status_code))
+                response.close()
+        except (requests.Timeout, requests.ConnectionError) as e:
+            if attempt >= max_retries:
+                raise
+            else:
+                print('request "{}" failed: {}'.format(url, e))
+
+        time.sleep(random.uniform(0.0, min(max_backoff, backoff * 2**attempt)))
+        attempt += 1
 
 
-def get_10_kegg_annotations(kegg_ids):
+def get_10_kegg_annotations(kegg_ids, session=None, rate_limiter=None, max_retries=5, timeout=30, kegg_url=kegg_rest_url):
     """ Request annotations for up to 10 KEGG ids. If a bad id is given there will be no response for it.
 
     The response from the KEGG API looks like this:
@@ -63,34 +185,51 @@ def get_10_kegg_annotations(kegg_ids):
                         SMAC: SMDB11_2482
             ...
 
+    The response is parsed as it is read. Only the fields in kegg_annotation_fields are kept.
+
     return: a dictionary of dictionaries that looks like this
         {
             'K01467': {
-                'ENTRY': 'K01467                      KO',
-                'NAME': 'ampC',
-                'DEFINITION': '',
-                'PATHWAY': '',
-                'MODULE': '',
-                ...
+                'NAME': ['ampC'],
+                'DEFINITION': ['beta-lactamase class C [EC:3.5.2.6]'],
+                'PATHWAY': ['ko01501  beta-Lactam resistance', 'ko02020  Two-component system'],
+                'MODULE': ['M00628  beta-Lactam resistance, AmpC system']
             },
             'K00154': {
-                'ENTRY': 'K00154                      KO',
-                'NAME': 'E1.2.1.68',
-                'DEFINITION': '',
-                'PATHWAY': '',
-                'MODULE': '',
-                ...
+                'NAME': ['E1.2.1.68'],
+                'DEFINITION': ['coniferyl-aldehyde dehydrogenase [EC:1.2.1.68]']
             }
 
         }
     and a (possibly empty) set of KEGG ids for which no annotation was returned
 
+    :param kegg_ids: list of up to 10 KEGG ids
+    :param session: requests.Session, a new session is used if None
+    :param rate_limiter: TokenBucket or None
+    :param max_retries: see request_with_retry
+    :param timeout: seconds to wait for the response
+    :param kegg_url: KEGG REST API root URL
     """
 
-    debug = False
-
     ko_id_list = '+'.join(['ko:{}'.format(k) for k in kegg_ids])
-    response = requests.get('http://rest.kegg.jp/get/{}'.format(ko_id_list))
+    url = '{}/get/{}'.format(kegg_url, ko_id_list)
+    if session is None:
+        with requests.Session() as session:
+            return get_10_kegg_annotations(
+                kegg_ids,
+                session=session,
+                rate_limiter=rate_limiter,
+                max_retries=max_retries,
+                timeout=timeout,
+                kegg_url=kegg_url)
+
+    with request_with_retry(
+            session, url, rate_limiter=rate_limiter, max_retries=max_retries, timeout=timeout, stream=True) as response:
+        return read_kegg_annotations_response(kegg_ids, response)
+
+
+def read_kegg_annotations_response(kegg_ids, response):
+    """Parse a (streamed) response to a KEGG REST 'get' request for kegg_ids."""
     if response.status_code == 404:
         print('no annotations returned')
         all_entries = {}
@@ -101,29 +240,66 @@ def get_10_kegg_annotations(kegg_ids):
         print(error_msg)
         raise Exception(error_msg)
     else:
-        all_entries = defaultdict(lambda: defaultdict(list))
-        kegg_id = None
-        field_name = None
-        for line in io.StringIO(response.text).readlines():
-            field_match = kegg_orthology_field_re.search(line.rstrip())
-            if field_match is None:
-                # this line separates entries
-                kegg_id = None
-                field_name = None
-            else:
-                field_value = field_match.group('field_value')
-                if 'field_name' in field_match.groupdict():
-                    field_name = field_match.group('field_name')
-                    if field_name == 'ENTRY':
-                        kegg_id, *_ = field_value.split(' ')
-                        # print('KEGG id: "{}"'.format(kegg_id))
-                else:
-                    # just a field value is present
-                    pass
-
-                all_entries[kegg_id][field_name].append(field_value)
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        all_entries = parse_kegg_orthology(response.iter_lines(decode_unicode=True))
 
         # were any of the KEGG ids bad?
         bad_kegg_ids = {k for k in kegg_ids} - {k for k in all_entries.keys()}
 
-        return all_entries, bad_kegg_ids
\ No newline at end of file
+        return all_entries, bad_kegg_ids
+
+
+def parse_kegg_orthology(lines, fields=kegg_annotation_fields):
+    """Parse KEGG orthology entries in the flat file format returned by the KEGG REST API
+    and used in the KEGG 'ko' file.
+
+    :param lines: iterable of lines
+    :param fields: the fields to keep
+    :return: dictionary of dictionaries as in get_10_kegg_annotations
+    """
+    return {kegg_id: entry for kegg_id, entry in iter_kegg_orthology(lines, fields=fields)}
+
+
+def iter_kegg_orthology(lines, fields=kegg_annotation_fields):
+    """Yield (KEGG id, entry) for each KEGG orthology entry in lines, one entry at a time.
+
+    Each entry is a dictionary of field name to a list of field values, one value for
+    each line of the field. Only the requested fields are kept. The lines of other fields,
+    such as the very long GENES field, are skipped after looking at their first character.
+
+    A field line starts with the field name in the first 12 columns. Lines starting with
+    white space continue the previous field. A line starting with /// ends an entry.
+
+    :param lines: iterable of lines, for example an open 'ko' file
+    :param fields: the fields to keep
+    :return: generator of (KEGG id, entry)
+    """
+    fields = frozenset(fields)
+    kegg_id = None
+    entry = {}
+    # the value list for the current field, None if the current field is not kept
+    field_values = None
+    for line in lines:
+        if line[:1] in (' ', '\t'):
+            if field_values is not None:
+                field_values.append(line.strip())
+        elif line.startswith('///'):
+            if kegg_id is not None:
+                yield kegg_id, entry
+            kegg_id = None
+            entry = {}
+            field_values = None
+        else:
+            field_name, _, field_value = line.partition(' ')
+            if field_name == 'ENTRY':
+                kegg_id, *_ = field_value.split(None, 1)
+            if field_name in fields:
+                field_values = entry.setdefault(field_name, [])
+                field_values.append(field_value.strip())
+            else:
+                field_values = None
+
+    # the last entry may not end with ///
+    if kegg_id is not None:
+        yield kegg_id, entry
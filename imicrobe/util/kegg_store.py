@@ -0,0 +1,206 @@
+"""
+A local store of parsed KEGG orthology annotations.
+
+Annotations are kept in a SQLite file, one row per KEGG id, with only the fields
+used by the loaders (NAME, DEFINITION, PATHWAY, MODULE) stored as zlib-compressed
+JSON. KEGG ids that KEGG does not recognize are stored with no annotation so they
+are not requested again. Rows downloaded from the KEGG REST API that are older than
+the time-to-live are ignored and can be evicted. Rows imported from a 'ko' flat file
+never expire, they are replaced by importing a newer file.
+
+The store can be filled from a KEGG 'ko' flat file so loaders can run with no
+network access:
+
+    python -m imicrobe.util.kegg_store --import-ko-fp ko
+
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from imicrobe.util import grouper
+from imicrobe.util.kegg import iter_kegg_orthology, kegg_annotation_fields
+
+
+def default_kegg_store_fp():
+    return os.environ.get(
+        'IMICROBE_KEGG_STORE',
+        os.path.expanduser('~/.cache/imicrobe/kegg_annotations.sqlite3'))
+
+
+class KeggAnnotationStore:
+    """
+    Parsed KEGG annotations keyed by KEGG id. Safe to share between threads.
+    """
+    schema_version = 2
+
+    # the source of each row, rows imported from a 'ko' file do not expire
+    REST = 'rest'
+    KO_FILE = 'ko_file'
+
+    def __init__(self, store_fp=None, ttl=90*24*60*60):
+        """
+        :param store_fp: path to the SQLite file, default_kegg_store_fp() if None
+        :param ttl: seconds before a stored annotation expires, None for no expiration
+        """
+        self.store_fp = default_kegg_store_fp() if store_fp is None else store_fp
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        store_dp = os.path.dirname(os.path.abspath(self.store_fp))
+        os.makedirs(store_dp, exist_ok=True)
+        self.connection = sqlite3.connect(self.store_fp, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'create table if not exists store_info (key text not null primary key, value text not null)')
+            row = self.connection.execute(
+                "select value from store_info where key = 'schema_version'").fetchone()
+            if row is not None and int(row[0]) == 1:
+                # version 1 had no source column, its rows are treated as downloaded rows
+                print('KEGG annotation store "{}" was written by an older version, '
+                      're-import the "ko" file if one was imported'.format(self.store_fp))
+                self.connection.execute(
+                    "alter table kegg_annotation add column source text not null default '{}'".format(self.REST))
+            elif row is None or int(row[0]) != self.schema_version:
+                # the store is a cache so it is safe to start over
+                self.connection.execute('drop table if exists kegg_annotation')
+            self.connection.execute(
+                "insert or replace into store_info values ('schema_version', ?)", (str(self.schema_version), ))
+            self.connection.execute("""
+                create table if not exists kegg_annotation (
+                    kegg_id text not null primary key,
+                    annotation blob,
+                    updated real not null,
+                    source text not null
+                )""")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('select count(*) from kegg_annotation').fetchone()[0]
+
+    def get_kegg_annotations(self, kegg_ids):
+        """Look up stored annotations.
+
+        :param kegg_ids: iterable of KEGG ids
+        :return: (dictionary of annotations, set of known bad KEGG ids) for KEGG ids that
+            are in the store and have not expired, imported rows never expire
+        """
+        kegg_annotations = {}
+        bad_kegg_ids = set()
+        oldest = 0.0 if self.ttl is None else time.time() - self.ttl
+        with self.lock:
+            for kegg_id_group in grouper(kegg_ids, n=500):
+                kegg_id_list = [k for k in kegg_id_group if k is not None]
+                rows = self.connection.execute(
+                    'select kegg_id, annotation from kegg_annotation '
+                    'where (source = ? or updated >= ?) and kegg_id in ({})'.format(','.join('?' * len(kegg_id_list))),
+                    [self.KO_FILE, oldest] + kegg_id_list)
+                for kegg_id, annotation in rows:
+                    if annotation is None:
+                        bad_kegg_ids.add(kegg_id)
+                    else:
+                        kegg_annotations[kegg_id] = json.loads(zlib.decompress(annotation).decode('utf-8'))
+
+        return kegg_annotations, bad_kegg_ids
+
+    def put_kegg_annotations(self, kegg_annotations, bad_kegg_ids=(), source=REST):
+        """Store annotations and bad KEGG ids.
+
+        :param kegg_annotations: dictionary of annotations as returned by get_kegg_annotations
+        :param bad_kegg_ids: iterable of KEGG ids with no annotation
+        :param source: KeggAnnotationStore.REST for downloaded rows, KeggAnnotationStore.KO_FILE for rows that do not expire
+        """
+        now = time.time()
+        rows = [
+            (kegg_id, self.compress(annotation), now, source)
+            for kegg_id, annotation
+            in kegg_annotations.items()]
+        rows.extend([(kegg_id, None, now, source) for kegg_id in bad_kegg_ids])
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('insert or replace into kegg_annotation values (?, ?, ?, ?)', rows)
+
+    def evict_expired(self):
+        """Delete downloaded annotations older than the time-to-live. Imported annotations are kept.
+
+        :return: number of deleted annotations
+        """
+        if self.ttl is None:
+            return 0
+        with self.lock:
+            with self.connection:
+                deleted_count = self.connection.execute(
+                    'delete from kegg_annotation where source = ? and updated < ?',
+                    (self.REST, time.time() - self.ttl)).rowcount
+            self.connection.execute('vacuum')
+        return deleted_count
+
+    def import_ko_file(self, ko_fp, batch_size=1000):
+        """Store every entry in a KEGG 'ko' flat file. The file is read one entry at a time.
+        Imported annotations do not expire.
+
+        :param ko_fp: path to the 'ko' file
+        :param batch_size: number of annotations stored per transaction
+        :return: number of imported annotations
+        """
+        t0 = time.time()
+        import_count = 0
+        with open(ko_fp, 'rt') as ko_file:
+            for ko_annotation_group in grouper(iter_kegg_orthology(ko_file), n=batch_size):
+                ko_annotations = dict([a for a in ko_annotation_group if a is not None])
+                self.put_kegg_annotations(ko_annotations, source=self.KO_FILE)
+                import_count += len(ko_annotations)
+
+        print('imported {} KEGG annotation(s) from "{}" in {:5.2f}s'.format(
+            import_count, ko_fp, time.time()-t0))
+        return import_count
+
+    @staticmethod
+    def compress(annotation):
+        return zlib.compress(
+            json.dumps({
+                field: annotation[field]
+                for field
+                in kegg_annotation_fields
+                if field in annotation}).encode('utf-8'))
+
+
+def get_args(argv):
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--store-fp', default=None, help='KEGG annotation store file')
+    arg_parser.add_argument('--import-ko-fp', default=None, help='KEGG "ko" flat file to import')
+    arg_parser.add_argument('--evict-expired', action='store_true', default=False, help='delete expired annotations')
+
+    args = arg_parser.parse_args(args=argv)
+
+    return args
+
+
+def main(argv):
+    args = get_args(argv)
+
+    with KeggAnnotationStore(store_fp=args.store_fp) as kegg_store:
+        if args.import_ko_fp:
+            kegg_store.import_ko_file(args.import_ko_fp)
+        if args.evict_expired:
+            print('evicted {} expired KEGG annotation(s)'.format(kegg_store.evict_expired()))
+        print('KEGG annotation store "{}" has {} entries'.format(kegg_store.store_fp, len(kegg_store)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+"""
+Read Pfam database files such as
+    ftp://ftp.ebi.ac.uk/pub/databases/Pfam/current_release/database_files/pfamA.txt.gz
+"""
+import csv
+import gzip
+import hashlib
+
+import pandas as pd
+
+
+# pfamA.txt columns used by the loaders
+pfamA_columns = {
+    0: 'accession',
+    1: 'identifier',
+    3: 'name',
+    8: 'description'
+}
+
+# dead_family.txt columns used by the loaders
+dead_family_columns = {
+    0: 'accession',
+    1: 'identifier',
+    2: 'cause_of_death'
+}
+
+
+def read_pfamA_table(pfamA_fp):
+    """Read the Pfam family table in one pass.
+
+    :param pfamA_fp: path to pfamA.txt or pfamA.txt.gz
+    :return: pandas.DataFrame with columns accession, identifier, name, description
+    """
+    # had problems on myo with U+009D in PF01298 description
+    # specifying encoding='latin-1' solves the problem
+    pfamA_df = pd.read_csv(
+        pfamA_fp,
+        sep='\t',
+        header=None,
+        usecols=sorted(pfamA_columns),
+        dtype=str,
+        na_filter=False,
+        quoting=csv.QUOTE_NONE,
+        encoding='latin-1')
+    pfamA_df.columns = [pfamA_columns[c] for c in pfamA_df.columns]
+    return pfamA_df
+
+
+def read_dead_family_table(dead_family_fp):
+    """Read the table of retired Pfam families.
+
+    :param dead_family_fp: path to dead_family.txt or dead_family.txt.gz
+    :return: pandas.DataFrame with columns accession, identifier, cause_of_death
+    """
+    dead_family_df = pd.read_csv(
+        dead_family_fp,
+        sep='\t',
+        header=None,
+        usecols=sorted(dead_family_columns),
+        dtype=str,
+        na_filter=False,
+        quoting=csv.QUOTE_NONE,
+        encoding='latin-1')
+    dead_family_df.columns = [dead_family_columns[c] for c in dead_family_df.columns]
+    return dead_family_df
+
+
+def read_pfam_version(pfam_version_fp):
+    """Return the Pfam release from a Pfam.version.gz file, which looks like this:
+        Pfam release       : 32.0
+        Pfam-A families    : 17929
+        ...
+    """
+    with gzip.open(pfam_version_fp, 'rt') as pfam_version_file:
+        for line in pfam_version_file:
+            key, _, value = line.partition(':')
+            if key.strip() == 'Pfam release':
+                return value.strip()
+    return None
+
+
+def file_sha256(fp, block_size=2**20):
+    sha256 = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def diff_pfam_catalogue(existing_df, pfamA_df, dead_family_df):
+    """Compare the Pfam families in a database table with the current Pfam files.
+
+    Retired families are described by their cause of death. They are kept in the
+    database so existing results that reference them are not lost.
+
+    :param existing_df: pandas.DataFrame of families in the database with columns accession, description
+    :param pfamA_df: pandas.DataFrame from read_pfamA_table
+    :param dead_family_df: pandas.DataFrame from read_dead_family_table
+    :return: (new_df, changed_df) each with columns accession, description
+        new_df has families missing from the database
+        changed_df has families in the database with a different description
+    """
+    current_df = pd.concat([
+        pfamA_df[['accession', 'description']],
+        dead_family_df[['accession', 'cause_of_death']].rename(columns={'cause_of_death': 'description'})])
+    current_df = current_df.drop_duplicates(subset='accession', keep='first')
+
+    merged_df = current_df.merge(
+        existing_df[['accession', 'description']],
+        on='accession',
+        how='left',
+        suffixes=('', '_existing'),
+        indicator=True)
+    new_df = merged_df.loc[merged_df._merge == 'left_only', ['accession', 'description']]
+    changed_df = merged_df.loc[
+        (merged_df._merge == 'both') & (merged_df.description != merged_df.description_existing),
+        ['accession', 'description']]
+
+    return new_df, changed_df
@@ -0,0 +1,17 @@
+import os
+
+import pytest
+
+from imicrobe.util.benchmark_irods import build_fake_projects, projects_collection_path
+from imicrobe.util.fake_irods import use_fake_irods
+
+
+@pytest.fixture()
+def fake_irods(tmpdir):
+    root_dp = str(tmpdir.mkdir('irods'))
+    build_fake_projects(root_dp, project_count=2, sample_count=3, file_count=2, file_size=90)
+    os.makedirs(os.path.join(root_dp, projects_collection_path.lstrip('/'), '0', 'samples', '0', 'nested'))
+    with open(os.path.join(root_dp, projects_collection_path.lstrip('/'), '0', 'samples', '0', 'reads.fa'), 'wt') as f:
+        f.write('>1\nACGT\n')
+    with use_fake_irods(root_dp) as fake_irods:
+        yield fake_irods
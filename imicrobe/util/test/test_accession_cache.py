@@ -0,0 +1,53 @@
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from imicrobe.util.accession_cache import AccessionIdCache
+
+
+def test_lookup():
+    cache = AccessionIdCache(accessions=['PF00002', 'K00001', 'PF00001'], ids=[3, 1, 2])
+
+    assert len(cache) == 3
+    assert cache['K00001'] == 1
+    assert 'PF00002' in cache
+    assert 'PF99999' not in cache
+    assert cache.lookup(['PF00001', 'PF99999', 'K00001']).tolist() == [2, -1, 1]
+
+
+def test_pending_and_save_load(tmpdir):
+    cache = AccessionIdCache(accessions=['K00001'], ids=[1])
+    cache['K00002'] = 2
+    cache.update({'K00001': 10})
+
+    assert cache.lookup(['K00001', 'K00002']).tolist() == [10, 2]
+
+    cache.save(str(tmpdir))
+    loaded_cache = AccessionIdCache.load(str(tmpdir))
+
+    assert isinstance(loaded_cache.accessions, np.memmap)
+    assert len(loaded_cache) == 2
+    assert loaded_cache.get('K00002') == 2
+
+
+def test_from_query():
+    Base = declarative_base()
+
+    class Protein(Base):
+        __tablename__ = 'protein'
+        protein_id = sa.Column(sa.Integer, primary_key=True)
+        accession = sa.Column(sa.String(16))
+
+    engine = sa.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([Protein(protein_id=i, accession='K{:05d}'.format(100 - i)) for i in range(1, 26)])
+    session.commit()
+
+    cache = AccessionIdCache.from_query(session.query(Protein.accession, Protein.protein_id), batch_size=10)
+    assert len(cache) == 25
+    assert cache.lookup(['K00099', 'K00075', 'K00001']).tolist() == [1, 25, -1]
+
+    empty_cache = AccessionIdCache.from_query(session.query(Protein.accession, Protein.protein_id).filter(sa.false()))
+    assert len(empty_cache) == 0
+    session.close()
@@ -0,0 +1,13 @@
+from imicrobe.util.benchmark_irods import run_benchmarks
+
+
+def test_benchmarks(tmpdir):
+    results = run_benchmarks(
+        str(tmpdir), project_count=2, sample_count=2, file_count=1, file_size=90,
+        latency=0.0, connect_latency=0.0, jobs=2)
+
+    assert [r[0] for r in results] == ['listing', 'exists', 'read', 'put', 'write']
+    # concurrent reads save time, not calls
+    for benchmark_name, baseline_time, baseline_calls, optimized_time, optimized_calls in results:
+        if benchmark_name != 'read':
+            assert optimized_calls < baseline_calls
@@ -0,0 +1,20 @@
+import os
+
+from imicrobe.util import irods
+from imicrobe.util.benchmark_irods import projects_collection_path
+
+
+def test_irods_paths_exist(fake_irods):
+    sample_0_path = os.path.join(projects_collection_path, '0', 'samples', '0')
+    paths = [os.path.join(sample_0_path, 'reads_0.uproc.kegg'), os.path.join(sample_0_path, 'missing.uproc.kegg')]
+
+    fake_irods.reset_call_counts()
+    with irods.irods_session_manager() as irods_session:
+        existing_paths = irods.irods_paths_exist(irods_session, paths)
+        existing_collections = irods.irods_collections_exist(irods_session, [sample_0_path, sample_0_path + '0'])
+
+    assert list(existing_paths.keys()) == paths[:1]
+    assert existing_paths[paths[0]].size == 90
+    assert existing_collections == {sample_0_path}
+    # one catalog query for the data objects and one for the collections
+    assert fake_irods.call_counts['query'] == 2
@@ -0,0 +1,20 @@
+import os
+import re
+
+from imicrobe.util import irods
+from imicrobe.util.benchmark_irods import projects_collection_path
+
+
+def test_get_project_sample_data_objects(fake_irods):
+    project_to_sample_data_objects = irods.get_project_sample_data_objects(
+        collection_root=projects_collection_path,
+        name_re=re.compile(r'\.uproc\.kegg$'))
+
+    sample_0_path = os.path.join(projects_collection_path, '0', 'samples', '0')
+    assert len(project_to_sample_data_objects) == 2
+    assert sum([len(s) for s in project_to_sample_data_objects.values()]) == 6
+    assert [d.name for d in project_to_sample_data_objects[os.path.dirname(os.path.dirname(sample_0_path))][sample_0_path]] == \
+        ['reads_0.uproc.kegg', 'reads_1.uproc.kegg']
+    # one catalog query for the sample collections and one for their data objects
+    assert fake_irods.call_counts['query'] == 2
+
@@ -0,0 +1,68 @@
+import pytest
+
+from irods.exception import NetworkException
+
+from imicrobe.util.irods import IrodsSessionPool
+
+
+class StubCollectionManager:
+    def __init__(self, healthy):
+        self.healthy = healthy
+
+    def get(self, path):
+        if not self.healthy:
+            raise NetworkException('connection lost')
+
+
+class StubSession:
+    zone = 'stubZone'
+
+    def __init__(self):
+        self.collections = StubCollectionManager(healthy=True)
+        self.cleaned_up = False
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+def test_session_reuse():
+    with IrodsSessionPool(max_size=2, session_factory=StubSession) as pool:
+        with pool.session() as irods_session_1:
+            pass
+        with pool.session() as irods_session_2:
+            assert irods_session_2 is irods_session_1
+        assert pool.created_session_count == 1
+
+        with pool.session(), pool.session():
+            with pytest.raises(Exception) as exc_info:
+                pool.checkout(timeout=0.01)
+            assert 'no iRODS session was returned' in str(exc_info.value)
+        assert pool.created_session_count == 2
+    assert pool.open_session_count == 0
+
+
+def test_discard_sessions():
+    pool = IrodsSessionPool(max_size=1, session_factory=StubSession)
+
+    # a session that raised a NetworkException is not reused
+    with pytest.raises(NetworkException):
+        with pool.session() as irods_session_1:
+            raise NetworkException('connection lost')
+    assert irods_session_1.cleaned_up
+    assert pool.open_session_count == 0
+
+    # an idle session that fails the health check is replaced
+    pool.health_check_interval = -1
+    with pool.session() as irods_session_2:
+        irods_session_2.collections.healthy = False
+    with pool.session() as irods_session_3:
+        assert irods_session_3 is not irods_session_2
+    assert irods_session_2.cleaned_up
+
+    # an idle session is closed after max_idle_time
+    pool.max_idle_time = -1
+    with pool.session() as irods_session_4:
+        assert irods_session_4 is not irods_session_3
+    assert irods_session_3.cleaned_up
+    assert pool.open_session_count == 1
+    assert pool.created_session_count == 4
@@ -0,0 +1,76 @@
+import base64
+import hashlib
+import os
+import time
+
+from imicrobe.util import irods
+from imicrobe.util.benchmark_irods import projects_collection_path
+from imicrobe.util.irods_sync import LocalChecksumCache, get_data_object_checksums, sync_local_to_irods
+from imicrobe.util.irods_transfer import put_files
+
+
+def test_local_checksum_cache(tmpdir):
+    fp = str(tmpdir.join('a.uproc.kegg'))
+    with open(fp, 'wb') as f:
+        f.write(b'K00001,1\n')
+    sha2_checksum = 'sha2:' + base64.b64encode(hashlib.sha256(b'K00001,1\n').digest()).decode('ascii')
+
+    cache_fp = str(tmpdir.join('checksums.sqlite3'))
+    with LocalChecksumCache(cache_fp=cache_fp) as checksum_cache:
+        assert checksum_cache.get_checksum(fp, 'sha2:') == sha2_checksum
+        assert checksum_cache.get_checksum(fp, 'abc') == hashlib.md5(b'K00001,1\n').hexdigest()
+        assert checksum_cache.hashed_count == 2
+
+    with LocalChecksumCache(cache_fp=cache_fp) as checksum_cache:
+        assert checksum_cache.get_checksum(fp, 'sha2:') == sha2_checksum
+        assert checksum_cache.hashed_count == 0
+
+        # a changed file is hashed again
+        with open(fp, 'ab') as f:
+            f.write(b'K00002,2\n')
+        assert checksum_cache.get_checksum(fp, 'sha2:') != sha2_checksum
+        assert checksum_cache.hashed_count == 1
+
+
+def test_sync_local_to_irods(fake_irods, tmpdir):
+    local_dp = tmpdir.mkdir('local')
+    local_dp.join('a.uproc.kegg').write('K00001,1\n')
+    local_dp.join('b.uproc.kegg').write('K00002,2\n')
+    collection_path = os.path.join(projects_collection_path, '1', 'samples', '4')
+    src_to_dest_paths = {
+        str(local_dp.join(n)): os.path.join(collection_path, n)
+        for n
+        in ('a.uproc.kegg', 'b.uproc.kegg')}
+
+    assert put_files({str(local_dp.join('a.uproc.kegg')): src_to_dest_paths[str(local_dp.join('a.uproc.kegg'))]}).file_count == 1
+
+    checksum_cache_fp = str(tmpdir.join('checksums.sqlite3'))
+    assert sync_local_to_irods(src_to_dest_paths, checksum_cache_fp=checksum_cache_fp).file_count == 1
+    assert sync_local_to_irods(src_to_dest_paths, checksum_cache_fp=checksum_cache_fp).file_count == 0
+
+    # a file changed within the second it was copied is found only by comparing checksums
+    local_dp.join('a.uproc.kegg').write('K00001,3\n')
+    assert sync_local_to_irods(src_to_dest_paths, checksum_cache_fp=checksum_cache_fp, compare='checksum').file_count == 1
+
+    # a file modified after its data object is compared by checksum and copied only if it differs
+    later = time.time() + 10
+    os.utime(str(local_dp.join('a.uproc.kegg')), (later, later))
+    assert sync_local_to_irods(src_to_dest_paths, checksum_cache_fp=checksum_cache_fp).file_count == 0
+    local_dp.join('a.uproc.kegg').write('K00001,4\n')
+    os.utime(str(local_dp.join('a.uproc.kegg')), (later + 1, later + 1))
+    assert sync_local_to_irods(src_to_dest_paths, checksum_cache_fp=checksum_cache_fp).file_count == 1
+
+
+def test_get_data_object_checksums(fake_irods):
+    sample_0_path = os.path.join(projects_collection_path, '0', 'samples', '0')
+    with irods.irods_session_manager() as irods_session:
+        data_objects = list(irods.irods_paths_exist(
+            irods_session,
+            [os.path.join(sample_0_path, n) for n in ('reads_0.uproc.kegg', 'reads_1.uproc.kegg')]).values())
+    listed_checksums = {d.path: d.checksum for d in data_objects}
+    # the first data object was written without a checksum
+    data_objects[0] = data_objects[0]._replace(checksum=None)
+
+    fake_irods.reset_call_counts()
+    assert get_data_object_checksums(data_objects, jobs=2) == listed_checksums
+    assert fake_irods.call_counts['data_objects.chksum'] == 1
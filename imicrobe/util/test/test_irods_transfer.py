@@ -0,0 +1,33 @@
+import os
+
+from imicrobe.util import irods
+from imicrobe.util.benchmark_irods import projects_collection_path
+from imicrobe.util.irods_transfer import put_files
+
+
+def test_put_files(fake_irods, tmpdir):
+    local_dp = tmpdir.mkdir('local')
+    local_dp.join('a.uproc.kegg').write('K00001,1\n')
+    local_dp.join('b.uproc.kegg').write('K00002,2\n')
+    collection_path = os.path.join(projects_collection_path, '1', 'samples', '4')
+    src_to_dest_paths = {
+        str(local_dp.join(n)): os.path.join(collection_path, n)
+        for n
+        in ('a.uproc.kegg', 'b.uproc.kegg')}
+
+    dry_run_summary = put_files(src_to_dest_paths, jobs=2, dry_run=True)
+    assert dry_run_summary.file_count == 0
+    assert dry_run_summary.skipped_count == 2
+
+    summary = put_files(src_to_dest_paths, jobs=2)
+    assert summary.file_count == 2
+    assert summary.byte_count == 18
+    assert fake_irods.call_counts['data_objects.chksum'] == 2
+    with irods.irods_session_manager() as irods_session:
+        with irods_session.data_objects.open(os.path.join(collection_path, 'b.uproc.kegg'), 'r') as b:
+            assert b.read() == b'K00002,2\n'
+
+    failed_summary = put_files(
+        {str(local_dp.join('a.uproc.kegg')): '/no/such/collection/a.uproc.kegg'}, max_retries=0)
+    assert failed_summary.file_count == 0
+    assert failed_summary.failed_paths == [str(local_dp.join('a.uproc.kegg'))]
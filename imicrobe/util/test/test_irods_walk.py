@@ -0,0 +1,44 @@
+import os
+import time
+
+from imicrobe.util import irods
+from imicrobe.util.benchmark_irods import build_fake_projects, projects_collection_path
+from imicrobe.util.fake_irods import use_fake_irods
+
+
+def test_walk(fake_irods):
+    walk_root = os.path.join(projects_collection_path, '0')
+    ordered_paths = [c.path for c, _, _ in irods.walk(walk_root, workers=3)]
+    unordered_paths = [c.path for c, _, _ in irods.walk(walk_root, workers=3, ordered=False)]
+    sequential_paths = [c.path for c, _, _ in irods.walk(walk_root)]
+
+    assert ordered_paths == sequential_paths
+    assert ordered_paths == sorted(ordered_paths)
+    assert sorted(unordered_paths) == ordered_paths
+    assert os.path.join(walk_root, 'samples', '0', 'nested') in ordered_paths
+
+
+def test_abandoned_walk(fake_irods):
+    for ordered in (True, False):
+        walk_expansions = irods.walk(projects_collection_path, workers=2, ordered=ordered, max_in_flight=4)
+        collection, _, _ = next(walk_expansions)
+        assert collection.path == projects_collection_path
+        # closing the walk cancels pending expansions and returns their sessions to the pool
+        walk_expansions.close()
+        pool = irods.irods_session_pool()
+        assert pool.open_session_count == len(pool.idle_sessions)
+
+
+def test_ordered_walk_speed(tmpdir):
+    root_dp = str(tmpdir.mkdir('irods'))
+    build_fake_projects(root_dp, project_count=8, sample_count=6, file_count=1, file_size=9)
+    with use_fake_irods(root_dp, latency=0.005):
+        walk_times = {}
+        for ordered in (True, False):
+            t0 = time.time()
+            collection_count = len(list(irods.walk(projects_collection_path, workers=8, ordered=ordered)))
+            walk_times[ordered] = time.time() - t0
+            assert collection_count == 1 + 8 * 2 + 8 * 6
+
+    # the ordered walk keeps the expansions of the next collections to be yielded in flight
+    assert walk_times[True] < 1.5 * walk_times[False]
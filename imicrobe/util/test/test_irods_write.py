@@ -0,0 +1,29 @@
+import io
+import os
+
+from imicrobe.util import irods
+from imicrobe.util.benchmark_irods import projects_collection_path
+
+
+def test_iter_content_chunks():
+    assert list(irods.iter_content_chunks('abcde', chunk_size=2)) == [b'ab', b'cd', b'e']
+    assert list(irods.iter_content_chunks(io.StringIO('abcde'), chunk_size=3)) == [b'abc', b'de']
+    assert list(irods.iter_content_chunks([b'a', 'bc', b'', 'd'], chunk_size=2)) == [b'ab', b'cd']
+    assert list(irods.iter_content_chunks(b'')) == []
+
+
+def test_write_data_objects(fake_irods):
+    collection_path = os.path.join(projects_collection_path, '1', 'samples', '3')
+    with irods.irods_session_manager() as irods_session:
+        irods.irods_write_data_object(irods_session, os.path.join(collection_path, 'a.json'), 'a' * 10)
+        irods.irods_write_data_object(
+            irods_session, os.path.join(collection_path, 'a.json'), io.BytesIO(b'b' * 5), chunk_size=2)
+        failed_paths = irods.irods_write_data_objects({
+            os.path.join(collection_path, 'b.json'): (s for s in ['{', '}']),
+            '/no/such/collection/c.json': 'c'})
+
+        with irods_session.data_objects.open(os.path.join(collection_path, 'a.json'), 'r') as a:
+            assert a.read() == b'bbbbb'
+        with irods_session.data_objects.open(os.path.join(collection_path, 'b.json'), 'r') as b:
+            assert b.read() == b'{}'
+    assert list(failed_paths.keys()) == ['/no/such/collection/c.json']
@@ -0,0 +1,176 @@
+import http.server
+import threading
+
+import pytest
+
+from imicrobe.util import kegg
+from imicrobe.util.kegg_store import KeggAnnotationStore
+
+
+kegg_entries = {
+    'K00001': 'ENTRY       K00001                      KO\nNAME        E1.1.1.1, adh\nDEFINITION  alcohol dehydrogenase [EC:1.1.1.1]\n///\n',
+    'K00002': 'ENTRY       K00002                      KO\nNAME        AKR1A1, adh\nDEFINITION  alcohol dehydrogenase (NADP+) [EC:1.1.1.2]\n///\n',
+}
+
+
+class StubKeggHandler(http.server.BaseHTTPRequestHandler):
+    """Answer /get/ko:K00001+ko:K00002 requests from kegg_entries. The first
+    server_errors requests are answered with 503."""
+    def do_GET(self):
+        self.server.request_count += 1
+        if self.server.request_count <= self.server.server_errors:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        kegg_ids = [k[len('ko:'):] for k in self.path[len('/get/'):].split('+')]
+        body = ''.join([kegg_entries[k] for k in kegg_ids if k in kegg_entries])
+        if len(body) == 0:
+            self.send_response(404)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def stub_kegg_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubKeggHandler)
+    server.request_count = 0
+    server.server_errors = 0
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stub_kegg_url(server):
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def test_get_kegg_annotations(stub_kegg_server):
+    annotations, bad_kegg_ids = kegg.get_kegg_annotations(
+        ['K00001', 'K00002', 'K99999'],
+        kegg_url=stub_kegg_url(stub_kegg_server))
+
+    assert set(annotations.keys()) == {'K00001', 'K00002'}
+    assert annotations['K00001']['NAME'] == ['E1.1.1.1, adh']
+    assert bad_kegg_ids == {'K99999'}
+
+
+def test_get_kegg_annotations_retries_server_errors(stub_kegg_server):
+    stub_kegg_server.server_errors = 2
+    annotations, bad_kegg_ids = kegg.get_kegg_annotations(
+        ['K00001'],
+        requests_per_second=100.0,
+        kegg_url=stub_kegg_url(stub_kegg_server))
+
+    assert stub_kegg_server.request_count == 3
+    assert set(annotations.keys()) == {'K00001'}
+    assert len(bad_kegg_ids) == 0
+
+
+def test_get_kegg_annotations_many_groups(stub_kegg_server):
+    kegg_ids = ['K{:05d}'.format(i) for i in range(1, 51)]
+    annotations, bad_kegg_ids = kegg.get_kegg_annotations(
+        kegg_ids,
+        max_workers=5,
+        requests_per_second=100.0,
+        kegg_url=stub_kegg_url(stub_kegg_server))
+
+    assert stub_kegg_server.request_count == 5
+    assert set(annotations.keys()) == {'K00001', 'K00002'}
+    assert bad_kegg_ids == set(kegg_ids) - {'K00001', 'K00002'}
+
+
+def test_get_kegg_annotations_with_store(stub_kegg_server, tmp_path):
+    with KeggAnnotationStore(store_fp=str(tmp_path / 'kegg.sqlite3')) as kegg_store:
+        kegg.get_kegg_annotations(
+            ['K00001', 'K99999'],
+            kegg_url=stub_kegg_url(stub_kegg_server),
+            kegg_store=kegg_store)
+        assert stub_kegg_server.request_count == 1
+
+        annotations, bad_kegg_ids = kegg.get_kegg_annotations(
+            ['K00001', 'K99999', 'K00002'],
+            kegg_store=kegg_store,
+            offline=True)
+        assert stub_kegg_server.request_count == 1
+        assert annotations['K00001']['DEFINITION'] == ['alcohol dehydrogenase [EC:1.1.1.1]']
+        # K00002 is not in the store but KEGG may know it
+        assert bad_kegg_ids == {'K99999'}
+
+
+def test_kegg_store_import_ko_file(tmp_path):
+    ko_fp = tmp_path / 'ko'
+    ko_fp.write_text(''.join(kegg_entries.values()))
+    with KeggAnnotationStore(store_fp=str(tmp_path / 'kegg.sqlite3'), ttl=None) as kegg_store:
+        assert kegg_store.import_ko_file(str(ko_fp)) == 2
+        annotations, bad_kegg_ids = kegg_store.get_kegg_annotations(['K00001', 'K00002', 'K00003'])
+        assert set(annotations.keys()) == {'K00001', 'K00002'}
+        assert annotations['K00002']['NAME'] == ['AKR1A1, adh']
+        assert len(bad_kegg_ids) == 0
+
+
+def test_kegg_store_imported_annotations_do_not_expire(tmp_path):
+    ko_fp = tmp_path / 'ko'
+    ko_fp.write_text(kegg_entries['K00001'])
+    with KeggAnnotationStore(store_fp=str(tmp_path / 'kegg.sqlite3'), ttl=-1) as kegg_store:
+        kegg_store.import_ko_file(str(ko_fp))
+        kegg_store.put_kegg_annotations({}, bad_kegg_ids=['K99999'])
+
+        # with a negative time-to-live every downloaded row has expired
+        annotations, bad_kegg_ids = kegg_store.get_kegg_annotations(['K00001', 'K99999'])
+        assert set(annotations.keys()) == {'K00001'}
+        assert len(bad_kegg_ids) == 0
+
+        assert kegg_store.evict_expired() == 1
+        assert len(kegg_store) == 1
+
+
+def test_token_bucket_limits_rate():
+    token_bucket = kegg.TokenBucket(rate=20.0)
+    t0 = kegg.time.monotonic()
+    for _ in range(5):
+        token_bucket.acquire()
+    # the first token is available immediately
+    assert kegg.time.monotonic() - t0 >= 4 / 20.0
+
+
+def test_iter_kegg_orthology():
+    ko_lines = [
+        'ENTRY       K01467                      KO\n',
+        'NAME        ampC\n',
+        'DEFINITION  beta-lactamase class C [EC:3.5.2.6]\n',
+        'PATHWAY     ko01501  beta-Lactam resistance\n',
+        '            ko02020  Two-component system\n',
+        'BRITE       Enzymes [BR:ko01000]\n',
+        '             3. Hydrolases\n',
+        'GENES       ECO: b4150(ampC)\n',
+        '            ECJ: JW4111(ampC)\n',
+        '///\n',
+        'ENTRY       K00154                      KO\n',
+        'NAME        E1.2.1.68\n',
+        'MODULE      M00628  beta-Lactam resistance, AmpC system\n',
+    ]
+    entries = list(kegg.iter_kegg_orthology(ko_lines))
+
+    assert entries == [
+        ('K01467', {
+            'NAME': ['ampC'],
+            'DEFINITION': ['beta-lactamase class C [EC:3.5.2.6]'],
+            'PATHWAY': ['ko01501  beta-Lactam resistance', 'ko02020  Two-component system']}),
+        ('K00154', {
+            'NAME': ['E1.2.1.68'],
+            'MODULE': ['M00628  beta-Lactam resistance, AmpC system']})
+    ]
+
+    entries = kegg.parse_kegg_orthology(ko_lines, fields=('ENTRY', 'GENES'))
+    assert entries['K01467'] == {
+        'ENTRY': ['K01467                      KO'],
+        'GENES': ['ECO: b4150(ampC)', 'ECJ: JW4111(ampC)']}
@@ -1,18 +1,64 @@
+"""
+Validate FASTA and FASTQ files, plain or gzipped.
+
+A valid FASTA file has at least one record, every record has a non-empty sequence,
+and every sequence letter is an IUPAC ambiguous DNA letter (GATCRYWSMKHBVDN, either
+case). Whitespace in sequence lines is ignored. A valid FASTQ file has 4-line records
+with a '@' header line, a non-empty sequence line of IUPAC ambiguous DNA letters, a '+'
+line, and a quality line of printable characters as long as the sequence line.
+
+Compression and format are detected from the first bytes of each file, not the name.
+
+Files are checked in blocks with NumPy rather than parsed into record objects.
+Plain FASTA files are memory mapped and large files are split at record boundaries
+into chunks that are validated in parallel by the process pool, so a single huge
+file can use every core. FASTQ and gzipped files are streamed through a fixed-size
+buffer, decompressed by pigz or igzip in a separate process if either is installed,
+otherwise by the isal package or the standard library gzip module.
+"""
 import argparse
 import concurrent.futures
+import contextlib
 import glob
+import gzip
+import mmap
+import os
+import shutil
+import subprocess
 import sys
 import time
 
-from Bio import SeqIO
-from Bio import Alphabet
-from Bio.Alphabet import IUPAC
+import numpy as np
+
+
+iupac_ambiguous_dna_letters = b'GATCRYWSMKHBVDN'
+
+# 256-entry lookup tables indexed by byte value
+sequence_letter_table = np.zeros(256, dtype=bool)
+sequence_letter_table[np.frombuffer(iupac_ambiguous_dna_letters, dtype=np.uint8)] = True
+sequence_letter_table[np.frombuffer(iupac_ambiguous_dna_letters.lower(), dtype=np.uint8)] = True
+
+whitespace_table = np.zeros(256, dtype=bool)
+whitespace_table[np.frombuffer(b' \t\r\n\v\f', dtype=np.uint8)] = True
+
+quality_table = np.zeros(256, dtype=bool)
+quality_table[ord('!'):ord('~')+1] = True
+
+gzip_magic_bytes = b'\x1f\x8b'
+external_decompressors = ('pigz', 'igzip')
+
+default_chunk_size = 256 * 1024 * 1024
+default_block_size = 16 * 1024 * 1024
 
 
 def get_args(argv):
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-i', '--fasta-glob', required=True, help='glob for FASTA files to be validated')
     arg_parser.add_argument('--max-workers', type=int, default=1, help='number of processes')
+    arg_parser.add_argument('--chunk-size', type=int, default=default_chunk_size,
+                            help='plain FASTA files larger than this many bytes are validated in parallel chunks')
+    arg_parser.add_argument('--decompressor', choices=('auto', 'pigz', 'igzip', 'isal', 'gzip'), default='auto',
+                            help='gzip decoder, "auto" for the first of pigz, igzip, isal, gzip that is available')
 
     args = arg_parser.parse_args(argv)
     print('command line arguments:\n\t{}'.format(args))
@@ -24,18 +70,26 @@ def main():
     fasta_validate(**vars(get_args(sys.argv[1:])))
 
 
-def fasta_validate(fasta_glob, max_workers):
+def fasta_validate(fasta_glob, max_workers, chunk_size=default_chunk_size, decompressor='auto'):
     fasta_list = glob.glob(fasta_glob, recursive=True)
     print('glob "{}" matched {} files'.format(fasta_glob, len(fasta_list)))
 
     good = []
     bad = []
     with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-        future_to_fasta_fp = {executor.submit(parse_fasta, fasta_fp): fasta_fp for fasta_fp in fasta_list}
-        for future in concurrent.futures.as_completed(future_to_fasta_fp):
-            fasta_fp = future_to_fasta_fp[future]
+        fasta_fp_to_chunk_futures = {}
+        for fasta_fp in fasta_list:
+            try:
+                fasta_fp_to_chunk_futures[fasta_fp] = [
+                    executor.submit(*task)
+                    for task
+                    in get_validation_tasks(fasta_fp, chunk_size, decompressor)]
+            except Exception as exc:
+                bad.append((fasta_fp, exc))
+
+        for fasta_fp, chunk_futures in fasta_fp_to_chunk_futures.items():
             try:
-                read_count, t = future.result()
+                read_count, t = combine_chunk_results(fasta_fp, [f.result() for f in chunk_futures])
             except Exception as exc:
                 bad.append((fasta_fp, exc))
             else:
@@ -43,38 +97,477 @@ def fasta_validate(fasta_glob, max_workers):
 
         print('\n{} valid FASTA file(s)\n'.format(len(good)))
 
-        sorted_bad = sorted(bad)
+        sorted_bad = sorted(bad, key=lambda b: b[0])
         print('{} problematic file(s):'.format(len(bad)))
         print('\n'.join([b[0] for b in sorted_bad]))
 
         print('\nfailures:')
         print('\n\n'.join([str(b[1]) for b in sorted_bad]))
 
+    return good, bad
+
+
+def parse_fasta(fasta_fp, chunk_size=default_chunk_size, decompressor='auto'):
+    """Validate one FASTA or FASTQ file in this process.
+
+    :return: (read count, seconds)
+    """
+    return combine_chunk_results(
+        fasta_fp,
+        [
+            task[0](*task[1:])
+            for task
+            in get_validation_tasks(fasta_fp, chunk_size, decompressor)])
+
+
+def get_validation_tasks(fasta_fp, chunk_size, decompressor):
+    """Return a list of tuples (function, arguments...) to be called in file order.
+    Each call returns a result for combine_chunk_results.
+    """
+    compressed, sequence_format = sniff_sequence_file(fasta_fp)
+    if compressed or sequence_format == 'fastq':
+        return [(validate_sequence_stream, fasta_fp, sequence_format, decompressor)]
+    else:
+        return [
+            (validate_fasta_chunk, fasta_fp, chunk_start, chunk_end)
+            for chunk_start, chunk_end
+            in find_fasta_chunks(fasta_fp, chunk_size)]
+
+
+def sniff_sequence_file(fasta_fp):
+    """Look at the first bytes of a file to decide whether it is gzipped and whether it is FASTA or FASTQ.
+
+    :return: (True if gzipped, 'fasta' or 'fastq')
+    """
+    with open(fasta_fp, 'rb') as fasta_file:
+        compressed = fasta_file.read(len(gzip_magic_bytes)) == gzip_magic_bytes
+
+    if compressed:
+        with gzip.open(fasta_fp, 'rb') as fasta_file:
+            first_bytes = fasta_file.read(4096)
+    else:
+        with open(fasta_fp, 'rb') as fasta_file:
+            first_bytes = fasta_file.read(4096)
+
+    # anything that is not FASTQ is validated as FASTA so it gets a FASTA error message
+    if first_bytes.lstrip().startswith(b'@'):
+        return compressed, 'fastq'
+    else:
+        return compressed, 'fasta'
+
+
+def find_decompressor():
+    for decompressor in external_decompressors:
+        if shutil.which(decompressor) is not None:
+            return decompressor
+    try:
+        import isal.igzip
+        return 'isal'
+    except ImportError:
+        return 'gzip'
+
 
-def parse_fasta(fasta_fp):
+@contextlib.contextmanager
+def open_decompressed(fasta_fp, decompressor='auto'):
+    """Open a file for reading bytes, decompressing it if it is gzipped.
+
+    :param decompressor: 'pigz' or 'igzip' to decompress in a separate process, 'isal' or
+        'gzip' to decompress in this process, 'auto' to use find_decompressor()
+    """
+    with open(fasta_fp, 'rb') as fasta_file:
+        compressed = fasta_file.read(len(gzip_magic_bytes)) == gzip_magic_bytes
+
+    if not compressed:
+        with open(fasta_fp, 'rb') as fasta_file:
+            yield fasta_file
+    else:
+        if decompressor == 'auto':
+            decompressor = find_decompressor()
+
+        if decompressor in external_decompressors:
+            process = subprocess.Popen(
+                [decompressor, '-dc', fasta_fp], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            read_all = False
+            try:
+                yield process.stdout
+                # the exit status matters only if all the output was read
+                read_all = process.stdout.read(1) == b''
+            finally:
+                if not read_all:
+                    process.kill()
+                process.stdout.close()
+                stderr = process.stderr.read()
+                process.stderr.close()
+                return_code = process.wait()
+            if read_all and return_code != 0:
+                raise Exception('{} failed on {}: {}'.format(decompressor, fasta_fp, stderr.decode('utf-8', 'replace')))
+        elif decompressor == 'isal':
+            import isal.igzip
+            with isal.igzip.open(fasta_fp, 'rb') as fasta_file:
+                yield fasta_file
+        else:
+            with gzip.open(fasta_fp, 'rb') as fasta_file:
+                yield fasta_file
+
+
+def find_fasta_chunks(fasta_fp, chunk_size):
+    """Split a FASTA file into chunks of about chunk_size bytes that begin at a record header
+    (except the first chunk, which begins at the start of the file).
+
+    :return: list of (start, end) byte offsets, empty if the file is empty
+    """
+    file_size = os.path.getsize(fasta_fp)
+    if file_size == 0:
+        return []
+
+    with open(fasta_fp, 'rb') as fasta_file, \
+            mmap.mmap(fasta_file.fileno(), 0, access=mmap.ACCESS_READ) as fasta_mmap:
+        return split_at_headers(fasta_mmap, 0, file_size, chunk_size)
+
+
+def split_at_headers(fasta_bytes, start, end, split_size):
+    """Return a list of (start, end) covering fasta_bytes[start:end] with each boundary
+    placed at the first header ('\\n>') at or after a multiple of split_size.
+    """
+    boundaries = [start]
+    while True:
+        header_start = fasta_bytes.find(b'\n>', boundaries[-1] + split_size, end)
+        if header_start < 0:
+            break
+        boundaries.append(header_start + 1)
+    boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class ByteRangeReader:
+    """
+    A binary stream over source[start:end] for any source that can be sliced, such as an mmap.
+    """
+    def __init__(self, source, start, end):
+        self.source = source
+        self.position = start
+        self.end = end
+
+    def read(self, size):
+        read_end = min(self.position + size, self.end)
+        data = self.source[self.position:read_end]
+        self.position = read_end
+        return data
+
+
+def validate_fasta_chunk(fasta_fp, chunk_start, chunk_end, block_size=default_block_size):
+    """Validate fasta_fp[chunk_start:chunk_end]. Runs in a worker process.
+
+    Blocks are split at headers so a block holds at least one whole record. A block
+    larger than 2 * block_size, for example one long genome or scaffold record, is
+    streamed block_size bytes at a time as gzipped files are, since validating it in
+    one piece would take about 10 times its size in temporary arrays.
+
+    :return: (read count, seconds, first problem or None) where a problem is
+        (description, record number within the chunk, record id, sequence excerpt)
+    """
     t0 = time.time()
-    alphabet = set(IUPAC.ambiguous_dna.letters)
     read_count = 0
-    for record in SeqIO.parse(fasta_fp, format='fasta', alphabet=IUPAC.ambiguous_dna):
-        read_count += 1
-        seq_letters = set(str(record.seq).upper())
-        if len(seq_letters.difference(alphabet)) == 0:
-            pass
+    with open(fasta_fp, 'rb') as fasta_file, \
+            mmap.mmap(fasta_file.fileno(), 0, access=mmap.ACCESS_READ) as fasta_mmap:
+        for block_start, block_end in split_at_headers(fasta_mmap, chunk_start, chunk_end, block_size):
+            if block_end - block_start > 2 * block_size:
+                block_read_count, problem = validate_fasta_stream(
+                    ByteRangeReader(fasta_mmap, block_start, block_end), block_size)
+            else:
+                block_read_count, problem, _ = validate_fasta_block(fasta_mmap[block_start:block_end])
+            if problem is not None:
+                description, record_number, record_id, excerpt = problem
+                return read_count, time.time() - t0, (description, read_count + record_number, record_id, excerpt)
+            read_count += block_read_count
+
+    return read_count, time.time() - t0, None
+
+
+def validate_sequence_stream(fasta_fp, sequence_format, decompressor='auto', block_size=default_block_size):
+    """Validate a FASTA or FASTQ file, plain or gzipped, reading block_size bytes at a time.
+    Runs in a worker process.
+
+    :param sequence_format: 'fasta' or 'fastq'
+    :return: see validate_fasta_chunk
+    """
+    t0 = time.time()
+    with open_decompressed(fasta_fp, decompressor) as stream:
+        if sequence_format == 'fastq':
+            read_count, problem = validate_fastq_stream(stream, block_size)
         else:
-            msg ='{}: Failed to parse sequence {}\nid: {}\nsequence: {}'.format(fasta_fp, read_count, record.id, record.seq[:1000])
-            raise Exception(msg)
+            read_count, problem = validate_fasta_stream(stream, block_size)
+
+    return read_count, time.time() - t0, problem
+
 
-        if len(record.seq) == 0:
-            msg = '{}: Record {} has 0-length sequence\nid: {}'.format(fasta_fp, read_count, record.id)
+def validate_fasta_stream(stream, block_size):
+    """Validate FASTA records read from a binary stream. Blocks end at a header if there
+    is one, otherwise inside a record, so memory use does not depend on record length.
+
+    :return: (read count, first problem or None)
+    """
+    read_count = 0
+    # sequence length and id of the record continued from the previous block
+    open_record_length = None
+    open_record_id = ''
+    buffer = b''
+    while True:
+        more = stream.read(block_size)
+        buffer += more
+        if len(more) == 0:
+            block_end, ends_at_header = len(buffer), True
+        else:
+            block_end, ends_at_header = find_fasta_block_end(buffer)
+
+        if block_end > 0:
+            block = buffer[:block_end]
+            buffer = buffer[block_end:]
+            block_read_count, problem, last_record_length = validate_fasta_block(
+                block, continued_record_length=open_record_length, final=ends_at_header)
+            if problem is not None:
+                description, record_number, record_id, excerpt = problem
+                if record_number == 0:
+                    record_id = open_record_id
+                return read_count, (description, read_count + record_number, record_id, excerpt)
+
+            read_count += block_read_count
+            if block_read_count > 0:
+                open_record_id = get_record_id(block, block.rfind(b'\n>') + 1)
+            open_record_length = None if ends_at_header else last_record_length
+
+        if len(more) == 0:
+            return read_count, None
+
+
+def find_fasta_block_end(buffer):
+    """Return (end, True) where end is the start of the last header in buffer after the
+    first byte, or if there is none (end, False) where end is inside the last record.
+    The bytes from end on are never a '>' that could be mistaken for a header.
+    Return (0, False) if the buffer cannot be split yet.
+    """
+    header_start = buffer.rfind(b'\n>')
+    if header_start >= 0:
+        return header_start + 1, True
+
+    header_end = buffer.find(b'\n') if buffer.startswith(b'>') else -1
+    if buffer.startswith(b'>') and header_end < 0:
+        return 0, False
+
+    block_end = len(buffer) - 1
+    while block_end > header_end and buffer[block_end] == ord('>'):
+        block_end -= 1
+    if block_end > header_end:
+        return block_end, False
+    else:
+        return 0, False
+
+
+def validate_fastq_stream(stream, block_size):
+    """Validate FASTQ records read from a binary stream. Blocks end after a complete record.
+
+    :return: (read count, first problem or None)
+    """
+    read_count = 0
+    buffer = b''
+    while True:
+        more = stream.read(block_size)
+        buffer += more
+        if len(more) == 0:
+            # ignore trailing blank lines and a missing final newline
+            block = buffer.rstrip(b'\r\n')
+            if len(block) > 0:
+                block += b'\n'
+            buffer = b''
+        else:
+            block_end = find_fastq_block_end(buffer)
+            block = buffer[:block_end]
+            buffer = buffer[block_end:]
+
+        if len(block) > 0:
+            block_read_count, problem = validate_fastq_block(block)
+            if problem is not None:
+                description, record_number, record_id, excerpt = problem
+                return read_count, (description, read_count + record_number, record_id, excerpt)
+            read_count += block_read_count
+
+        if len(more) == 0:
+            return read_count, None
+
+
+def find_fastq_block_end(buffer):
+    """Return the index after the newline that ends the last complete 4-line record in buffer, or 0."""
+    newline_count = buffer.count(b'\n')
+    partial_line_count = newline_count % 4
+    if newline_count == partial_line_count:
+        return 0
+
+    block_end = len(buffer)
+    for _ in range(partial_line_count + 1):
+        block_end = buffer.rfind(b'\n', 0, block_end)
+    return block_end + 1
+
+
+def get_record_id(block, header_position):
+    """Return the first word of the header line at header_position, as Biopython had it."""
+    header_end = block.find(b'\n', header_position)
+    header = block[header_position+1:len(block) if header_end < 0 else header_end].split()
+    return header[0].decode('utf-8', 'replace') if len(header) > 0 else ''
+
+
+def get_line_starts(block_array):
+    line_start = np.empty(len(block_array), dtype=bool)
+    line_start[0] = True
+    line_start[1:] = block_array[:-1] == ord('\n')
+    return line_start
+
+
+def validate_fasta_block(block, continued_record_length=None, final=True):
+    """Validate FASTA records in a bytes object.
+
+    :param continued_record_length: None if the block begins at a header or at the start of a file,
+        otherwise the block continues the sequence of a record from the previous block and this is
+        the length of that sequence so far. That record is record 0 in a problem.
+    :param final: False if the last record may continue in the next block
+    :return: (read count, first problem or None, sequence length of the last record or None if there
+        is no record), see validate_fasta_chunk for problems
+    """
+    block_array = np.frombuffer(block, dtype=np.uint8)
+
+    line_start = get_line_starts(block_array)
+    header_start = line_start & (block_array == ord('>'))
+    read_count = int(np.count_nonzero(header_start))
+
+    # mark every byte of every header line
+    line_index = np.cumsum(line_start, dtype=np.int32) - 1
+    header_byte = header_start[line_start][line_index]
+
+    # record 0 is anything before the first header, record n is the record with the n-th header
+    record_index = np.cumsum(header_start, dtype=np.int32)
+    header_positions = np.flatnonzero(header_start)
+
+    def record_id(record_number):
+        return '' if record_number == 0 else get_record_id(block, header_positions[record_number - 1])
+
+    def leading_data_problem():
+        first_header_position = header_positions[0] if len(header_positions) > 0 else len(block)
+        return 'Found sequence data before the first header', 1, '', block[:min(first_header_position, 1000)]
+
+    sequence_byte = ~header_byte & ~whitespace_table[block_array]
+
+    sequence_lengths = np.bincount(record_index[sequence_byte], minlength=read_count + 1)
+    if continued_record_length is None:
+        first_record_number = 1
+    else:
+        sequence_lengths[0] += continued_record_length
+        first_record_number = 0
+
+    bad_letter = sequence_byte & ~sequence_letter_table[block_array]
+    bad_letter_record_number = int(record_index[np.argmax(bad_letter)]) if bad_letter.any() else read_count + 1
+
+    # the last record is checked when it is complete
+    last_record_number = read_count if final else read_count - 1
+    empty_records = np.flatnonzero(sequence_lengths[first_record_number:last_record_number+1] == 0)
+    empty_record_number = int(empty_records[0]) + first_record_number if len(empty_records) > 0 else read_count + 1
+
+    if continued_record_length is None and sequence_lengths[0] > 0:
+        return read_count, leading_data_problem(), None
+    elif bad_letter_record_number <= empty_record_number and bad_letter_record_number <= read_count:
+        return read_count, (
+            'Failed to parse sequence',
+            bad_letter_record_number,
+            record_id(bad_letter_record_number),
+            block_array[(record_index == bad_letter_record_number) & sequence_byte][:1000].tobytes()), None
+    elif empty_record_number <= read_count:
+        return read_count, ('has 0-length sequence', empty_record_number, record_id(empty_record_number), b''), None
+
+    if read_count == 0 and continued_record_length is None:
+        return read_count, None, None
+    else:
+        return read_count, None, int(sequence_lengths[read_count])
+
+
+def validate_fastq_block(block):
+    """Validate FASTQ records in a bytes object that begins at a record and ends with a newline.
+
+    :return: (read count, first problem or None), see validate_fasta_chunk
+    """
+    block_array = np.frombuffer(block, dtype=np.uint8)
+
+    line_start = get_line_starts(block_array)
+    line_positions = np.flatnonzero(line_start)
+    line_index = np.cumsum(line_start, dtype=np.int32) - 1
+    line_count = len(line_positions)
+    read_count = line_count // 4
+
+    # line 0 of a record is the header, line 1 the sequence, line 2 the separator, line 3 the quality
+    record_index = line_index // 4
+    record_line = line_index % 4
+    text_byte = (block_array != ord('\n')) & (block_array != ord('\r'))
+    sequence_byte = (record_line == 1) & ~whitespace_table[block_array]
+    quality_byte = (record_line == 3) & text_byte
+
+    def first_record(record_mask):
+        records = np.flatnonzero(record_mask)
+        return int(records[0]) if len(records) > 0 else line_count
+
+    def first_byte_record(byte_mask):
+        return int(record_index[np.argmax(byte_mask)]) if byte_mask.any() else line_count
+
+    # an incomplete last record is checked for an empty sequence if it has a sequence line
+    sequence_lengths = np.bincount(record_index[sequence_byte], minlength=read_count + 1)
+    quality_lengths = np.bincount(record_index[quality_byte], minlength=read_count + 1)
+    sequence_line_count = read_count + 1 if line_count % 4 >= 2 else read_count
+
+    # (first record with the problem, description) in the order the problems are checked in a record
+    problems = [
+        (first_record(block_array[line_positions[0::4]] != ord('@')), 'Found malformed FASTQ header in record'),
+        (first_byte_record(sequence_byte & ~sequence_letter_table[block_array]), 'Failed to parse sequence'),
+        (first_record(sequence_lengths[:sequence_line_count] == 0), 'has 0-length sequence'),
+        (first_record(block_array[line_positions[2::4]] != ord('+')), 'Found malformed FASTQ separator in record'),
+        (first_byte_record(quality_byte & ~quality_table[block_array]), 'Failed to parse quality of record'),
+        (first_record(sequence_lengths[:read_count] != quality_lengths[:read_count]), 'Found quality length different from sequence length in record'),
+        (read_count if line_count % 4 != 0 else line_count, 'Found incomplete FASTQ record')]
+
+    record_number, description = min(problems, key=lambda p: p[0])
+    if record_number == line_count:
+        return read_count, None
+    else:
+        return read_count, (
+            description,
+            record_number + 1,
+            get_record_id(block, line_positions[4 * record_number]),
+            block_array[(record_index == record_number) & (record_line == 1) & text_byte][:1000].tobytes())
+
+
+def combine_chunk_results(fasta_fp, chunk_results):
+    """Add up read counts and times for the chunks of one file and raise an
+    Exception describing the first problem.
+
+    :param chunk_results: list of validate_fasta_chunk results in file order
+    :return: (read count, seconds)
+    """
+    read_count = 0
+    t = 0.0
+    for chunk_read_count, chunk_t, problem in chunk_results:
+        t += chunk_t
+        if problem is not None:
+            description, record_number, record_id, excerpt = problem
+            record_number += read_count
+            if description == 'has 0-length sequence':
+                msg = '{}: Record {} has 0-length sequence\nid: {}'.format(fasta_fp, record_number, record_id)
+            else:
+                msg = '{}: {} {}\nid: {}\nsequence: {}'.format(
+                    fasta_fp, description, record_number, record_id, excerpt.decode('utf-8', 'replace'))
             raise Exception(msg)
+        read_count += chunk_read_count
 
     if read_count == 0:
         msg = '{} is empty'.format(fasta_fp)
         raise Exception(msg)
 
-    t = time.time() - t0
     return read_count, t
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
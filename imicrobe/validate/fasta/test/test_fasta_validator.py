@@ -0,0 +1,87 @@
+import gzip
+import os
+
+import pytest
+
+from imicrobe.validate.fasta.fasta_validator import fasta_validate, parse_fasta, validate_fasta_chunk
+
+
+fasta_dp = os.path.dirname(os.path.dirname(__file__))
+
+
+def test_good():
+    read_count, t = parse_fasta(os.path.join(fasta_dp, 'good.fa'))
+    assert read_count == 2
+
+
+@pytest.mark.parametrize('fasta_fn, msg', [
+    ('bad_1.fa', 'before the first header'),
+    ('bad_2.fa', 'Failed to parse sequence 3'),
+    ('bad_3.fa', 'is empty')])
+def test_bad(fasta_fn, msg):
+    with pytest.raises(Exception) as exc_info:
+        parse_fasta(os.path.join(fasta_dp, fasta_fn))
+    assert msg in str(exc_info.value)
+
+
+def test_chunks(tmpdir):
+    fasta_fp = str(tmpdir.join('chunks.fa'))
+    with open(fasta_fp, 'wt') as fasta_file:
+        for i in range(100):
+            fasta_file.write('>read_{}\nACGTN\nacgt\n'.format(i))
+
+    assert parse_fasta(fasta_fp, chunk_size=50)[0] == 100
+
+    with open(fasta_fp, 'at') as fasta_file:
+        fasta_file.write('>read_100\n\n>read_101\nACGT\n')
+
+    with pytest.raises(Exception) as exc_info:
+        parse_fasta(fasta_fp, chunk_size=50)
+    assert 'Record 101 has 0-length sequence\nid: read_100' in str(exc_info.value)
+
+    good, bad = fasta_validate(str(tmpdir.join('*.fa')), max_workers=2, chunk_size=50)
+    assert len(good) == 0
+    assert 'Record 101' in str(bad[0][1])
+
+
+@pytest.mark.parametrize('decompressor', ['auto', 'gzip'])
+def test_gzip_and_fastq(tmpdir, decompressor):
+    with open(os.path.join(fasta_dp, 'good.fa'), 'rb') as good_file:
+        fasta_gz_fp = str(tmpdir.join('good.fa.gz'))
+        with gzip.open(fasta_gz_fp, 'wb') as fasta_gz_file:
+            fasta_gz_file.write(good_file.read())
+    assert parse_fasta(fasta_gz_fp, decompressor=decompressor)[0] == 2
+
+    fastq_gz_fp = str(tmpdir.join('reads.fastq.gz'))
+    with gzip.open(fastq_gz_fp, 'wt') as fastq_gz_file:
+        for i in range(100):
+            fastq_gz_file.write('@read_{} x\nACGTN\n+\nIIIII\n'.format(i))
+    assert parse_fasta(fastq_gz_fp, decompressor=decompressor)[0] == 100
+
+    fastq_fp = str(tmpdir.join('reads.fastq'))
+    with open(fastq_fp, 'wt') as fastq_file:
+        fastq_file.write('@read_0\nACGT\n+\nIIII\n@read_1\nACGT\n+\nIII\n')
+    with pytest.raises(Exception) as exc_info:
+        parse_fasta(fastq_fp, decompressor=decompressor)
+    assert 'quality length different from sequence length in record 2\nid: read_1' in str(exc_info.value)
+
+
+def test_long_record(tmpdir):
+    fasta_fp = str(tmpdir.join('long.fa'))
+    with open(fasta_fp, 'wt') as fasta_file:
+        fasta_file.write('>short\nACGT\n>long\n')
+        fasta_file.write('ACGTACGTAC\n' * 1000)
+        fasta_file.write('>last\nACGT\n')
+    fasta_size = os.path.getsize(fasta_fp)
+
+    # the long record is much larger than 2 * block_size so it is streamed
+    read_count, _, problem = validate_fasta_chunk(fasta_fp, 0, fasta_size, block_size=256)
+    assert read_count == 3
+    assert problem is None
+
+    with open(fasta_fp, 'r+t') as fasta_file:
+        fasta_file.seek(len('>short\nACGT\n>long\n') + 11 * 700)
+        fasta_file.write('X')
+
+    _, _, problem = validate_fasta_chunk(fasta_fp, 0, fasta_size, block_size=256)
+    assert problem[1:3] == (2, 'long')
@@ -16,7 +16,7 @@ import pymongo
 import imicrobe.util.irods as irods
 
 
-def write_sample_metadata_files(target_root, file_limit):
+def write_sample_metadata_files(target_root, file_limit, jobs=4):
     """
     This script is intended to run on a system with access to the iMicrobe MongoDB.
     For each document in the 'sample' collection of the 'imicrobe' database write
@@ -82,38 +82,43 @@ def write_sample_metadata_files(target_root, file_limit):
     print('which files already exist?')
     files_to_be_written = {}
     with irods.irods_session_manager() as irods_session:
-        for metadata_fp, sample_metadata in sorted(samples.items()):
-            print('checking for "{}"'.format(metadata_fp))
-            if irods.irods_data_object_exists(irods_session, metadata_fp):
-                pass
-            else:
-                files_to_be_written[metadata_fp] = sample_metadata
+        existing_metadata_fps = irods.irods_paths_exist(irods_session, samples.keys())
+    for metadata_fp, sample_metadata in sorted(samples.items()):
+        if metadata_fp in existing_metadata_fps:
+            pass
+        else:
+            files_to_be_written[metadata_fp] = sample_metadata
     print('found {} files to be written in {:5.2f}s'.format(len(files_to_be_written), time.time()-t0))
 
     t0 = time.time()
     print('\nwriting {} files'.format(len(files_to_be_written)))
-    with irods.irods_session_manager() as irods_session:
-        for metadata_fp, sample_metadata in sorted(files_to_be_written.items()):
-            print('writing {}'.format(metadata_fp))
-            # remove mongo _id field - it will not serialize
-            del sample_metadata['_id']
-            irods.irods_write_data_object(
-                irods_session,
-                metadata_fp,
-                content=json.dumps(sample_metadata, indent=2))
-            #print(json.dumps(sample_metadata, indent=2))
-    print('wrote {} metadata files in {:5.3f}s'.format(len(files_to_be_written), time.time()-t0))
+    for sample_metadata in files_to_be_written.values():
+        # remove mongo _id field - it will not serialize
+        del sample_metadata['_id']
+    failed_metadata_fps = irods.irods_write_data_objects(
+        {
+            metadata_fp: json.JSONEncoder(indent=2).iterencode(sample_metadata)
+            for metadata_fp, sample_metadata
+            in sorted(files_to_be_written.items())
+        },
+        jobs=jobs)
+    print('wrote {} metadata files in {:5.3f}s'.format(
+        len(files_to_be_written) - len(failed_metadata_fps), time.time()-t0))
+
 
 def main(argv):
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--target-root', default='/iplant/home/shared/imicrobe/projects')
     arg_parser.add_argument('--file-limit', type=int, default=0, required=False)
+    arg_parser.add_argument('--jobs', type=int, default=4, required=False,
+                            help='number of files written at the same time')
 
     args = arg_parser.parse_args(args=argv)
 
     write_sample_metadata_files(
         target_root=args.target_root,
-        file_limit=args.file_limit)
+        file_limit=args.file_limit,
+        jobs=args.jobs)
 
 
 def cli():
@@ -64,14 +64,13 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
-        'biopython',
         'pymongo',
         'orminator',
         'python-irodsclient',
+        'numpy',
         'pandas',
         'sqlalchemy',
-        'requests',
-        'requests_cache'
+        'requests'
     ],
 
     # List additional groups of dependencies here (e.g. development